@@ -1,12 +1,38 @@
 """
 API endpoints
 """
-from fastapi import APIRouter, UploadFile, File, Form
+import json
+import secrets
+from datetime import datetime
+from fastapi import APIRouter, UploadFile, File, Form, Request, Header, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+
+import services.telegram_bot as telegram_bot
+from config.settings import TELEGRAM_MODE, TELEGRAM_WEBHOOK_SECRET, DISPATCH_SECRET
 
 from models.schemas import ChatResponse
-from services.gemini_service import run_agent
-from services.memory_service import save_message, get_chat_history, clear_session_history
-from database.mongodb import ping_db
+from services.gemini_service import run_agent, run_agent_stream
+from services.memory_service import (
+    save_turn,
+    save_unanswered,
+    get_chat_history,
+    get_context,
+    clear_session_history,
+    get_history_cache_stats,
+    get_memory_stats,
+)
+from services.context_cache import get_cache_stats
+from services.mongo_service import get_result_cache_stats, get_pushdown_stats
+from services.router_service import get_router_stats
+from services.admission import get_admission_stats
+from services.call_policy import get_call_policy_stats
+from services.image_service import prepare_image, get_image_stats
+from services.query_guard import get_advisor_report
+from services.schema_digest import get_digest_stats
+from services.rollup_service import get_rollup_stats
+from services.metrics import start_timings, render as render_metrics
+from services.turn_pipeline import overlap, get_pipeline_stats
+from database.mongodb import ping_db, get_collection
 
 router = APIRouter()
 
@@ -14,6 +40,16 @@ router = APIRouter()
 # ──────────────────────────── Endpoints ─────────────────────────
 
 
+async def _read_image(image: UploadFile | None) -> tuple[bytes | None, str | None]:
+    """Uploaded image → (bytes, mime) ready for Gemini; (None, None) without one"""
+    if not image:
+        return None, None
+    try:
+        return await prepare_image(await image.read(), image.content_type)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Imagen no válida: {e}")
+
+
 @router.post("/chat", response_model=ChatResponse)
 async def chat(
     message: str = Form(...),
@@ -28,31 +64,149 @@ async def chat(
         session_id: ID único de la sesión de conversación
         image: Imagen opcional
     """
-    image_bytes = None
-    image_mime = None
+    received_at = datetime.utcnow()
+    timings = start_timings()
 
-    if image:
-        image_bytes = await image.read()
-        image_mime = image.content_type
-
-    # Get chat history
-    history = await get_chat_history(session_id)
-
-    # Save user message to history (without image, only text)
-    await save_message(session_id, "user", message)
+    # Image preparation ∥ rolling summary + newest turns within the token budget
+    (image_bytes, image_mime), (summary, history) = await overlap(
+        _read_image(image), get_context(session_id)
+    )
 
     # Ask Gemini with history (agent loop)
-    llm, steps = await run_agent(message, image_bytes, image_mime, history)
+    try:
+        llm, steps = await run_agent(
+            message, image_bytes, image_mime, history, summary=summary, session_id=session_id
+        )
+    except Exception:
+        # No reply to pair it with, but the user's message stays in history
+        await save_unanswered(session_id, message, received_at)
+        raise
 
-    data = {"steps": steps}
     op_dict = llm.operation.model_dump(exclude_none=True) if llm.operation else None
 
-    # Save assistant reply to history
-    await save_message(session_id, "assistant", llm.reply)
+    # Save the turn to history (user text without image + reply)
+    await save_turn(session_id, message, llm.reply, user_at=received_at)
+
+    # Per-step timings live in each step; this list has the whole request
+    data = {"steps": steps, "timings": timings}
 
     return ChatResponse(reply=llm.reply, operation=op_dict, data=data)
 
 
+def _sse(event: str, data) -> str:
+    """Format one Server-Sent Event"""
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+@router.post("/chat/stream")
+async def chat_stream(
+    message: str = Form(...),
+    session_id: str = Form(...),
+    image: UploadFile | None = File(default=None),
+):
+    """
+    Variante SSE de /chat: emite la respuesta token a token.
+
+    Eventos:
+        token: {"step": n, "text": "..."} texto de la respuesta del paso n
+        step: {"step": n, "llm": {...}, "result": ...} al terminar cada paso
+        final: ChatResponse completo
+    """
+    received_at = datetime.utcnow()
+    timings = start_timings()
+    (image_bytes, image_mime), (summary, history) = await overlap(
+        _read_image(image), get_context(session_id)
+    )
+
+    async def events():
+        start_timings(timings)
+        saved = False
+        try:
+            async for event in run_agent_stream(
+                message, image_bytes, image_mime, history, summary=summary, session_id=session_id
+            ):
+                if event["type"] == "token":
+                    yield _sse("token", {"step": event["step"], "text": event["text"]})
+                elif event["type"] == "step":
+                    yield _sse("step", {"step": event["step"], **event["info"]})
+                else:
+                    llm = event["llm"]
+                    saved = True
+                    await save_turn(session_id, message, llm.reply, user_at=received_at)
+                    op_dict = llm.operation.model_dump(exclude_none=True) if llm.operation else None
+                    response = ChatResponse(
+                        reply=llm.reply,
+                        operation=op_dict,
+                        data={"steps": event["steps"], "timings": timings},
+                    )
+                    yield _sse("final", response.model_dump())
+        finally:
+            # Failed or disconnected before the reply: keep the user's message
+            if not saved:
+                await save_unanswered(session_id, message, received_at)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post(telegram_bot.WEBHOOK_PATH + "/{secret}", include_in_schema=False)
+async def telegram_webhook(
+    secret: str,
+    request: Request,
+    x_telegram_bot_api_secret_token: str | None = Header(default=None),
+):
+    """
+    Telegram webhook: recibe updates y los encola en el bot.
+    Solo activo con TELEGRAM_MODE=webhook.
+    """
+    if (
+        TELEGRAM_MODE != "webhook"
+        or telegram_bot.bot_app is None
+        or not TELEGRAM_WEBHOOK_SECRET
+        or not secrets.compare_digest(secret, TELEGRAM_WEBHOOK_SECRET)
+    ):
+        raise HTTPException(status_code=404)
+    if not secrets.compare_digest(
+        x_telegram_bot_api_secret_token or "", TELEGRAM_WEBHOOK_SECRET
+    ):
+        raise HTTPException(status_code=403)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="JSON no válido")
+    if not isinstance(data, dict) or "update_id" not in data:
+        raise HTTPException(status_code=400, detail="Update no válido")
+    try:
+        await telegram_bot.process_webhook_update(data)
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Update no válido: {e}")
+    return {"ok": True}
+
+
+@router.post(telegram_bot.DISPATCH_PATH, include_in_schema=False)
+async def telegram_dispatched_turn(
+    request: Request,
+    x_dispatch_secret: str | None = Header(default=None),
+):
+    """
+    Turno de Telegram reenviado por el dispatcher (DEPLOY_MODE=workers).
+    Responde cuando el turno termina, para que el dispatcher mantenga el
+    orden por usuario.
+    """
+    if telegram_bot.worker_bot is None or not DISPATCH_SECRET:
+        raise HTTPException(status_code=404)
+    if not secrets.compare_digest(x_dispatch_secret or "", DISPATCH_SECRET):
+        raise HTTPException(status_code=403)
+
+    await telegram_bot.run_forwarded_turn(await request.json())
+    return {"ok": True}
+
+
 @router.get("/health")
 async def health():
     db_connected = await ping_db()
@@ -62,6 +216,41 @@ async def health():
     }
 
 
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Per-stage latency, turn, step and token histograms (Prometheus format)"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/stats")
+async def stats():
+    """Cache and router counters for measuring latency/cost savings"""
+    return {
+        "context_cache": get_cache_stats(),
+        "memory": get_memory_stats(),
+        "history_cache": get_history_cache_stats(),
+        "mongo_result_cache": get_result_cache_stats(),
+        "mongo_pushdown": get_pushdown_stats(),
+        "schema_digest": get_digest_stats(),
+        "rollups": get_rollup_stats(),
+        "router": get_router_stats(),
+        "gemini_admission": get_admission_stats(),
+        "gemini_call_policy": get_call_policy_stats(),
+        "images": get_image_stats(),
+        "telegram_dispatcher": telegram_bot.get_dispatcher_stats(),
+        "turn_pipeline": get_pipeline_stats(),
+    }
+
+
+@router.get("/advisor/indexes")
+async def index_advisor():
+    """
+    Query shapes generated by the model, their plan, and the index that
+    would serve each one
+    """
+    return await get_advisor_report(get_collection())
+
+
 @router.get("/history/{session_id}")
 async def get_history(session_id: str, limit: int = 20):
     """
@@ -0,0 +1,84 @@
+"""
+Benchmark: agent steps per data question with and without the schema digest
+
+Runs the same data questions through run_agent twice, first with the
+schema digest left out of the system context and then with it, and
+prints average agent steps, exploratory reads (find_one or an unfiltered
+find issued before any real query) and turn latency. Uses the Gemini API
+and the MongoDB collection configured in .env.
+
+    python -m benchmarks.agent_steps --rounds 2
+"""
+import argparse
+import asyncio
+import time
+
+from database.mongodb import init_db, close_db
+from services import schema_digest
+from services.gemini_service import init_gemini, run_agent
+
+QUESTIONS = [
+    "¿Cuánto gasté en total el mes pasado?",
+    "¿Cuáles son los 5 negocios donde más dinero he gastado?",
+    "¿En qué categoría gasto más?",
+    "¿Cuántas veces fui a comer fuera esta semana?",
+    "Compara mis gastos de este mes con los del mes anterior",
+    "¿Cuál fue mi compra más cara?",
+]
+
+
+def _exploratory(steps: list[dict]) -> int:
+    """Reads that only look at the shape of the data"""
+    count = 0
+    for step in steps:
+        llm = step.get("llm") or {}
+        ops = ([llm["operation"]] if llm.get("operation") else []) + (llm.get("operations") or [])
+        for op in ops:
+            if op.get("action") == "find_one" or (op.get("action") == "find" and not op.get("filter")):
+                count += 1
+    return count
+
+
+async def _run_questions(rounds: int) -> dict:
+    steps_total, explore_total, ms_total, n = 0, 0, 0.0, 0
+    for _ in range(rounds):
+        for question in QUESTIONS:
+            started = time.perf_counter()
+            _llm, steps = await run_agent(question, session_id="benchmark")
+            ms_total += (time.perf_counter() - started) * 1000
+            steps_total += len(steps)
+            explore_total += _exploratory(steps)
+            n += 1
+    return {
+        "avg_steps": steps_total / n,
+        "avg_exploratory": explore_total / n,
+        "avg_ms": ms_total / n,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=1)
+    args = parser.parse_args()
+
+    await init_db()
+    init_gemini()
+    # Sample once up front; the background task is not needed here
+    schema_digest.stop_schema_digest()
+    await schema_digest.refresh_digest()
+
+    schema_digest.SCHEMA_DIGEST = False
+    before = await _run_questions(args.rounds)
+    schema_digest.SCHEMA_DIGEST = True
+    after = await _run_questions(args.rounds)
+
+    print(f"{len(QUESTIONS)} questions x {args.rounds} rounds, digest {len(schema_digest.get_digest())} chars")
+    print(f"{'':<16}{'steps':>8}{'explore':>10}{'turn ms':>10}")
+    for name, r in (("without digest", before), ("with digest", after)):
+        print(f"{name:<16}{r['avg_steps']:>8.2f}{r['avg_exploratory']:>10.2f}{r['avg_ms']:>10.0f}")
+
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+"""
+Microbenchmark: BSON → JSON conversion of a 100-document result set
+
+Compares the previous json_util.dumps + json.loads round trip (plus the
+json.dumps for the prompt) with mongo_service.bson_to_json + to_json_text.
+Needs only pymongo's bson package, no running mongod.
+
+    python -m benchmarks.bson_conversion --docs 100 --rounds 2000
+"""
+import argparse
+import json
+import random
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+from bson import ObjectId, Decimal128, json_util
+
+from services.mongo_service import bson_to_json, to_json_text
+
+
+def make_docs(n: int) -> list[dict]:
+    """Llego-like documents with the BSON types the app actually stores"""
+    base = datetime(2024, 1, 1)
+    return [
+        {
+            "_id": ObjectId(),
+            "negocio": f"Negocio {i % 17}",
+            "categoria": random.choice(["comida", "transporte", "ocio", "casa"]),
+            "monto": Decimal128(Decimal(f"{random.uniform(1, 500):.2f}")),
+            "cantidad": random.randint(1, 5),
+            "fecha": base + timedelta(hours=i),
+            "tags": ["llego", f"t{i % 5}"],
+            "ubicacion": {"ciudad": "La Habana", "lat": 23.1136, "lng": -82.3666},
+        }
+        for i in range(n)
+    ]
+
+
+def old_path(docs):
+    converted = json.loads(json_util.dumps(docs))
+    return json.dumps(converted, ensure_ascii=False)
+
+
+def new_path(docs):
+    return to_json_text(bson_to_json(docs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    docs = make_docs(args.docs)
+    old = min(timeit.repeat(lambda: old_path(docs), number=args.rounds, repeat=3))
+    new = min(timeit.repeat(lambda: new_path(docs), number=args.rounds, repeat=3))
+
+    per_old = old / args.rounds * 1e6
+    per_new = new / args.rounds * 1e6
+    print(f"{args.docs} docs x {args.rounds} rounds")
+    print(f"json_util round trip + dumps: {per_old:8.1f} µs/result")
+    print(f"single-pass + compact dumps:  {per_new:8.1f} µs/result")
+    print(f"speedup: {per_old / per_new:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Exercise the Gemini call policy against the local fake server
+
+Starts benchmarks.fake_gemini in-process and runs ask_gemini through
+four scenarios: transient 503s (retries), a slow tail with and without
+hedging (latency percentiles), a full outage (circuit breaker opens, then
+closes again once the fake recovers) and a half-open probe that gets
+cancelled (the breaker must not stay stuck). No API key or network needed.
+
+    python -m benchmarks.call_policy_check --calls 100
+"""
+import argparse
+import asyncio
+import os
+import time
+
+PORT = 8765
+
+# Point the client at the fake before config.settings is imported
+os.environ.setdefault("GEMINI_API_KEY", "fake")
+os.environ["GEMINI_BASE_URL"] = f"http://127.0.0.1:{PORT}"
+os.environ["GEMINI_CONTEXT_CACHE"] = "false"
+os.environ.setdefault("GEMINI_RETRY_BASE_DELAY", "0.05")
+os.environ.setdefault("GEMINI_BREAKER_COOLDOWN", "2")
+os.environ.setdefault("GEMINI_RATE_LIMIT", "0")
+
+from benchmarks import fake_gemini  # noqa: E402
+from services import call_policy  # noqa: E402
+from services.gemini_service import init_gemini, ask_gemini  # noqa: E402
+
+
+def _pct(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def _run(calls: int, concurrency: int) -> tuple[list[float], int]:
+    """Issue calls with bounded concurrency; returns latencies (ms) and errors"""
+    sem = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with sem:
+            info = {}
+            started = time.perf_counter()
+            llm = await ask_gemini(f"mensaje {i}", call_info=info)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if llm.reply.startswith("Error") or info.get("shed"):
+                errors += 1
+
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    return latencies, errors
+
+
+def _report(name: str, latencies: list[float], errors: int):
+    print(
+        f"{name:<28} n={len(latencies):<4} errors={errors:<3} "
+        f"p50={_pct(latencies, .5):7.1f}ms p95={_pct(latencies, .95):7.1f}ms "
+        f"p99={_pct(latencies, .99):7.1f}ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    server = await fake_gemini.serve(PORT, latency_ms=100.0)
+    init_gemini()
+
+    # 1. Transient errors: retries should hide them
+    fake_gemini.config.update(error_rate=0.2, slow_rate=0.0)
+    before = dict(call_policy.policy_stats)
+    _report("20% 503s, retries", *await _run(args.calls, args.concurrency))
+    print(f"  retries: {call_policy.policy_stats['retries'] - before['retries']}")
+
+    # 2. Slow tail, without and with hedging
+    fake_gemini.config.update(error_rate=0.0, slow_rate=0.05, slow_factor=15.0)
+    call_policy.GEMINI_HEDGE = False
+    _report("5% slow tail, no hedge", *await _run(args.calls, args.concurrency))
+    call_policy.GEMINI_HEDGE = True
+    before = dict(call_policy.policy_stats)
+    _report("5% slow tail, hedged", *await _run(args.calls, args.concurrency))
+    print(
+        f"  hedges: {call_policy.policy_stats['hedges'] - before['hedges']}, "
+        f"won by hedge: {call_policy.policy_stats['hedge_wins'] - before['hedge_wins']}"
+    )
+    call_policy.GEMINI_HEDGE = False
+
+    # 3. Outage: breaker opens and fails fast, then recovers
+    fake_gemini.config.update(error_rate=1.0, slow_rate=0.0)
+    before_requests = fake_gemini.stats["requests"]
+    _report("outage", *await _run(20, 1))
+    print(
+        f"  breaker: {call_policy.breaker.state}, upstream requests: "
+        f"{fake_gemini.stats['requests'] - before_requests}, "
+        f"rejected fast: {call_policy.policy_stats['rejected_open']}"
+    )
+    fake_gemini.config.update(error_rate=0.0)
+    await asyncio.sleep(call_policy.breaker.cooldown)
+    _report("after recovery", *await _run(10, 1))
+    print(f"  breaker: {call_policy.breaker.state}")
+
+    # 4. Cancelled probe: the next call after it must be let through
+    fake_gemini.config.update(error_rate=1.0)
+    await _run(20, 1)
+    fake_gemini.config.update(error_rate=0.0)
+    await asyncio.sleep(call_policy.breaker.cooldown)
+    try:
+        await asyncio.wait_for(ask_gemini("sonda cancelada"), timeout=0.01)
+    except asyncio.TimeoutError:
+        pass
+    latencies, errors = await _run(5, 1)
+    _report("after cancelled probe", latencies, errors)
+    print(f"  breaker: {call_policy.breaker.state}, probing: {call_policy.breaker.probing}")
+    if errors or call_policy.breaker.state != "closed":
+        raise SystemExit("FALLO: el breaker quedó bloqueado tras una sonda cancelada")
+
+    server.should_exit = True
+    await asyncio.sleep(0.2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,193 @@
+"""
+Deterministic in-process stand-in for the google-genai client
+
+Drop-in replacement for gemini_service.gemini_client in load tests: no
+network, no quota. Implements what Robert calls (aio.models
+generate_content / generate_content_stream and aio.caches) and answers
+from per-question scripts, so the agent loop issues real MongoDB
+operations. Latency and token counts derive from the request contents,
+not from a shared RNG, so runs are repeatable at any concurrency.
+
+    client = FakeGeminiClient(scripts={"¿Cuánto gasté?": [step1, step2]})
+    gemini_service.gemini_client = client
+"""
+import asyncio
+import json
+import zlib
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from google.genai import types
+
+# Reply used for questions without a script
+DEFAULT_SCRIPT = [{"reply": "Respuesta de prueba del cliente falso.", "is_final": True}]
+
+# Prefix of the user turns the agent loop adds with MongoDB results
+_RESULT_PREFIX = "[RESULTADO_MONGO"
+
+
+def _text(content) -> str:
+    if isinstance(content, str):
+        return content
+    for part in content.parts or []:
+        if part.text:
+            return part.text
+    return ""
+
+
+class FakeGeminiClient:
+    """
+    Args:
+        scripts: question → list of LLMResponse-shaped dicts, one per agent
+            step (the last one should be final)
+        latency_ms: mean latency of a call
+        jitter: ± fraction applied to latency_ms (deterministic per request)
+        ms_per_output_token: extra latency per generated token
+        chars_per_token: how prompt/output text is converted to token counts
+        stream_chunks: chunks per streamed response
+    """
+
+    def __init__(
+        self,
+        scripts: dict[str, list[dict]] | None = None,
+        latency_ms: float = 300.0,
+        jitter: float = 0.2,
+        ms_per_output_token: float = 0.0,
+        chars_per_token: float = 4.0,
+        stream_chunks: int = 6,
+    ):
+        self.scripts = scripts or {}
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.ms_per_output_token = ms_per_output_token
+        self.chars_per_token = chars_per_token
+        self.stream_chunks = stream_chunks
+        self._caches: dict[str, str] = {}
+        self.stats = {
+            "calls": 0,
+            "stream_calls": 0,
+            "router_calls": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "output_tokens": 0,
+        }
+        self.aio = SimpleNamespace(
+            models=SimpleNamespace(
+                generate_content=self.generate_content,
+                generate_content_stream=self.generate_content_stream,
+            ),
+            caches=SimpleNamespace(
+                create=self._create_cache,
+                update=self._update_cache,
+                delete=self._delete_cache,
+            ),
+        )
+
+    # ──────────────────────────── Scripts ───────────────────────
+
+    def _step(self, contents) -> tuple[str, int]:
+        """(question, agent step) for a request"""
+        if isinstance(contents, str):
+            return contents, 0
+        texts = [_text(c) for c in contents if c.role == "user"]
+        results = [i for i, t in enumerate(texts) if t.startswith(_RESULT_PREFIX)]
+        if not results:
+            return (texts[-1] if texts else ""), 0
+        # The question is the user turn right before the first result
+        return texts[results[0] - 1], len(results)
+
+    def _reply(self, contents, config) -> str:
+        question, step = self._step(contents)
+        script = self.scripts.get(question.strip(), DEFAULT_SCRIPT)
+        mime = getattr(config, "response_mime_type", None)
+        if mime == "text/x.enum":
+            self.stats["router_calls"] += 1
+            needs_data = len(script) > 1 or script[0].get("operation") or script[0].get("operations")
+            return "data" if needs_data else "chat"
+        if mime != "application/json":
+            return script[-1]["reply"]
+        return json.dumps(script[min(step, len(script) - 1)], ensure_ascii=False)
+
+    # ──────────────────────────── Responses ─────────────────────
+
+    def _tokens(self, text: str) -> int:
+        return max(1, int(len(text) / self.chars_per_token))
+
+    def _usage(self, contents, config, reply: str) -> types.GenerateContentResponseUsageMetadata:
+        prompt = contents if isinstance(contents, str) else "".join(_text(c) for c in contents)
+        cached = 0
+        system = getattr(config, "system_instruction", None)
+        if isinstance(system, str):
+            prompt += system
+        cached_name = getattr(config, "cached_content", None)
+        if cached_name in self._caches:
+            cached = self._tokens(self._caches[cached_name])
+        prompt_tokens = self._tokens(prompt) + cached
+        output_tokens = self._tokens(reply)
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["cached_tokens"] += cached
+        self.stats["output_tokens"] += output_tokens
+        return types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached or None,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        )
+
+    def _latency(self, contents, reply: str) -> float:
+        seed = zlib.crc32(repr(contents).encode("utf-8")) / 0xFFFFFFFF
+        base = self.latency_ms * (1 - self.jitter + 2 * self.jitter * seed)
+        return (base + self.ms_per_output_token * self._tokens(reply)) / 1000
+
+    @staticmethod
+    def _response(text: str, usage=None, finished: bool = True) -> types.GenerateContentResponse:
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(
+                content=types.Content(role="model", parts=[types.Part.from_text(text=text)]),
+                finish_reason=types.FinishReason.STOP if finished else None,
+            )],
+            usage_metadata=usage,
+        )
+
+    async def generate_content(self, *, model: str, contents, config=None):
+        self.stats["calls"] += 1
+        reply = self._reply(contents, config)
+        await asyncio.sleep(self._latency(contents, reply))
+        return self._response(reply, self._usage(contents, config, reply))
+
+    async def generate_content_stream(self, *, model: str, contents, config=None):
+        self.stats["calls"] += 1
+        self.stats["stream_calls"] += 1
+        reply = self._reply(contents, config)
+        latency = self._latency(contents, reply)
+        n = max(1, self.stream_chunks)
+        size = max(1, len(reply) // n + 1)
+        pieces = [reply[i:i + size] for i in range(0, len(reply), size)] or [""]
+
+        async def chunks():
+            # Half the latency before the first token, the rest spread out
+            await asyncio.sleep(latency / 2)
+            for i, piece in enumerate(pieces):
+                if i:
+                    await asyncio.sleep(latency / 2 / len(pieces))
+                last = i == len(pieces) - 1
+                usage = self._usage(contents, config, reply) if last else None
+                yield self._response(piece, usage, finished=last)
+
+        return chunks()
+
+    # ──────────────────────────── Context Cache ─────────────────
+
+    async def _create_cache(self, *, model: str, config=None):
+        name = f"cachedContents/fake{len(self._caches)}"
+        self._caches[name] = getattr(config, "system_instruction", "") or ""
+        return types.CachedContent(
+            name=name,
+            model=model,
+            expire_time=datetime.now(timezone.utc) + timedelta(hours=1),
+        )
+
+    async def _update_cache(self, *, name: str, config=None):
+        return types.CachedContent(name=name)
+
+    async def _delete_cache(self, *, name: str, config=None):
+        self._caches.pop(name, None)
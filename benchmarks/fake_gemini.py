@@ -0,0 +1,217 @@
+"""
+Local fake of the Gemini REST API for offline tests and benchmarks
+
+Implements just what Robert uses: generateContent, streamGenerateContent
+(SSE) and cachedContents. Latency, slow-tail rate and error rate are
+configurable at start-up and at runtime (POST /fake/config), so the
+call policy (retries, hedging, circuit breaker) can be exercised without
+a real API key.
+
+    python -m benchmarks.fake_gemini --port 8765 --latency-ms 300 --error-rate 0.1
+    GEMINI_BASE_URL=http://127.0.0.1:8765 GEMINI_API_KEY=fake uvicorn main:app
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Fake Gemini")
+
+config = {
+    "latency_ms": 200.0,   # mean latency of a normal response
+    "jitter": 0.3,         # ± fraction applied to latency_ms
+    "slow_rate": 0.0,      # fraction of requests that take slow_factor x longer
+    "slow_factor": 10.0,
+    "error_rate": 0.0,     # fraction of requests answered with error_status
+    "error_status": 503,
+    "stream_chunks": 6,
+}
+
+stats = {"requests": 0, "errors": 0, "slow": 0, "cancelled": 0}
+
+
+# ──────────────────────────── Behaviour ─────────────────────────
+
+
+def _latency() -> float:
+    base = config["latency_ms"] * random.uniform(1 - config["jitter"], 1 + config["jitter"])
+    if random.random() < config["slow_rate"]:
+        stats["slow"] += 1
+        base *= config["slow_factor"]
+    return base / 1000
+
+
+def _error() -> JSONResponse | None:
+    if random.random() >= config["error_rate"]:
+        return None
+    stats["errors"] += 1
+    status = int(config["error_status"])
+    return JSONResponse(
+        status_code=status,
+        content={"error": {"code": status, "message": "fake upstream error", "status": "UNAVAILABLE"}},
+    )
+
+
+def _last_user_text(body: dict) -> str:
+    for content in reversed(body.get("contents", [])):
+        if content.get("role", "user") == "user":
+            texts = [p["text"] for p in content.get("parts", []) if "text" in p]
+            if texts:
+                return texts[-1]
+    return ""
+
+
+def _reply_text(body: dict) -> str:
+    """A reply in the format the request asked for"""
+    generation = body.get("generationConfig", {})
+    mime = generation.get("responseMimeType") or generation.get("response_mime_type")
+    if mime == "text/x.enum":
+        return "data"
+    if mime == "application/json":
+        return json.dumps(
+            {"reply": "Respuesta de prueba del servidor falso.", "is_final": True},
+            ensure_ascii=False,
+        )
+    return f"Respuesta de prueba a: {_last_user_text(body)[:60]}"
+
+
+def _candidate(text: str, body: dict, finished: bool = True) -> dict:
+    prompt_chars = len(json.dumps(body.get("contents", [])))
+    result = {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": text}]},
+            "index": 0,
+        }],
+        "usageMetadata": {
+            "promptTokenCount": prompt_chars // 4,
+            "candidatesTokenCount": max(1, len(text) // 4),
+            "totalTokenCount": prompt_chars // 4 + max(1, len(text) // 4),
+        },
+        "modelVersion": "fake-gemini",
+    }
+    if finished:
+        result["candidates"][0]["finishReason"] = "STOP"
+    return result
+
+
+# ──────────────────────────── Routes ────────────────────────────
+
+
+@app.post("/{version}/models/{target}")
+async def models(version: str, target: str, request: Request):
+    model, _, method = target.partition(":")
+    body = await request.json()
+    stats["requests"] += 1
+
+    try:
+        await asyncio.sleep(_latency())
+    except asyncio.CancelledError:
+        # Client gave up (timeout or losing hedge)
+        stats["cancelled"] += 1
+        raise
+
+    error = _error()
+    if error is not None:
+        return error
+
+    text = _reply_text(body)
+    if method == "generateContent":
+        return _candidate(text, body)
+
+    # streamGenerateContent?alt=sse
+    n = max(1, int(config["stream_chunks"]))
+    size = max(1, len(text) // n + 1)
+    pieces = [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def events():
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(config["latency_ms"] / 1000 / n)
+            chunk = _candidate(piece, body, finished=i == len(pieces) - 1)
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/{version}/cachedContents")
+async def create_cache(version: str, request: Request):
+    body = await request.json()
+    ttl = float(str(body.get("ttl", "3600s")).rstrip("s"))
+    expire = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+    return {
+        "name": f"cachedContents/{uuid.uuid4().hex[:12]}",
+        "model": body.get("model"),
+        "expireTime": expire.isoformat().replace("+00:00", "Z"),
+    }
+
+
+@app.patch("/{version}/cachedContents/{cache_id}")
+async def update_cache(version: str, cache_id: str, request: Request):
+    body = await request.json()
+    ttl = float(str(body.get("ttl", "3600s")).rstrip("s"))
+    expire = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+    return {"name": f"cachedContents/{cache_id}", "expireTime": expire.isoformat().replace("+00:00", "Z")}
+
+
+@app.delete("/{version}/cachedContents/{cache_id}")
+async def delete_cache(version: str, cache_id: str):
+    return {}
+
+
+@app.post("/fake/config")
+async def set_config(request: Request):
+    """Change behaviour at runtime, e.g. {"error_rate": 1.0} for an outage"""
+    config.update(await request.json())
+    return config
+
+
+@app.get("/fake/stats")
+async def get_stats():
+    return {**stats, "config": config}
+
+
+# ──────────────────────────── Runner ────────────────────────────
+
+
+async def serve(port: int = 8765, **overrides):
+    """Run the fake server inside the current event loop (returns the server)"""
+    import uvicorn
+
+    config.update({k: v for k, v in overrides.items() if v is not None})
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    asyncio.get_running_loop().create_task(server.serve())
+    started = time.monotonic()
+    while not server.started:
+        if time.monotonic() - started > 10:
+            raise RuntimeError("Fake Gemini server did not start")
+        await asyncio.sleep(0.05)
+    return server
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=config["latency_ms"])
+    parser.add_argument("--slow-rate", type=float, default=config["slow_rate"])
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"])
+    parser.add_argument("--error-status", type=int, default=config["error_status"])
+    args = parser.parse_args()
+
+    config.update(
+        latency_ms=args.latency_ms,
+        slow_rate=args.slow_rate,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
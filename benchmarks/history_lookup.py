@@ -0,0 +1,105 @@
+"""
+Benchmark: latest-N history lookup as the chats collection grows
+
+Seeds a scratch collection on a local mongod in increasing sizes and times
+the same query memory_service uses (sessionID filter, timestamp desc,
+role/message projection). With the (sessionID, timestamp) index the
+latency should stay flat; run with --no-index to see the collection scan.
+
+    python -m benchmarks.history_lookup --sizes 10000 100000 1000000
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+
+from config.settings import MONGO_URI
+from benchmarks.local_target import check_local_target
+
+SESSIONS = 5000
+QUERY_LIMIT = 20
+# --db holds the scratch collection, dropped before and after the run
+DB_PREFIX = "robert_bench"
+
+
+def seed(col, start: int, end: int):
+    """Insert messages [start, end) spread over SESSIONS sessions"""
+    base = datetime(2024, 1, 1)
+    batch = []
+    for i in range(start, end):
+        batch.append({
+            "sessionID": f"bench_{i % SESSIONS}",
+            "role": "user" if i % 2 == 0 else "assistant",
+            "message": f"mensaje de prueba {i}",
+            "timestamp": base + timedelta(seconds=i),
+        })
+        if len(batch) == 10000:
+            col.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        col.insert_many(batch, ordered=False)
+
+
+def time_lookups(col, rounds: int) -> list[float]:
+    samples = []
+    for _ in range(rounds):
+        session_id = f"bench_{random.randrange(SESSIONS)}"
+        started = time.perf_counter()
+        docs = list(
+            col.find({"sessionID": session_id}, {"_id": 0, "role": 1, "message": 1})
+            .sort("timestamp", -1)
+            .limit(QUERY_LIMIT)
+        )
+        docs.reverse()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def winning_stage(col) -> str:
+    plan = (
+        col.find({"sessionID": "bench_0"}, {"_id": 0, "role": 1, "message": 1})
+        .sort("timestamp", -1)
+        .limit(QUERY_LIMIT)
+        .explain()
+    )
+    stage = plan["queryPlanner"]["winningPlan"]
+    stages = []
+    while stage:
+        stages.append(stage.get("stage", "?"))
+        stage = stage.get("inputStage")
+    return " <- ".join(stages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--no-index", action="store_true")
+    parser.add_argument("--db", default=DB_PREFIX, help=f"Must start with {DB_PREFIX}")
+    args = parser.parse_args()
+    check_local_target([args.db], DB_PREFIX)
+
+    client = MongoClient(MONGO_URI)
+    col = client[args.db]["chats_bench"]
+    col.drop()
+    if not args.no_index:
+        col.create_index([("sessionID", 1), ("timestamp", -1)], name="session_timestamp")
+
+    seeded = 0
+    print(f"{'docs':>10}  {'p50 ms':>8}  {'p95 ms':>8}  plan")
+    for size in sorted(args.sizes):
+        seed(col, seeded, size)
+        seeded = size
+        samples = sorted(time_lookups(col, args.rounds))
+        p50 = statistics.median(samples)
+        p95 = samples[int(len(samples) * 0.95) - 1]
+        print(f"{size:>10}  {p50:>8.2f}  {p95:>8.2f}  {winning_stage(col)}")
+
+    col.drop()
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+"""
+Offline load test: /chat and the Telegram handlers under concurrency
+
+Swaps gemini_service.gemini_client for benchmarks.fake_client (scripted
+tool calls, configurable latency and token counts), seeds a synthetic
+Llego dataset plus chat history on a local mongod, and drives whole turns
+through the real code: the /chat route over ASGI, or the Telegram
+handlers with fake updates. Reports p50/p95/p99 turn latency, turns per
+second, MongoDB commands and agent operations per turn and Gemini calls
+and tokens per turn, and saves everything as JSON; --compare flags
+regressions against an earlier run.
+
+    python -m benchmarks.load_test --scenario api --users 20 --turns 10
+    python -m benchmarks.load_test --scenario telegram --users 50 --gemini-latency-ms 800
+    python -m benchmarks.load_test --scenario api --compare benchmarks/results/<run>.json
+    python -m benchmarks.load_test --scenario telegram --no-pipeline --out seq.json
+    python -m benchmarks.load_test --scenario telegram --compare seq.json
+
+Uses its own databases (robert_loadtest*, regardless of DB_NAME and
+MEMORY_DB_NAME) and drops them at start, so it refuses to run unless
+MONGO_URI points at this machine. The per-process Gemini rate limit and
+the Telegram debounce window are off unless set in the environment.
+"""
+import os
+
+# Before config.settings is imported
+os.environ.setdefault("GEMINI_API_KEY", "fake")
+# Assigned, not defaulted: these databases are dropped
+os.environ["DB_NAME"] = "robert_loadtest"
+os.environ["MEMORY_DB_NAME"] = "robert_loadtest_memory"
+os.environ.setdefault("GEMINI_RATE_LIMIT", "0")
+os.environ.setdefault("TELEGRAM_COALESCE_WINDOW", "0")
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import random  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from collections import Counter  # noqa: E402
+from datetime import datetime, timedelta  # noqa: E402
+from pathlib import Path  # noqa: E402
+from types import SimpleNamespace  # noqa: E402
+
+import httpx  # noqa: E402
+from pymongo import monitoring  # noqa: E402
+
+from config.settings import MONGO_URI, DB_NAME, MEMORY_DB_NAME, COLLECTION  # noqa: E402
+import database.mongodb as db  # noqa: E402
+from services import gemini_service, telegram_bot, metrics, turn_pipeline  # noqa: E402
+from services.memory_service import save_turn, flush_memory, stop_memory_writer  # noqa: E402
+from services.rollup_service import rebuild_rollups  # noqa: E402
+from benchmarks.fake_client import FakeGeminiClient  # noqa: E402
+from benchmarks.local_target import check_local_target  # noqa: E402
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+# Metrics compared by --compare: (path, higher is worse)
+COMPARED = [
+    (("latency_ms", "p50"), True),
+    (("latency_ms", "p95"), True),
+    (("latency_ms", "p99"), True),
+    (("turns_per_second",), False),
+    (("mongo", "commands_per_turn"), True),
+    (("gemini", "calls_per_turn"), True),
+    (("gemini", "prompt_tokens_per_turn"), True),
+]
+
+# ──────────────────────────── Synthetic Data ────────────────────
+
+BUSINESSES = [
+    ("Café Central", "cafeteria"), ("La Esquina", "restaurante"), ("Sushi Go", "restaurante"),
+    ("Pizzería Roma", "restaurante"), ("Mercado Fresco", "supermercado"), ("SuperAhorro", "supermercado"),
+    ("Gasolinera Sur", "transporte"), ("Taxi Ya", "transporte"), ("Cine Estrella", "ocio"),
+    ("Gimnasio Fuerte", "salud"), ("Farmacia Luz", "salud"), ("Librería Papel", "compras"),
+    ("TecnoShop", "compras"), ("Panadería Sol", "cafeteria"), ("Bar El Puerto", "ocio"),
+]
+PAYMENT_METHODS = ["tarjeta", "efectivo", "transferencia"]
+
+
+async def seed_dataset(docs: int, days: int):
+    """Llego-like purchases spread over the last `days` days"""
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    col = db.get_collection()
+    batch = []
+    for i in range(docs):
+        negocio, categoria = rng.choice(BUSINESSES)
+        when = now - timedelta(minutes=rng.randrange(days * 24 * 60))
+        batch.append({
+            "negocio": negocio,
+            "categoria": categoria,
+            "monto": round(rng.lognormvariate(2.8, 0.7), 2),
+            "fecha": when.strftime("%Y-%m-%dT%H:%M:%S"),
+            "metodo_pago": rng.choice(PAYMENT_METHODS),
+        })
+        if len(batch) == 5000:
+            await col.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await col.insert_many(batch, ordered=False)
+
+    await col.create_index([("fecha", -1)])
+    await col.create_index([("negocio", 1), ("fecha", -1)])
+    await col.create_index([("categoria", 1), ("fecha", -1)])
+    await rebuild_rollups()
+
+
+async def seed_history(sessions: list[str], turns: int):
+    """Earlier turns for every simulated user"""
+    start = datetime.utcnow() - timedelta(days=1)
+
+    async def one(session_id: str):
+        for t in range(turns):
+            await save_turn(
+                session_id,
+                f"Mensaje previo {t}: ¿qué opinas de mis gastos?",
+                f"Respuesta previa {t}: revisa tus cafés, hermano.",
+                user_at=start + timedelta(minutes=t),
+            )
+
+    await asyncio.gather(*(one(s) for s in sessions))
+    await flush_memory()
+
+
+def build_scripts() -> dict[str, list[dict]]:
+    """Question → agent steps the fake model answers with"""
+    this_month = datetime.utcnow().strftime("%Y-%m")
+    last_month = (datetime.utcnow().replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+
+    def final(reply: str) -> dict:
+        return {"reply": reply, "is_final": True}
+
+    def step(reply: str, **fields) -> dict:
+        return {"reply": reply, "is_final": False, **fields}
+
+    return {
+        "Hola Robert, ¿cómo va todo?": [
+            final("Todo en orden. ¿Qué avanzaste hoy en tu proyecto?"),
+        ],
+        "¿Cuánto gasté este mes?": [
+            step("Reviso el total del mes.", operation={
+                "action": "rollup", "filter": {"rollup": "mes", "mes": this_month},
+            }),
+            final("Este mes llevas un buen gasto. ¿Qué recortas mañana?"),
+        ],
+        "Compara mis gastos de este mes con los del mes pasado": [
+            step("Traigo ambos meses.", operations=[
+                {"action": "rollup", "filter": {"rollup": "mes", "mes": this_month}},
+                {"action": "rollup", "filter": {"rollup": "mes", "mes": last_month}},
+            ]),
+            final("Vas por encima del mes pasado. ¿Dónde está la fuga?"),
+        ],
+        "¿Cuáles son los 5 negocios donde más gasto?": [
+            step("Agrupo por negocio.", operation={
+                "action": "aggregate",
+                "pipeline": [
+                    {"$group": {"_id": "$negocio", "total": {"$sum": "$monto"}}},
+                    {"$sort": {"total": -1}},
+                    {"$limit": 5},
+                ],
+            }),
+            final("Tu top 5 está dominado por restaurantes. ¿Cocinas esta semana?"),
+        ],
+        "¿Cuáles fueron mis últimas compras en restaurantes?": [
+            step("Busco tus compras en restaurantes.", operation={
+                "action": "find",
+                "filter": {"categoria": "restaurante", "fecha": {"$gte": f"{last_month}-01"}},
+                "projection": ["negocio", "monto", "fecha"],
+            }),
+            final("Comes fuera demasiado. ¿Cuántas veces vas a cocinar mañana?"),
+        ],
+        "¿Cuántas veces fui al supermercado este mes?": [
+            step("Cuento tus visitas.", operation={
+                "action": "count",
+                "filter": {"categoria": "supermercado", "fecha": {"$gte": f"{this_month}-01"}},
+            }),
+            final("Vas seguido al súper; compra por semana, no por día."),
+        ],
+    }
+
+
+# ──────────────────────────── Instrumentation ───────────────────
+
+
+class CommandCounter(monitoring.CommandListener):
+    """MongoDB commands sent by the app (registered before init_db)"""
+
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def _stage_count(name: str) -> int:
+    return sum(
+        series[-1] for key, series in metrics.stage_seconds._series.items() if key[0] == name
+    )
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+# ──────────────────────────── Drivers ───────────────────────────
+
+
+async def api_turn(client: httpx.AsyncClient, session_id: str, question: str) -> bool:
+    r = await client.post("/chat", data={"message": question, "session_id": session_id})
+    return r.status_code == 200
+
+
+class FakeTelegramMessage:
+    """Just the parts of telegram.Message the handlers use"""
+
+    def __init__(self, user_id: int, text: str | None, latency: float, sent: list):
+        self.text = text
+        self.caption = None
+        self.photo = []
+        self._latency = latency
+        self._sent = sent
+        self.chat = SimpleNamespace(send_action=self._send_action)
+
+    async def _send_action(self, action, **kwargs):
+        await asyncio.sleep(self._latency)
+
+    async def reply_text(self, text, **kwargs):
+        await asyncio.sleep(self._latency)
+        self._sent.append(text)
+        return FakeTelegramMessage(0, text, self._latency, self._sent)
+
+    async def edit_text(self, text, **kwargs):
+        await asyncio.sleep(self._latency)
+        self._sent.append(text)
+        return self
+
+
+class FakeApplication:
+    def create_task(self, coro, update=None):
+        return asyncio.get_running_loop().create_task(coro)
+
+
+async def telegram_turn(user_id: int, question: str, latency: float) -> bool:
+    """handle_message → per-user dispatcher → reply, as a Telegram update would"""
+    sent = []
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        message=FakeTelegramMessage(user_id, question, latency, sent),
+    )
+    context = SimpleNamespace(application=FakeApplication())
+    await telegram_bot.handle_message(update, context)
+    drainer = telegram_bot._drainers.get(str(user_id))
+    if drainer is not None:
+        await drainer
+    return bool(sent) and not any(text.startswith("Algo salió mal") for text in sent)
+
+
+# ──────────────────────────── Run ───────────────────────────────
+
+
+DB_PREFIX = "robert_loadtest"
+
+
+def _check_target():
+    """Refuse to drop anything but local robert_loadtest* databases"""
+    check_local_target([DB_NAME, MEMORY_DB_NAME], DB_PREFIX, tag="[LOAD]")
+
+
+async def run(args) -> dict:
+    _check_target()
+    counter = CommandCounter()
+    monitoring.register(counter)
+    await db.init_db()
+    for name in (DB_NAME, MEMORY_DB_NAME):
+        await db.db_client.drop_database(name)
+    # Drop removed the indexes init_db created
+    from services.memory_service import ensure_memory_indexes
+    from services.rollup_service import ensure_rollup_indexes
+    await ensure_memory_indexes()
+    await ensure_rollup_indexes()
+
+    scripts = build_scripts()
+    fake = FakeGeminiClient(
+        scripts=scripts,
+        latency_ms=args.gemini_latency_ms,
+        jitter=args.gemini_jitter,
+        ms_per_output_token=args.ms_per_output_token,
+        chars_per_token=args.chars_per_token,
+    )
+    gemini_service.gemini_client = fake
+    # Sequential baseline for the per-turn pipeline
+    turn_pipeline.TURN_PIPELINE = not args.no_pipeline
+
+    print(f"[LOAD] Sembrando {args.docs} documentos en {DB_NAME}.{COLLECTION}...")
+    await seed_dataset(args.docs, args.days)
+    user_ids = [100000 + i for i in range(args.users)]
+    sessions = [str(u) for u in user_ids]
+    print(f"[LOAD] Sembrando {args.history} turnos de historial para {args.users} usuarios...")
+    await seed_history(sessions, args.history)
+
+    from services.schema_digest import refresh_digest
+    await refresh_digest()
+
+    questions = list(scripts)
+    latencies: list[float] = []
+    errors = 0
+
+    transport = httpx.ASGITransport(app=_app())
+    client = httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=120)
+
+    async def user(index: int):
+        nonlocal errors
+        rng = random.Random(index)
+        for _ in range(args.turns):
+            question = rng.choice(questions)
+            started = time.perf_counter()
+            try:
+                if args.scenario == "api":
+                    ok = await api_turn(client, sessions[index], question)
+                else:
+                    ok = await telegram_turn(user_ids[index], question, args.telegram_latency_ms / 1000)
+            except Exception as e:
+                print(f"[LOAD ERROR] {e}")
+                ok = False
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += not ok
+            if args.think_ms:
+                await asyncio.sleep(rng.uniform(0, 2 * args.think_ms) / 1000)
+
+    # Only count what the measured turns do
+    counter.commands.clear()
+    calls_before = dict(fake.stats)
+    ops_before = _stage_count("mongo")
+
+    print(f"[LOAD] {args.scenario}: {args.users} usuarios x {args.turns} turnos...")
+    started = time.perf_counter()
+    await asyncio.gather(*(user(i) for i in range(args.users)))
+    wall = time.perf_counter() - started
+    await client.aclose()
+
+    turns = len(latencies)
+    commands = sum(counter.commands.values())
+    gemini_delta = {k: fake.stats[k] - calls_before[k] for k in fake.stats}
+    result = {
+        "scenario": args.scenario,
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "config": {
+            k: v for k, v in vars(args).items() if k not in ("compare", "out")
+        },
+        "turns": turns,
+        "errors": errors,
+        "seconds": round(wall, 2),
+        "turns_per_second": round(turns / wall, 2) if wall else 0.0,
+        "latency_ms": {
+            "p50": round(_percentile(latencies, 0.50), 1),
+            "p95": round(_percentile(latencies, 0.95), 1),
+            "p99": round(_percentile(latencies, 0.99), 1),
+            "mean": round(sum(latencies) / turns, 1) if turns else 0.0,
+            "max": round(max(latencies), 1) if latencies else 0.0,
+        },
+        "mongo": {
+            "commands_per_turn": round(commands / turns, 2) if turns else 0.0,
+            "agent_ops_per_turn": round((_stage_count("mongo") - ops_before) / turns, 2) if turns else 0.0,
+            "by_command": dict(counter.commands.most_common()),
+        },
+        "gemini": {
+            "calls_per_turn": round(gemini_delta["calls"] / turns, 2) if turns else 0.0,
+            "prompt_tokens_per_turn": round(gemini_delta["prompt_tokens"] / turns, 1) if turns else 0.0,
+            "output_tokens_per_turn": round(gemini_delta["output_tokens"] / turns, 1) if turns else 0.0,
+            **gemini_delta,
+        },
+    }
+
+    await stop_memory_writer()
+    if not args.keep:
+        for name in (DB_NAME, MEMORY_DB_NAME):
+            await db.db_client.drop_database(name)
+    db.close_db()
+    return result
+
+
+def _app():
+    from main import app
+    return app
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+# ──────────────────────────── Report ────────────────────────────
+
+
+def _get(result: dict, path: tuple):
+    for key in path:
+        result = result.get(key, {}) if isinstance(result, dict) else {}
+    return result if isinstance(result, (int, float)) else None
+
+
+def report(result: dict):
+    lat = result["latency_ms"]
+    print(
+        f"\n{result['scenario']}: {result['turns']} turnos en {result['seconds']}s "
+        f"({result['turns_per_second']} turnos/s), errores: {result['errors']}"
+    )
+    print(f"latencia ms  p50={lat['p50']}  p95={lat['p95']}  p99={lat['p99']}  max={lat['max']}")
+    print(
+        f"mongo/turno  comandos={result['mongo']['commands_per_turn']}  "
+        f"operaciones del agente={result['mongo']['agent_ops_per_turn']}"
+    )
+    print(
+        f"gemini/turno llamadas={result['gemini']['calls_per_turn']}  "
+        f"tokens prompt={result['gemini']['prompt_tokens_per_turn']}  "
+        f"salida={result['gemini']['output_tokens_per_turn']}"
+    )
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> bool:
+    """Print deltas against a previous run; True if nothing regressed"""
+    print(f"\nvs {baseline.get('commit') or '?'} ({baseline.get('started_at')}):")
+    ok = True
+    for path, higher_is_worse in COMPARED:
+        new, old = _get(result, path), _get(baseline, path)
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        worse = change > tolerance if higher_is_worse else change < -tolerance
+        ok &= not worse
+        flag = "  REGRESIÓN" if worse else ""
+        print(f"  {'.'.join(path):<30} {old:>10} → {new:<10} ({change:+.1%}){flag}")
+    new, old = _get(result, ("latency_ms", "mean")), _get(baseline, ("latency_ms", "mean"))
+    if new is not None and old is not None:
+        print(f"  tiempo ahorrado por turno (media): {old - new:+.1f} ms")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scenario", choices=["api", "telegram"], default="api")
+    parser.add_argument("--users", type=int, default=20, help="Concurrent simulated users")
+    parser.add_argument("--turns", type=int, default=10, help="Turns per user")
+    parser.add_argument("--think-ms", type=float, default=0, help="Mean pause between a user's turns")
+    parser.add_argument("--docs", type=int, default=50_000, help="Synthetic Llego documents")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--history", type=int, default=10, help="Seeded turns per user")
+    parser.add_argument("--gemini-latency-ms", type=float, default=300)
+    parser.add_argument("--gemini-jitter", type=float, default=0.2)
+    parser.add_argument("--ms-per-output-token", type=float, default=0.0)
+    parser.add_argument("--chars-per-token", type=float, default=4.0)
+    parser.add_argument("--telegram-latency-ms", type=float, default=50, help="Fake Bot API call latency")
+    parser.add_argument("--no-pipeline", action="store_true", help="Run turn steps sequentially (TURN_PIPELINE=false)")
+    parser.add_argument("--out", help="Result JSON path (default benchmarks/results/<scenario>-<time>.json)")
+    parser.add_argument("--compare", help="Earlier result JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression")
+    parser.add_argument("--keep", action="store_true", help="Keep the load-test databases")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    report(result)
+
+    out = Path(args.out) if args.out else RESULTS_DIR / (
+        f"{args.scenario}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, indent=2, ensure_ascii=False))
+    print(f"\nResultados guardados en {out}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if not compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
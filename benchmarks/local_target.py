@@ -0,0 +1,30 @@
+"""
+Guard for benchmarks that seed and drop MongoDB databases
+
+They connect with MONGO_URI from .env, which usually points at the real
+cluster: check_local_target stops them unless it is a mongod on this
+machine and every database they drop carries the benchmark prefix.
+"""
+from pymongo import uri_parser
+
+from config.settings import MONGO_URI
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+def check_local_target(names: list[str], prefix: str, tag: str = "[BENCH]", uri: str = MONGO_URI):
+    """Exit unless `uri` is local and every name in `names` starts with `prefix`"""
+    if uri.startswith("mongodb+srv://"):
+        raise SystemExit(f"{tag} MONGO_URI es un clúster (mongodb+srv); solo se corre contra un mongod local")
+    try:
+        hosts = {host for host, _port in uri_parser.parse_uri(uri)["nodelist"]}
+    except Exception as e:
+        raise SystemExit(f"{tag} MONGO_URI no válido: {e}")
+    if not hosts or not hosts <= LOCAL_HOSTS:
+        raise SystemExit(
+            f"{tag} MONGO_URI apunta a {', '.join(sorted(hosts))}: el benchmark "
+            "borra sus bases de datos y solo corre contra un mongod local"
+        )
+    for name in names:
+        if not name.startswith(prefix):
+            raise SystemExit(f"{tag} Base de datos {name!r} no empieza por {prefix!r}; no se borra")
@@ -0,0 +1,151 @@
+"""
+Benchmark: chat history layouts, one document per message vs per session
+
+Seeds the same conversations on a local mongod in both layouts
+memory_service supports and times what the app does on every turn:
+reading the latest messages and saving a user + assistant turn. Also
+prints documents, data size and index size per layout.
+
+    python -m benchmarks.memory_layout --sessions 2000 --messages 300
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+
+from config.settings import MONGO_URI, MEMORY_SESSION_MAX_MESSAGES
+from services.memory_service import archive_requests, session_push
+from benchmarks.local_target import check_local_target
+
+READ_LIMIT = 20
+# --db is dropped before and after the run
+DB_PREFIX = "robert_bench"
+
+
+def _message(i: int, timestamp: datetime) -> dict:
+    text = f"mensaje de prueba {i} " + "x" * random.randrange(20, 200)
+    return {
+        "role": "user" if i % 2 == 0 else "assistant",
+        "message": text,
+        "timestamp": timestamp,
+        "tokens": (len(text) + 3) // 4,
+    }
+
+
+def seed(db, sessions: int, per_session: int, cap: int):
+    """Same conversations in both layouts"""
+    chats, docs, archive = db["chats"], db["chats_sessions"], db["chats_archive"]
+    chats.create_index([("sessionID", 1), ("timestamp", -1)], name="session_timestamp")
+    archive.create_index([("sessionID", 1), ("bucket", -1)], name="session_bucket", unique=True)
+
+    base = datetime(2024, 1, 1)
+    for s in range(sessions):
+        session_id = f"bench_{s}"
+        messages = [
+            _message(i, base + timedelta(minutes=37 * i + s)) for i in range(per_session)
+        ]
+        chats.insert_many([{"sessionID": session_id, **m} for m in messages], ordered=False)
+        docs.insert_one({
+            "_id": session_id,
+            "messages": messages[-cap:],
+            "total": len(messages),
+            "updated_at": messages[-1]["timestamp"],
+        })
+        older = messages[:-cap]
+        if older:
+            archive.bulk_write(archive_requests(session_id, older), ordered=False)
+
+
+def _percentiles(samples: list[float]) -> tuple[float, float]:
+    samples = sorted(samples)
+    return statistics.median(samples), samples[max(0, int(len(samples) * 0.95) - 1)]
+
+
+def time_reads(db, layout: str, sessions: int, rounds: int) -> list[float]:
+    samples = []
+    for _ in range(rounds):
+        session_id = f"bench_{random.randrange(sessions)}"
+        started = time.perf_counter()
+        if layout == "messages":
+            docs = list(
+                db["chats"].find(
+                    {"sessionID": session_id},
+                    {"_id": 0, "role": 1, "message": 1, "timestamp": 1, "tokens": 1},
+                ).sort("timestamp", -1).limit(READ_LIMIT)
+            )
+            docs.reverse()
+        else:
+            db["chats_sessions"].find_one(
+                {"_id": session_id}, {"_id": 0, "messages": {"$slice": -READ_LIMIT}, "total": 1}
+            )
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def time_writes(db, layout: str, sessions: int, rounds: int, cap: int) -> list[float]:
+    samples = []
+    for i in range(rounds):
+        session_id = f"bench_{random.randrange(sessions)}"
+        now = datetime.utcnow()
+        turn = [_message(2 * i, now), _message(2 * i + 1, now + timedelta(milliseconds=1))]
+        started = time.perf_counter()
+        if layout == "messages":
+            db["chats"].insert_many([{"sessionID": session_id, **m} for m in turn], ordered=True)
+        else:
+            update, projection = session_push(turn, cap)
+            before = db["chats_sessions"].find_one_and_update(
+                {"_id": session_id}, update, projection=projection, upsert=True
+            )
+            if before and before["dropped"]:
+                db["chats_archive"].bulk_write(
+                    archive_requests(session_id, before["dropped"]), ordered=False
+                )
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def sizes(db, names: list[str]) -> tuple[int, int, int]:
+    docs, data, index = 0, 0, 0
+    for name in names:
+        stats = db.command("collStats", name)
+        docs += stats.get("count", 0)
+        data += stats.get("size", 0)
+        index += stats.get("totalIndexSize", 0)
+    return docs, data, index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=300, help="Messages per session")
+    parser.add_argument("--cap", type=int, default=MEMORY_SESSION_MAX_MESSAGES)
+    parser.add_argument("--rounds", type=int, default=500)
+    parser.add_argument("--db", default=DB_PREFIX, help=f"Dropped; must start with {DB_PREFIX}")
+    args = parser.parse_args()
+    check_local_target([args.db], DB_PREFIX)
+
+    client = MongoClient(MONGO_URI)
+    client.drop_database(args.db)
+    db = client[args.db]
+
+    print(f"Seeding {args.sessions} sessions x {args.messages} messages (cap {args.cap})...")
+    seed(db, args.sessions, args.messages, args.cap)
+
+    print(f"{'layout':<10}{'read p50':>10}{'read p95':>10}{'turn p50':>10}{'turn p95':>10}"
+          f"{'docs':>10}{'data MB':>10}{'index MB':>10}")
+    layouts = {"messages": ["chats"], "session": ["chats_sessions", "chats_archive"]}
+    for layout, collections in layouts.items():
+        read = _percentiles(time_reads(db, layout, args.sessions, args.rounds))
+        write = _percentiles(time_writes(db, layout, args.sessions, args.rounds, args.cap))
+        docs, data, index = sizes(db, collections)
+        print(f"{layout:<10}{read[0]:>10.2f}{read[1]:>10.2f}{write[0]:>10.2f}{write[1]:>10.2f}"
+              f"{docs:>10}{data / 2**20:>10.1f}{index / 2**20:>10.1f}")
+
+    client.drop_database(args.db)
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
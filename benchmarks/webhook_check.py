@@ -0,0 +1,107 @@
+"""
+Offline check for the Telegram webhook route
+
+Drives POST /telegram/webhook/<secret> through FastAPI's TestClient with a
+stubbed bot Application (no server, bot token, MongoDB or network; no
+replies are sent) and checks the status codes: valid updates are queued,
+a wrong path secret is 404, a missing or wrong secret header is 403 and
+malformed JSON or a non-Update body is 400. Exits non-zero on failure.
+
+    python -m benchmarks.webhook_check
+"""
+import os
+import sys
+import time
+
+SECRET = "webhook-check-secret"
+
+# Before config.settings is imported
+os.environ["TELEGRAM_MODE"] = "webhook"
+os.environ["TELEGRAM_WEBHOOK_SECRET"] = SECRET
+os.environ.setdefault("GEMINI_API_KEY", "fake")
+
+from types import SimpleNamespace  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import services.telegram_bot as telegram_bot  # noqa: E402
+from main import app  # noqa: E402
+
+ENDPOINT = f"{telegram_bot.WEBHOOK_PATH}/{SECRET}"
+HEADERS = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+
+class StubQueue:
+    """Stands in for Application.update_queue; keeps what was put"""
+
+    def __init__(self):
+        self.updates = []
+
+    async def put(self, update):
+        self.updates.append(update)
+
+
+def sample_updates(chat_id: int = 123456789) -> list[dict]:
+    """Minimal but valid Update payloads, as Telegram would send them"""
+    user = {"id": chat_id, "is_bot": False, "first_name": "Bench"}
+    chat = {"id": chat_id, "type": "private", "first_name": "Bench"}
+    now = int(time.time())
+
+    def message(update_id: int, **fields) -> dict:
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": now,
+                "chat": chat,
+                "from": user,
+                **fields,
+            },
+        }
+
+    return [
+        message(1, text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}]),
+        message(2, text="Hola Robert, ¿cómo va todo?"),
+        message(3, text="¿Cuánto gasté este mes?"),
+    ]
+
+
+def main():
+    queue = StubQueue()
+    # No lifespan (TestClient outside a with block): nothing connects
+    telegram_bot.bot_app = SimpleNamespace(bot=None, update_queue=queue)
+    client = TestClient(app)
+    update = sample_updates()[0]
+    cases = [
+        ("valid update", lambda: client.post(ENDPOINT, json=update, headers=HEADERS), 200),
+        ("wrong path secret", lambda: client.post(f"{telegram_bot.WEBHOOK_PATH}/nope", json=update, headers=HEADERS), 404),
+        ("missing secret header", lambda: client.post(ENDPOINT, json=update), 403),
+        ("wrong secret header", lambda: client.post(
+            ENDPOINT, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "nope"}
+        ), 403),
+        ("malformed JSON", lambda: client.post(
+            ENDPOINT, content=b'{"update_id": 1,', headers={**HEADERS, "Content-Type": "application/json"}
+        ), 400),
+        ("JSON that is not an Update", lambda: client.post(ENDPOINT, json=[1, 2], headers=HEADERS), 400),
+        ("Update without update_id", lambda: client.post(ENDPOINT, json={"message": {}}, headers=HEADERS), 400),
+    ]
+
+    failures = 0
+    for name, send, expected in cases:
+        status = send().status_code
+        ok = status == expected
+        failures += not ok
+        print(f"{'ok ' if ok else 'FAIL'} {name:<28} {status} (expected {expected})")
+
+    for payload in sample_updates()[1:]:
+        client.post(ENDPOINT, json=payload, headers=HEADERS)
+    queued = [u.update_id for u in queue.updates]
+    ok = queued == [1, 2, 3]
+    failures += not ok
+    print(f"{'ok ' if ok else 'FAIL'} {'queued updates':<28} {queued} (expected [1, 2, 3])")
+
+    telegram_bot.bot_app = None
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,156 @@
 """
 Robert Bot — Entry point
-Runs Telegram bot + FastAPI server in one process.
+Runs Telegram bot + FastAPI server in one process (DEPLOY_MODE=single), or
+a pool of uvicorn workers plus this process as the Telegram dispatcher
+(DEPLOY_MODE=workers).
 """
-import os
 import asyncio
+import os
+import secrets
+import subprocess
+import sys
+import time
+import httpx
 import uvicorn
+from config.settings import (
+    TELEGRAM_MODE,
+    TELEGRAM_POLLING_START_DELAY,
+    WORKERS_MODE,
+    PORT,
+    API_WORKERS,
+    DISPATCH_URL,
+    DISPATCH_SECRET,
+)
 from database.mongodb import init_db, close_db
 from services.gemini_service import init_gemini
-from services.telegram_bot import create_bot_application
+from services.telegram_bot import (
+    create_bot_application,
+    start_webhook_bot,
+    stop_bot,
+    start_dispatcher,
+    stop_dispatcher,
+)
+from services.memory_service import stop_memory_writer
 from main import app
 
+# How long the dispatcher waits for the API workers to answer /health
+API_STARTUP_TIMEOUT = 60
+
+
+async def _start_polling():
+    bot_app = create_bot_application()
+    await bot_app.initialize()
+    # Clear previous connections and wait for old instance to die
+    await bot_app.bot.delete_webhook(drop_pending_updates=True)
+    if TELEGRAM_POLLING_START_DELAY > 0:
+        await asyncio.sleep(TELEGRAM_POLLING_START_DELAY)
+    await bot_app.start()
+    await bot_app.updater.start_polling(drop_pending_updates=True)
+    return bot_app
+
 
 async def start():
     print("Inicializando Robert Bot...")
 
     # Initialize database and Gemini
-    init_db()
+    await init_db()
     init_gemini()
 
     print("Conexiones inicializadas")
 
     # --- Telegram Bot ---
-    bot_app = create_bot_application()
-    await bot_app.initialize()
-    # Clear previous connections and wait for old instance to die
-    await bot_app.bot.delete_webhook(drop_pending_updates=True)
-    await asyncio.sleep(5)
-    await bot_app.start()
-    await bot_app.updater.start_polling(drop_pending_updates=True)
-    print("Robert Bot corriendo en Telegram...")
+    if TELEGRAM_MODE == "webhook":
+        # Updates arrive on the FastAPI webhook route served below
+        bot_app = await start_webhook_bot()
+        print("Robert Bot recibiendo updates por webhook...")
+    else:
+        bot_app = await _start_polling()
+        print("Robert Bot corriendo en Telegram...")
 
     # --- FastAPI server ---
-    port = int(os.getenv("PORT", "8000"))
-    config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info")
+    config = uvicorn.Config(app, host="0.0.0.0", port=PORT, log_level="info")
     server = uvicorn.Server(config)
-    print(f"Servidor web en puerto {port}")
+    print(f"Servidor web en puerto {PORT}")
 
     try:
         await server.serve()
     finally:
-        await bot_app.updater.stop()
-        await bot_app.stop()
-        await bot_app.shutdown()
+        await stop_bot(bot_app)
+        # After the bot: its last turns may still have queued messages
+        await stop_memory_writer()
         close_db()
         print("Robert Bot detenido")
 
 
+# ──────────────────────────── Workers Mode ──────────────────────
+
+
+def _start_api_workers(secret: str) -> subprocess.Popen:
+    """
+    uvicorn with API_WORKERS processes for main:app. Workers are separate
+    interpreters; each creates its Motor and Gemini clients in the lifespan.
+    """
+    cmd = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "0.0.0.0",
+        "--port", str(PORT),
+        "--workers", str(API_WORKERS),
+    ]
+    env = {**os.environ, "DISPATCH_SECRET": secret}
+    return subprocess.Popen(cmd, env=env)
+
+
+async def _wait_for_api(api: subprocess.Popen):
+    deadline = time.monotonic() + API_STARTUP_TIMEOUT
+    async with httpx.AsyncClient(base_url=DISPATCH_URL, timeout=2) as client:
+        while time.monotonic() < deadline:
+            if api.poll() is not None:
+                raise RuntimeError(f"uvicorn terminó al arrancar (código {api.returncode})")
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"Los workers no respondieron en {DISPATCH_URL} tras {API_STARTUP_TIMEOUT}s")
+
+
+async def start_workers():
+    """
+    Run the API in API_WORKERS processes and use this process only to poll
+    Telegram: the per-user dispatcher forwards each turn to the workers
+    """
+    print(f"Inicializando Robert Bot (workers: {API_WORKERS})...")
+    if TELEGRAM_MODE == "webhook":
+        raise ValueError("DEPLOY_MODE=workers recibe los updates por polling: usa TELEGRAM_MODE=polling")
+
+    # Shared with the workers only; generated if not configured
+    secret = DISPATCH_SECRET or secrets.token_urlsafe(32)
+    api = _start_api_workers(secret)
+    bot_app = None
+
+    try:
+        await _wait_for_api(api)
+        print(f"Servidor web en puerto {PORT} con {API_WORKERS} workers")
+
+        start_dispatcher(secret)
+        bot_app = await _start_polling()
+        print("Robert Bot corriendo en Telegram (dispatcher)...")
+
+        # Until the worker pool exits or the process is interrupted
+        while api.poll() is None:
+            await asyncio.sleep(1)
+    finally:
+        if bot_app is not None:
+            # Waits for the turns already handed to the workers
+            await stop_bot(bot_app)
+        await stop_dispatcher()
+        if api.poll() is None:
+            # Graceful: each worker's lifespan flushes and closes its clients
+            api.terminate()
+            await asyncio.to_thread(api.wait)
+        print("Robert Bot detenido")
+
+
 if __name__ == "__main__":
-    asyncio.run(start())
+    asyncio.run(start_workers() if WORKERS_MODE else start())
@@ -9,17 +9,182 @@ load_dotenv()
 
 # ──────────────────────────── Config ────────────────────────────
 
+# Deployment: "single" — bot_main runs the Telegram bot and one uvicorn
+# server in one process; "workers" — bot_main starts uvicorn with
+# API_WORKERS processes and only polls Telegram, forwarding each turn to
+# the workers (see Deployment below)
+DEPLOY_MODE = os.getenv("DEPLOY_MODE", "single").lower()
+WORKERS_MODE = DEPLOY_MODE == "workers"
+# Per-process state is only safe by default with one process
+_SINGLE_PROCESS_DEFAULT = "false" if WORKERS_MODE else "true"
+
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "mydb")
 COLLECTION = os.getenv("COLLECTION", "items")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
+# Read-result cache for LLM-generated queries (invalidated on writes; off by
+# default in workers mode, where another worker's writes can't invalidate it)
+MONGO_RESULT_CACHE = os.getenv("MONGO_RESULT_CACHE", _SINGLE_PROCESS_DEFAULT).lower() == "true"
+MONGO_RESULT_CACHE_TTL = int(os.getenv("MONGO_RESULT_CACHE_TTL", "120"))
+MONGO_RESULT_CACHE_MAX_ENTRIES = int(os.getenv("MONGO_RESULT_CACHE_MAX_ENTRIES", "256"))
+
+# Query guard: time budget for every operation, what to do with COLLSCANs
+# over QUERY_GUARD_COLLSCAN_MAX_DOCS documents ("off", "report", "rewrite"
+# = run reads under QUERY_GUARD_SCAN_MAX_TIME_MS and refuse writes,
+# "reject"), and how long explain plans are cached per query shape (s)
+MONGO_MAX_TIME_MS = int(os.getenv("MONGO_MAX_TIME_MS", "5000"))
+QUERY_GUARD_MODE = os.getenv("QUERY_GUARD_MODE", "rewrite").lower()
+QUERY_GUARD_COLLSCAN_MAX_DOCS = int(os.getenv("QUERY_GUARD_COLLSCAN_MAX_DOCS", "20000"))
+QUERY_GUARD_SCAN_MAX_TIME_MS = int(os.getenv("QUERY_GUARD_SCAN_MAX_TIME_MS", "1000"))
+QUERY_GUARD_PLAN_TTL = int(os.getenv("QUERY_GUARD_PLAN_TTL", "600"))
+
+# Read pushdown: max documents a find/aggregate returns (enforced on the
+# server with limit/$limit) and allowDiskUse for pipelines that group/sort
+MONGO_RESULT_LIMIT = int(os.getenv("MONGO_RESULT_LIMIT", "100"))
+MONGO_AGG_ALLOW_DISK_USE = os.getenv("MONGO_AGG_ALLOW_DISK_USE", "true").lower() == "true"
+
+# Materialized spending rollups (per month, business/month, category/month)
+# kept in ROLLUP_COLLECTION; field names of the data documents they read,
+# and the most documents one update/delete may touch and still be
+# tracked incrementally (beyond that, run tools.rebuild_rollups)
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "true").lower() == "true"
+ROLLUP_COLLECTION = os.getenv("ROLLUP_COLLECTION", f"{COLLECTION}_rollups")
+ROLLUP_BUSINESS_FIELD = os.getenv("ROLLUP_BUSINESS_FIELD", "negocio")
+ROLLUP_CATEGORY_FIELD = os.getenv("ROLLUP_CATEGORY_FIELD", "categoria")
+ROLLUP_AMOUNT_FIELD = os.getenv("ROLLUP_AMOUNT_FIELD", "monto")
+ROLLUP_DATE_FIELD = os.getenv("ROLLUP_DATE_FIELD", "fecha")
+ROLLUP_MAX_TRACKED = int(os.getenv("ROLLUP_MAX_TRACKED", "5000"))
+
+# Schema digest of COLLECTION appended to the system context: documents
+# sampled per refresh, refresh interval (s) and max fields listed
+SCHEMA_DIGEST = os.getenv("SCHEMA_DIGEST", "true").lower() == "true"
+SCHEMA_DIGEST_SAMPLE_SIZE = int(os.getenv("SCHEMA_DIGEST_SAMPLE_SIZE", "200"))
+SCHEMA_DIGEST_REFRESH = int(os.getenv("SCHEMA_DIGEST_REFRESH", "600"))
+SCHEMA_DIGEST_MAX_FIELDS = int(os.getenv("SCHEMA_DIGEST_MAX_FIELDS", "40"))
+
+# Gemini context cache (system prompt served from a server-side cache)
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "true").lower() == "true"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+GEMINI_CONTEXT_CACHE_REFRESH_MARGIN = int(os.getenv("GEMINI_CONTEXT_CACHE_REFRESH_MARGIN", "300"))
+GEMINI_CONTEXT_CACHE_RETRY_AFTER = int(os.getenv("GEMINI_CONTEXT_CACHE_RETRY_AFTER", "600"))
+
+# Fast-path router: "off", "heuristic" (local rules only), "model" or
+# "hybrid" (rules first, small model for ambiguous messages)
+ROUTER_MODE = os.getenv("ROUTER_MODE", "hybrid").lower()
+ROUTER_MODEL = os.getenv("ROUTER_MODEL", "gemini-2.5-flash-lite")
+# The classifier sits in front of every ambiguous turn: per-attempt timeout
+# (s) and retries before falling back to the agent loop
+ROUTER_TIMEOUT = float(os.getenv("ROUTER_TIMEOUT", "3"))
+ROUTER_MAX_RETRIES = int(os.getenv("ROUTER_MAX_RETRIES", "1"))
+
+# Gemini admission control: concurrent calls, requests/s (0 = no rate
+# limit), burst size and the longest a call may wait for a slot (s)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_RATE_LIMIT = float(os.getenv("GEMINI_RATE_LIMIT", "5"))
+GEMINI_RATE_BURST = int(os.getenv("GEMINI_RATE_BURST", "10"))
+GEMINI_QUEUE_DEADLINE = float(os.getenv("GEMINI_QUEUE_DEADLINE", "20"))
+
+# Gemini call policy: per-attempt timeout (s), retries with exponential
+# backoff + jitter on 429/5xx/timeouts, a hedged second request after the
+# observed p95 latency, and a circuit breaker (0 failures = disabled)
+GEMINI_CALL_TIMEOUT = float(os.getenv("GEMINI_CALL_TIMEOUT", "30"))
+# Longest gap between two chunks of an open stream before it is abandoned
+GEMINI_STREAM_IDLE_TIMEOUT = float(os.getenv("GEMINI_STREAM_IDLE_TIMEOUT", str(GEMINI_CALL_TIMEOUT)))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5"))
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "8"))
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "false").lower() == "true"
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+# Image preprocessing: longest side (px), JPEG quality, byte cap, how many
+# processed images/uploads to remember, and resize threads. With
+# GEMINI_FILE_UPLOADS images go through the Files API once and are reused
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(1024 * 1024)))
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "128"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+GEMINI_FILE_UPLOADS = os.getenv("GEMINI_FILE_UPLOADS", "false").lower() == "true"
+
+# Alternative Gemini endpoint (e.g. benchmarks.fake_gemini); empty = Google
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")
+
 # Memory database config
 MEMORY_DB_NAME = os.getenv("MEMORY_DB_NAME", "robert_memory")
 MEMORY_COLLECTION = os.getenv("MEMORY_COLLECTION", "chats")
 
+# Chat storage layout: "messages" (one document per message, MEMORY_COLLECTION)
+# or "session" (one capped document per session + time-bucketed archive).
+# Switch with tools.migrate_sessions.
+MEMORY_LAYOUT = os.getenv("MEMORY_LAYOUT", "messages").lower()
+MEMORY_SESSION_COLLECTION = os.getenv("MEMORY_SESSION_COLLECTION", f"{MEMORY_COLLECTION}_sessions")
+MEMORY_ARCHIVE_COLLECTION = os.getenv("MEMORY_ARCHIVE_COLLECTION", f"{MEMORY_COLLECTION}_archive")
+MEMORY_SESSION_MAX_MESSAGES = int(os.getenv("MEMORY_SESSION_MAX_MESSAGES", "100"))
+MEMORY_ARCHIVE_BUCKET_HOURS = int(os.getenv("MEMORY_ARCHIVE_BUCKET_HOURS", "24"))
+
+# Write-behind for chat messages: saves are queued and flushed in batches
+# every MEMORY_FLUSH_INTERVAL seconds or once MEMORY_FLUSH_BATCH are queued;
+# callers wait for a flush only past MEMORY_MAX_PENDING queued messages, and
+# get an error if it can't make room (MongoDB down)
+# (off by default in workers mode: the next turn may run in another process)
+MEMORY_WRITE_BEHIND = os.getenv("MEMORY_WRITE_BEHIND", _SINGLE_PROCESS_DEFAULT).lower() == "true"
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "0.25"))
+MEMORY_FLUSH_BATCH = int(os.getenv("MEMORY_FLUSH_BATCH", "500"))
+MEMORY_MAX_PENDING = int(os.getenv("MEMORY_MAX_PENDING", "20000"))
+
+# In-process history cache (recent turns per session, write-through; off by
+# default in workers mode, where another worker may write the session)
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", _SINGLE_PROCESS_DEFAULT).lower() == "true"
+HISTORY_CACHE_MAX_SESSIONS = int(os.getenv("HISTORY_CACHE_MAX_SESSIONS", "1000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+HISTORY_CACHE_MAX_MESSAGES = int(os.getenv("HISTORY_CACHE_MAX_MESSAGES", "50"))
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "900"))
+
+# Token-budgeted history with a rolling summary per session
+SUMMARY_COLLECTION = os.getenv("SUMMARY_COLLECTION", "chat_summaries")
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_SUMMARY_EVERY = int(os.getenv("HISTORY_SUMMARY_EVERY", "10"))
+HISTORY_SUMMARY_KEEP = int(os.getenv("HISTORY_SUMMARY_KEEP", "10"))
+# Most messages folded per summary call; long backlogs go in several calls
+HISTORY_SUMMARY_CHUNK = int(os.getenv("HISTORY_SUMMARY_CHUNK", "100"))
+GEMINI_SUMMARY_MODEL = os.getenv("GEMINI_SUMMARY_MODEL", GEMINI_MODEL)
+
+# Agent loop: compaction of MongoDB results sent back to the model
+RESULT_COMPACT_THRESHOLD = int(os.getenv("RESULT_COMPACT_THRESHOLD", "2000"))
+RESULT_SAMPLE_ROWS = int(os.getenv("RESULT_SAMPLE_ROWS", "5"))
+RESULT_MAX_STRING = int(os.getenv("RESULT_MAX_STRING", "200"))
+
 # Telegram bot config
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# "polling" (default) or "webhook" (updates POSTed to the FastAPI app)
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling").lower()
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")  # public base URL, e.g. https://robert.example.com
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+TELEGRAM_POLLING_START_DELAY = float(os.getenv("TELEGRAM_POLLING_START_DELAY", "5"))
+TELEGRAM_STREAM_REPLIES = os.getenv("TELEGRAM_STREAM_REPLIES", "true").lower() == "true"
+TELEGRAM_STREAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_STREAM_EDIT_INTERVAL", "1.0"))
+# Text messages from one user closer than this (seconds) become one turn
+TELEGRAM_COALESCE_WINDOW = float(os.getenv("TELEGRAM_COALESCE_WINDOW", "1.5"))
+# "typing" lasts ~5s in Telegram; re-send it this often while a turn runs (0 = once)
+TELEGRAM_TYPING_REFRESH = float(os.getenv("TELEGRAM_TYPING_REFRESH", "4"))
+
+# Per-turn pipeline: overlap independent I/O of a turn (typing action and
+# history fetch, image preparation, reply send and turn save). false runs
+# the same steps one after another (baseline for benchmarks/load_test.py)
+TURN_PIPELINE = os.getenv("TURN_PIPELINE", "true").lower() == "true"
+
+# Deployment (DEPLOY_MODE=workers): uvicorn worker processes for main:app
+# (0 = one per CPU) and how the Telegram dispatcher reaches them. Each turn
+# is POSTed to DISPATCH_URL + /internal/telegram/turn with DISPATCH_SECRET;
+# a user's next turn is sent only after the previous one finished
+PORT = int(os.getenv("PORT", "8000"))
+API_WORKERS = int(os.getenv("API_WORKERS", "0")) or os.cpu_count() or 1
+DISPATCH_URL = os.getenv("DISPATCH_URL", f"http://127.0.0.1:{PORT}")
+DISPATCH_SECRET = os.getenv("DISPATCH_SECRET")
+DISPATCH_TIMEOUT = float(os.getenv("DISPATCH_TIMEOUT", "300"))
 
 # ──────────────────────────── System Prompt ─────────────────────
 
@@ -45,7 +210,7 @@ Cero Robot: PROHIBIDO usar frases de IA ("Como modelo de lenguaje", "Espero habe
 
 Humanización: Lo más natural posible. Puedes utilizar palabras como "bro", "hermano" o similares, pero sin sobreuso, solo cuando el contexto de confianza lo amerite.
 
-Memoria y Contexto: Analiza siempre el historial. Tu respuesta debe tener continuidad con lo que hablamos ayer. No preguntes lo que ya sabes.
+Memoria y Contexto: Analiza siempre el historial. Tu respuesta debe tener continuidad con lo que hablamos ayer. No preguntes lo que ya sabes. Si recibes un mensaje con el prefijo [RESUMEN_CONVERSACION], es el resumen de nuestras conversaciones anteriores: trátalo como memoria propia.
 
 ESTILO DE HUMOR E IRONÍA (La "Pimienta"):
 
@@ -79,6 +244,10 @@ Tienes acceso al CRUD de MongoDB de la app Llego con negocios que he visitado, e
 MODO AGENTE (OBLIGATORIO):
 Trabajas en un loop. Si necesitas datos reales, primero pides una operación MongoDB.
 Luego recibirás un mensaje con el resultado en JSON con el prefijo [RESULTADO_MONGO].
+Si el resultado es grande llegará compactado ("compactado": true): total_filas, campos, primeras_filas y agregados numéricos (min, max, sum, avg) calculados sobre todas las filas. Si necesitas más detalle, pide una operación más específica (filtro o aggregate).
+Los resultados de pasos anteriores se reducen a una línea con el prefijo [RESULTADO_MONGO_PREVIO].
+Si necesitas varias consultas independientes (p. ej. este mes vs el mes pasado), pídelas juntas en operations en un solo paso; se ejecutan en paralelo y recibirás un único [RESULTADO_MONGO] con los resultados numerados (#1, #2, ...).
+Si un resultado trae "error" y "sugerencia", la consulta fue rechazada o tardó demasiado: corrígela siguiendo la sugerencia (filtra por campos indexados o acota por fecha) en vez de repetirla igual. No uses $where ni $function.
 Analiza ese resultado y decide si necesitas otra operación o si ya puedes responder.
 Solo marca is_final=true cuando estés listo para dar la respuesta final al usuario.
 
@@ -94,13 +263,18 @@ Reglas técnicas para operation:
 - filter: para find, find_one, update_*, delete_*.
 - data: para insert_one (un dict) o insert_many (lista de dicts).
 - update: para update_one/update_many, con operadores MongoDB ($set, $inc, etc).
-- pipeline: solo para aggregate (lista de stages).
+- pipeline: para aggregate o rollup (lista de stages).
+- Al final de estas instrucciones puede venir [ESQUEMA_COLECCION] con los campos reales, sus tipos y ejemplos: úsalo para escribir filtros directamente, sin un find_one exploratorio para descubrir campos.
+- rollup: consulta de solo lectura sobre resúmenes precalculados en "{ROLLUP_COLLECTION}" (responde en milisegundos aunque haya años de historial). Cada documento tiene rollup ("mes", "negocio_mes" o "categoria_mes"), mes ("AAAA-MM"), {ROLLUP_BUSINESS_FIELD} o {ROLLUP_CATEGORY_FIELD} según el rollup, total (suma de {ROLLUP_AMOUNT_FIELD}) y count. Usa filter (p. ej. {{"rollup": "negocio_mes", "mes": "2024-05"}}, ordenado por total descendente) o pipeline para sumar varios meses. Úsalo primero para gastos por mes, por negocio o por categoría; ve a la colección original solo para detalle de transacciones.
+- projection: lista de campos a devolver en find/find_one/aggregate (p. ej. ["negocio", "monto", "fecha"]). Úsala siempre que no necesites el documento completo.
 - count: usa filter opcional.
 - Si el usuario envía una imagen, analízala y decide la operación según lo que pida.
 - reply siempre debe explicar qué harás o el resultado en tu estilo característico de Robert.
 - Debes devolver SIEMPRE el campo is_final (booleano).
 - Si necesitas otra operación, is_final=false y operation con la acción requerida.
+- operations: lista de operaciones independientes para un mismo paso (úsala en vez de operation cuando sean varias).
 - Cuando termines, is_final=true y operation puede ser null o action="none".
+- Si el mensaje del usuario incluye [MODO_CONVERSACION], responde directamente con el texto para el usuario en texto plano, sin JSON.
 
 Usa esta base de datos para analizar mis hábitos, gastos, negocios frecuentados, y dime qué estoy haciendo bien o mal financieramente. Sé directo.
 """
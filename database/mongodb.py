@@ -1,6 +1,7 @@
 """
 MongoDB database connection and utilities
 """
+import os
 from motor.motor_asyncio import AsyncIOMotorClient
 from config.settings import MONGO_URI, DB_NAME, COLLECTION
 
@@ -9,18 +10,47 @@ from config.settings import MONGO_URI, DB_NAME, COLLECTION
 db_client: AsyncIOMotorClient = None
 
 
+def _forget_client_after_fork():
+    """
+    A forked worker must not reuse the parent's client (its sockets and
+    monitor threads belong to the parent); dropping the reference makes the
+    worker's lifespan create its own with init_db()
+    """
+    global db_client
+    db_client = None
+
+
+os.register_at_fork(after_in_child=_forget_client_after_fork)
+
 # ──────────────────────────── Connection ────────────────────────
 
 
-def init_db():
-    """Initialize MongoDB client"""
+async def init_db():
+    """
+    Initialize MongoDB client, make sure required indexes exist and start
+    the schema digest sampler
+    """
     global db_client
     db_client = AsyncIOMotorClient(MONGO_URI)
+
+    from services.memory_service import ensure_memory_indexes
+    from services.rollup_service import ensure_rollup_indexes
+    try:
+        await ensure_memory_indexes()
+        await ensure_rollup_indexes()
+    except Exception as e:
+        print(f"[DB ERROR] No se pudieron crear los índices: {e}")
+
+    from services.schema_digest import start_schema_digest
+    start_schema_digest()
+
     return db_client
 
 
 def close_db():
     """Close MongoDB connection"""
+    from services.schema_digest import stop_schema_digest
+    stop_schema_digest()
     if db_client:
         db_client.close()
 
@@ -6,8 +6,11 @@ Soporta texto e imágenes.
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
+from config.settings import TELEGRAM_MODE, TELEGRAM_BOT_TOKEN, WORKERS_MODE
 from database.mongodb import init_db, close_db
 from services.gemini_service import init_gemini
+from services.memory_service import flush_memory, stop_memory_writer
+import services.telegram_bot as telegram_bot
 from api.routes import router
 
 
@@ -16,16 +19,37 @@ from api.routes import router
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup — only init if not already initialized (bot_main does it first)
+    # Startup — only init if not already initialized (bot_main does it first).
+    # Each uvicorn worker runs this after it starts, so it gets its own
+    # Motor and Gemini clients (inherited ones are dropped on fork)
     from database.mongodb import db_client
     from services.gemini_service import gemini_client
-    if db_client is None:
-        init_db()
+    own_db = db_client is None
+    if own_db:
+        await init_db()
     if gemini_client is None:
         init_gemini()
+
+    # Webhook mode under plain uvicorn: this process serves the bot too
+    own_bot = None
+    if WORKERS_MODE:
+        # API worker: answers turns forwarded by bot_main's dispatcher
+        if TELEGRAM_BOT_TOKEN:
+            await telegram_bot.start_worker_bot()
+    elif TELEGRAM_MODE == "webhook" and telegram_bot.bot_app is None:
+        own_bot = await telegram_bot.start_webhook_bot()
     yield
     # Shutdown
-    close_db()
+    if own_bot is not None:
+        await telegram_bot.stop_bot(own_bot)
+    await telegram_bot.stop_worker_bot()
+    if own_db:
+        # Queued chat messages go out before the client closes
+        await stop_memory_writer()
+        close_db()
+    else:
+        # bot_main owns the connection and stops the writer after the bot
+        await flush_memory()
 
 
 # ──────────────────────────── App ───────────────────────────────
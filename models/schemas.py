@@ -2,7 +2,7 @@
 Pydantic models and schemas
 """
 from enum import Enum
-from typing import Optional, Any
+from typing import Optional, Any, List
 from pydantic import BaseModel, Field
 
 
@@ -20,6 +20,7 @@ class ActionEnum(str, Enum):
     delete_many = "delete_many"
     aggregate = "aggregate"
     count = "count"
+    rollup = "rollup"
     none = "none"
 
 
@@ -36,7 +37,11 @@ class MongoOperation(BaseModel):
         default=None, description="Update con operadores $set, $inc, etc."
     )
     pipeline: Optional[Any] = Field(
-        default=None, description="Pipeline para aggregate"
+        default=None, description="Pipeline para aggregate (o rollup)"
+    )
+    projection: Optional[List[str]] = Field(
+        default=None,
+        description="Campos a devolver en find/find_one/aggregate; null = documento completo",
     )
 
 
@@ -51,6 +56,22 @@ class LLMResponse(BaseModel):
         default=None,
         description="Operación MongoDB, null si solo es conversación",
     )
+    operations: Optional[List[MongoOperation]] = Field(
+        default=None,
+        description=(
+            "Varias operaciones independientes en el mismo paso "
+            "(p. ej. comparar dos meses). Las lecturas se ejecutan en paralelo; "
+            "las escrituras en el orden dado. Usa esto en vez de operation "
+            "cuando necesites más de una."
+        ),
+    )
+
+    def requested_operations(self) -> List[MongoOperation]:
+        """All operations requested in this step, ignoring action=none"""
+        ops = list(self.operations or [])
+        if self.operation:
+            ops.insert(0, self.operation)
+        return [op for op in ops if op.action != ActionEnum.none]
 
 
 # ──────────────────── API Response ──────────────────────────────
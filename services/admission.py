@@ -0,0 +1,237 @@
+"""
+Admission control for Gemini calls
+
+Caps concurrent generate_content calls, applies a token-bucket rate
+limit and hands free slots out round-robin across sessions, so one busy
+/chat client can't starve Telegram users. Requests that would wait past
+GEMINI_QUEUE_DEADLINE are rejected with GeminiOverloadedError.
+"""
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from config.settings import (
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_RATE_LIMIT,
+    GEMINI_RATE_BURST,
+    GEMINI_QUEUE_DEADLINE,
+)
+
+# Session the current task is working for (set once per turn)
+current_session: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_session", default="anonymous"
+)
+
+
+class GeminiOverloadedError(Exception):
+    """Raised when a Gemini call can't be admitted before the deadline"""
+
+
+# ──────────────────────────── State ─────────────────────────────
+
+# session_id → waiting futures (FIFO); dict order is the round-robin order
+_queues: "OrderedDict[str, deque[asyncio.Future]]" = OrderedDict()
+_in_flight = 0
+
+_tokens = float(GEMINI_RATE_BURST)
+_last_refill = time.monotonic()
+_refill_handle: asyncio.TimerHandle | None = None
+
+# Recent call durations (s) to predict queue wait
+_service_times: deque[float] = deque(maxlen=200)
+_wait_times: deque[float] = deque(maxlen=1000)
+
+admission_stats = {
+    "admitted": 0,
+    "queued": 0,
+    "shed": 0,
+    "timeouts": 0,
+}
+
+
+# ──────────────────────────── Token Bucket ──────────────────────
+
+
+def _refill():
+    global _tokens, _last_refill
+    now = time.monotonic()
+    if GEMINI_RATE_LIMIT > 0:
+        _tokens = min(GEMINI_RATE_BURST, _tokens + (now - _last_refill) * GEMINI_RATE_LIMIT)
+    _last_refill = now
+
+
+def _token_wait() -> float:
+    """Seconds until a token is available (0 if one is available now)"""
+    if GEMINI_RATE_LIMIT <= 0:
+        return 0.0
+    _refill()
+    if _tokens >= 1:
+        return 0.0
+    return (1 - _tokens) / GEMINI_RATE_LIMIT
+
+
+def _take_token():
+    global _tokens
+    if GEMINI_RATE_LIMIT > 0:
+        _tokens -= 1
+
+
+# ──────────────────────────── Scheduling ────────────────────────
+
+
+def _queue_depth() -> int:
+    return sum(len(q) for q in _queues.values())
+
+
+def _predicted_wait() -> float:
+    """Rough wait for a new arrival: queue ahead of it over throughput"""
+    depth = _queue_depth()
+    if depth == 0 and _in_flight < GEMINI_MAX_CONCURRENCY:
+        return 0.0
+    avg = sum(_service_times) / len(_service_times) if _service_times else 1.0
+    by_concurrency = (depth + 1) * avg / GEMINI_MAX_CONCURRENCY
+    by_rate = (depth + 1) / GEMINI_RATE_LIMIT if GEMINI_RATE_LIMIT > 0 else 0.0
+    return max(by_concurrency, by_rate)
+
+
+def _next_waiter() -> asyncio.Future | None:
+    """Pop the next live waiter, rotating across sessions"""
+    while _queues:
+        session_id, queue = next(iter(_queues.items()))
+        fut = queue.popleft()
+        if queue:
+            _queues.move_to_end(session_id)
+        else:
+            del _queues[session_id]
+        if not fut.done():
+            return fut
+    return None
+
+
+def _drop_waiter(session_id: str, fut: asyncio.Future):
+    """Forget a waiter that gave up, so it no longer counts as queued"""
+    queue = _queues.get(session_id)
+    if queue is None:
+        return
+    try:
+        queue.remove(fut)
+    except ValueError:
+        return
+    if not queue:
+        del _queues[session_id]
+
+
+def _dispatch():
+    """Grant free slots to queued requests while capacity and tokens last"""
+    global _in_flight, _refill_handle
+    _refill_handle = None
+
+    while _queues and _in_flight < GEMINI_MAX_CONCURRENCY:
+        wait = _token_wait()
+        if wait > 0:
+            _refill_handle = asyncio.get_running_loop().call_later(wait, _dispatch)
+            return
+        fut = _next_waiter()
+        if fut is None:
+            return
+        _take_token()
+        _in_flight += 1
+        fut.set_result(None)
+
+
+async def _acquire(session_id: str):
+    global _in_flight
+    if not _queues and _in_flight < GEMINI_MAX_CONCURRENCY and _token_wait() == 0:
+        _take_token()
+        _in_flight += 1
+        _wait_times.append(0.0)
+        return
+
+    if _predicted_wait() > GEMINI_QUEUE_DEADLINE:
+        admission_stats["shed"] += 1
+        raise GeminiOverloadedError(
+            "Robert está atendiendo demasiadas consultas ahora mismo. "
+            "Intenta de nuevo en unos segundos."
+        )
+
+    fut = asyncio.get_running_loop().create_future()
+    _queues.setdefault(session_id, deque()).append(fut)
+    admission_stats["queued"] += 1
+    if _refill_handle is None:
+        _dispatch()
+
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(asyncio.shield(fut), timeout=GEMINI_QUEUE_DEADLINE)
+    except asyncio.TimeoutError:
+        if fut.done() and not fut.cancelled():
+            # Granted right at the deadline: give the slot back
+            _release()
+        fut.cancel()
+        _drop_waiter(session_id, fut)
+        admission_stats["timeouts"] += 1
+        raise GeminiOverloadedError(
+            "Robert está atendiendo demasiadas consultas ahora mismo. "
+            "Intenta de nuevo en unos segundos."
+        )
+    except asyncio.CancelledError:
+        if fut.done() and not fut.cancelled():
+            _release()
+        fut.cancel()
+        _drop_waiter(session_id, fut)
+        raise
+    _wait_times.append(time.monotonic() - started)
+
+
+def _release():
+    global _in_flight
+    _in_flight -= 1
+    if _queues and _refill_handle is None:
+        _dispatch()
+
+
+@asynccontextmanager
+async def gemini_slot(session_id: str | None = None):
+    """
+    Hold one admitted Gemini call for the duration of the block.
+
+    Raises GeminiOverloadedError if the request can't be admitted in time.
+    """
+    await _acquire(session_id or current_session.get())
+    admission_stats["admitted"] += 1
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _service_times.append(time.monotonic() - started)
+        _release()
+
+
+# ──────────────────────────── Metrics ───────────────────────────
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def get_admission_stats() -> dict:
+    """Queue depth, in-flight calls and recent wait-time percentiles"""
+    waits = list(_wait_times)
+    return {
+        **admission_stats,
+        "in_flight": _in_flight,
+        "queue_depth": _queue_depth(),
+        "queued_sessions": len(_queues),
+        "max_concurrency": GEMINI_MAX_CONCURRENCY,
+        "rate_limit_per_s": GEMINI_RATE_LIMIT,
+        "wait_ms": {
+            "p50": round(_percentile(waits, 0.50) * 1000, 1),
+            "p95": round(_percentile(waits, 0.95) * 1000, 1),
+            "max": round(max(waits, default=0.0) * 1000, 1),
+        },
+    }
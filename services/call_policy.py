@@ -0,0 +1,271 @@
+"""
+Call policy for Gemini requests
+
+Wraps a single generate_content call with a per-attempt timeout,
+exponential backoff with full jitter on retryable errors (429, 5xx,
+timeouts, connection errors), an optional hedged second request once the
+first one runs past the observed p95 latency, and a circuit breaker that
+fails fast while the upstream keeps failing. Every attempt, hedges
+included, is admitted separately (services.admission), so backoff sleeps
+hold no slot and retries count against the rate limit.
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import AsyncExitStack
+import httpx
+from google.genai import errors
+
+from config.settings import (
+    GEMINI_CALL_TIMEOUT,
+    GEMINI_MAX_RETRIES,
+    GEMINI_RETRY_BASE_DELAY,
+    GEMINI_RETRY_MAX_DELAY,
+    GEMINI_HEDGE,
+    GEMINI_HEDGE_MIN_SAMPLES,
+    GEMINI_BREAKER_THRESHOLD,
+    GEMINI_BREAKER_COOLDOWN,
+)
+from services.admission import gemini_slot, GeminiOverloadedError
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class GeminiUnavailableError(Exception):
+    """Raised while the circuit breaker is open"""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Transient failures worth another attempt"""
+    if isinstance(exc, errors.APIError):
+        return exc.code in RETRYABLE_STATUS
+    return isinstance(exc, (asyncio.TimeoutError, httpx.TransportError))
+
+
+# ──────────────────────────── Circuit Breaker ───────────────────
+
+
+class CircuitBreaker:
+    """
+    closed → open after GEMINI_BREAKER_THRESHOLD consecutive failures;
+    open → half-open after GEMINI_BREAKER_COOLDOWN seconds, letting a
+    single probe through; the probe's outcome closes or reopens it.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed" or self.threshold <= 0:
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def release_probe(self):
+        """A probe ended without an outcome (cancelled): let another one through"""
+        self.probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.threshold > 0 and (
+            self.probing or (self.opened_at is None and self.failures >= self.threshold)
+        ):
+            self.trips += 1
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+# ──────────────────────────── State ─────────────────────────────
+
+breaker = CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN)
+
+# model → recent successful attempt latencies (s), for the hedge delay
+_latencies: dict[str, deque[float]] = {}
+
+policy_stats = {
+    "calls": 0,
+    "retries": 0,
+    "timeouts": 0,
+    "hedges": 0,
+    "hedge_wins": 0,
+    "failures": 0,
+    "rejected_open": 0,
+}
+
+
+def _p95(model: str) -> float | None:
+    samples = _latencies.get(model)
+    if not samples or len(samples) < GEMINI_HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+
+def _backoff(attempt: int) -> float:
+    """Full jitter: uniform in [0, min(max, base * 2^attempt)]"""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+# ──────────────────────────── Attempts ──────────────────────────
+
+
+async def _attempt(
+    make_call,
+    model: str,
+    slots: AsyncExitStack | None = None,
+    timeout: float = GEMINI_CALL_TIMEOUT,
+):
+    """
+    One admitted call under the per-attempt timeout. With `slots` the
+    admission slot outlives the attempt and is released when that stack
+    closes (a stream holds it while it is read).
+    """
+    async with AsyncExitStack() as stack:
+        await stack.enter_async_context(gemini_slot())
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(make_call(), timeout=timeout)
+        except asyncio.TimeoutError:
+            policy_stats["timeouts"] += 1
+            raise
+        _latencies.setdefault(model, deque(maxlen=200)).append(time.monotonic() - started)
+        if slots is not None:
+            slots.push_async_exit(stack.pop_all())
+        return result
+
+
+async def _hedged_attempt(make_call, model: str, timeout: float = GEMINI_CALL_TIMEOUT):
+    """
+    Run one attempt; if it is still pending after the p95 latency, fire a
+    second identical request and keep whichever succeeds first.
+    """
+    delay = _p95(model)
+    primary = asyncio.ensure_future(_attempt(make_call, model, timeout=timeout))
+    if delay is None:
+        return await primary
+
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+
+    policy_stats["hedges"] += 1
+    hedge = asyncio.ensure_future(_attempt(make_call, model, timeout=timeout))
+    pending = {primary, hedge}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        policy_stats["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_with_policy(
+    make_call,
+    model: str,
+    call_info: dict | None = None,
+    hedge: bool = True,
+    slots: AsyncExitStack | None = None,
+    timeout: float = GEMINI_CALL_TIMEOUT,
+    max_retries: int = GEMINI_MAX_RETRIES,
+):
+    """
+    Await make_call() (a zero-argument coroutine function) under the call
+    policy and return its result.
+
+    slots: keep the successful attempt's admission slot until this stack
+    is closed instead of releasing it on return (implies no hedging).
+    timeout, max_retries: per-attempt timeout and retries, for calls with
+    a tighter budget than GEMINI_CALL_TIMEOUT / GEMINI_MAX_RETRIES.
+
+    Raises GeminiUnavailableError while the breaker is open,
+    GeminiOverloadedError if an attempt isn't admitted in time, or the
+    last error once retries are exhausted or the error is not retryable.
+    """
+    policy_stats["calls"] += 1
+    hedge = hedge and GEMINI_HEDGE and slots is None
+
+    for attempt in range(max_retries + 1):
+        if not breaker.allow():
+            policy_stats["rejected_open"] += 1
+            raise GeminiUnavailableError(
+                "Gemini no está respondiendo ahora mismo. Intenta de nuevo en un momento."
+            )
+        try:
+            if hedge:
+                result = await _hedged_attempt(make_call, model, timeout)
+            else:
+                result = await _attempt(make_call, model, slots, timeout)
+        except GeminiOverloadedError:
+            # Not admitted: no request reached the upstream
+            if breaker.probing:
+                breaker.release_probe()
+            raise
+        except asyncio.CancelledError:
+            # Says nothing about the upstream; a stuck probe would keep the
+            # breaker half-open and rejecting forever
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            retryable = is_retryable(e)
+            if retryable:
+                breaker.record_failure()
+            else:
+                # The upstream answered (e.g. 400): it is up, the request is bad
+                breaker.record_success()
+            if not retryable or attempt == max_retries:
+                policy_stats["failures"] += 1
+                raise
+            delay = _backoff(attempt)
+            policy_stats["retries"] += 1
+            if call_info is not None:
+                call_info["retries"] = attempt + 1
+            print(f"[GEMINI] Intento {attempt + 1} falló ({type(e).__name__}: {e}), reintento en {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return result
+
+
+def get_call_policy_stats() -> dict:
+    """Retry/hedge counters, breaker state and p95 latency per model"""
+    return {
+        **policy_stats,
+        "breaker": breaker.state,
+        "breaker_trips": breaker.trips,
+        "p95_ms": {
+            model: round(p95 * 1000, 1)
+            for model in _latencies
+            if (p95 := _p95(model)) is not None
+        },
+    }
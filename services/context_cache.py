@@ -0,0 +1,158 @@
+"""
+Gemini context cache for the system prompt
+
+Keeps a server-side CachedContent handle holding the system context
+(SYSTEM_PROMPT plus the schema digest) so each agent step only sends the
+conversation, not the multi-kilobyte prefix.
+"""
+import asyncio
+import hashlib
+import time
+from google.genai import types
+
+from config.settings import (
+    GEMINI_CONTEXT_CACHE,
+    GEMINI_CONTEXT_CACHE_TTL,
+    GEMINI_CONTEXT_CACHE_REFRESH_MARGIN,
+    GEMINI_CONTEXT_CACHE_RETRY_AFTER,
+)
+
+# ──────────────────────────── Globals ───────────────────────────
+
+_cache_name: str | None = None
+_cache_key: str | None = None
+_expires_at: float = 0.0
+_retry_at: float = 0.0
+_lock: asyncio.Lock | None = None
+
+cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "created": 0,
+    "refreshed": 0,
+    "invalidated": 0,
+    "errors": 0,
+}
+
+
+# ──────────────────────────── Utilities ─────────────────────────
+
+
+def _fingerprint(model: str, system_prompt: str) -> str:
+    """Key that changes whenever the model or the prompt changes"""
+    return hashlib.sha256(f"{model}\0{system_prompt}".encode("utf-8")).hexdigest()
+
+
+def _is_fresh(key: str) -> bool:
+    return (
+        _cache_name is not None
+        and _cache_key == key
+        and time.monotonic() < _expires_at - GEMINI_CONTEXT_CACHE_REFRESH_MARGIN
+    )
+
+
+def _get_lock() -> asyncio.Lock:
+    global _lock
+    if _lock is None:
+        _lock = asyncio.Lock()
+    return _lock
+
+
+# ──────────────────────────── Cache Handle ──────────────────────
+
+
+async def get_cached_content(client, model: str, system_prompt: str) -> str | None:
+    """
+    Return the name of a live CachedContent for (model, system_prompt).
+
+    Creates it on first use, extends its TTL before it expires and rebuilds
+    it when the prompt or model changes. Returns None when caching is
+    disabled or unavailable, so the caller sends system_instruction inline.
+    """
+    global _cache_name, _cache_key, _expires_at, _retry_at
+
+    if not GEMINI_CONTEXT_CACHE or client is None:
+        return None
+
+    key = _fingerprint(model, system_prompt)
+    if _is_fresh(key):
+        cache_stats["hits"] += 1
+        return _cache_name
+
+    if time.monotonic() < _retry_at:
+        cache_stats["misses"] += 1
+        return None
+
+    async with _get_lock():
+        # Another coroutine may have refreshed it while we waited
+        if _is_fresh(key):
+            cache_stats["hits"] += 1
+            return _cache_name
+
+        cache_stats["misses"] += 1
+        ttl = f"{GEMINI_CONTEXT_CACHE_TTL}s"
+
+        try:
+            if _cache_name and _cache_key == key:
+                await client.aio.caches.update(
+                    name=_cache_name,
+                    config=types.UpdateCachedContentConfig(ttl=ttl),
+                )
+                cache_stats["refreshed"] += 1
+            else:
+                stale = _cache_name
+                cached = await client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_prompt,
+                        display_name="robert-system-prompt",
+                        ttl=ttl,
+                    ),
+                )
+                _cache_name = cached.name
+                _cache_key = key
+                cache_stats["created"] += 1
+                print(f"[CACHE] Context cache creado: {_cache_name}")
+                if stale:
+                    await _delete_quietly(client, stale)
+        except Exception as e:
+            # e.g. prompt below the model's minimum cacheable size, or quota
+            cache_stats["errors"] += 1
+            print(f"[CACHE ERROR] No se pudo preparar el context cache: {e}")
+            _cache_name = None
+            _cache_key = None
+            _retry_at = time.monotonic() + GEMINI_CONTEXT_CACHE_RETRY_AFTER
+            return None
+
+        _expires_at = time.monotonic() + GEMINI_CONTEXT_CACHE_TTL
+        return _cache_name
+
+
+def invalidate_cached_content(name: str | None = None):
+    """Forget the current handle (e.g. the server reported it missing)"""
+    global _cache_name, _cache_key, _expires_at
+    if name is not None and name != _cache_name:
+        return
+    if _cache_name is not None:
+        cache_stats["invalidated"] += 1
+    _cache_name = None
+    _cache_key = None
+    _expires_at = 0.0
+
+
+async def _delete_quietly(client, name: str):
+    try:
+        await client.aio.caches.delete(name=name)
+    except Exception as e:
+        print(f"[CACHE] No se pudo borrar el cache anterior {name}: {e}")
+
+
+def get_cache_stats() -> dict:
+    """Hit/miss counters for the context cache"""
+    total = cache_stats["hits"] + cache_stats["misses"]
+    return {
+        **cache_stats,
+        "enabled": GEMINI_CONTEXT_CACHE,
+        "active": _cache_name,
+        "hit_rate": round(cache_stats["hits"] / total, 4) if total else 0.0,
+    }
@@ -1,12 +1,39 @@
 """
 Gemini LLM service for processing natural language queries
 """
+import asyncio
 import json
+import os
+import re
+import time
+from contextlib import AsyncExitStack
+from functools import partial
 from google import genai
 from google.genai import types
 
-from config.settings import GEMINI_MODEL, SYSTEM_PROMPT
-from models.schemas import LLMResponse, ActionEnum
+from config.settings import (
+    GEMINI_MODEL,
+    GEMINI_SUMMARY_MODEL,
+    GEMINI_BASE_URL,
+    GEMINI_STREAM_IDLE_TIMEOUT,
+    SYSTEM_PROMPT,
+)
+from models.schemas import LLMResponse
+from services.context_cache import get_cached_content, invalidate_cached_content
+from services.result_compaction import compact_result, summarize_result
+from services.router_service import Route, route_message, record_turn_latency
+from services.admission import current_session, GeminiOverloadedError
+from services.call_policy import call_with_policy, is_retryable, GeminiUnavailableError
+from services.image_service import image_part
+from services.schema_digest import get_digest
+from services.metrics import (
+    stage,
+    observe_stage,
+    record_gemini_usage,
+    record_turn,
+    timings_mark,
+    timings_since,
+)
 
 # ──────────────────────────── Globals ───────────────────────────
 
@@ -17,28 +44,89 @@ gemini_client: genai.Client = None
 
 
 def init_gemini():
-    """Initialize Gemini client (reads GEMINI_API_KEY from env automatically)"""
+    """
+    Initialize Gemini client (reads GEMINI_API_KEY from env automatically).
+    GEMINI_BASE_URL points it at another endpoint, e.g. a local fake server.
+    """
     global gemini_client
-    gemini_client = genai.Client()
+    if GEMINI_BASE_URL:
+        gemini_client = genai.Client(http_options=types.HttpOptions(base_url=GEMINI_BASE_URL))
+    else:
+        gemini_client = genai.Client()
     return gemini_client
 
 
+def _forget_client_after_fork():
+    """Forked workers create their own client (init_gemini) in the lifespan"""
+    global gemini_client
+    gemini_client = None
+
+
+os.register_at_fork(after_in_child=_forget_client_after_fork)
+
+
 # ──────────────────────────── LLM Call ──────────────────────────
 
 
-async def ask_gemini(
-    message: str,
-    image_bytes: bytes | None = None,
-    image_mime: str | None = None,
-    history: list[dict] | None = None,
-) -> LLMResponse:
+def system_context() -> str:
+    """SYSTEM_PROMPT plus the collection schema digest, once one is available"""
+    digest = get_digest()
+    if not digest:
+        return SYSTEM_PROMPT
+    return f"{SYSTEM_PROMPT}\n[ESQUEMA_COLECCION] Campos de la colección (muestra):\n{digest}\n"
+
+
+def _build_config(
+    cached_content: str | None, structured: bool = True
+) -> types.GenerateContentConfig:
     """
-    Ask Gemini to interpret the message and return structured response
-    with MongoDB operation if needed
+    Generation config with the system prompt cached or inline.
+    structured=True asks for an LLMResponse JSON; False for plain text.
     """
-    # Build conversation with Content objects
+    kwargs = {"temperature": 0.6}
+    if cached_content:
+        kwargs["cached_content"] = cached_content
+    else:
+        kwargs["system_instruction"] = system_context()
+    if structured:
+        kwargs["response_mime_type"] = "application/json"
+        kwargs["response_schema"] = LLMResponse
+    return types.GenerateContentConfig(**kwargs)
+
+
+# Appended to the user turn when the router skips the agent loop
+CHAT_MODE_HINT = "[MODO_CONVERSACION] Responde directamente en texto plano, sin JSON ni operaciones."
+
+
+def _record_usage(call_info: dict | None, response, model: str = GEMINI_MODEL):
+    """Record token usage in the metrics and copy it into call_info"""
+    usage = getattr(response, "usage_metadata", None)
+    record_gemini_usage(model, usage)
+    if call_info is None or not usage:
+        return
+    call_info["prompt_tokens"] = usage.prompt_token_count
+    call_info["cached_tokens"] = usage.cached_content_token_count or 0
+    call_info["output_tokens"] = usage.candidates_token_count
+
+
+def _build_contents(
+    message: str,
+    image: types.Part | None,
+    history: list[dict] | None,
+    summary: str | None,
+    structured: bool = True,
+) -> list[types.Content]:
+    """Summary + history + current message as Content objects"""
     contents = []
 
+    if summary:
+        contents.append(
+            types.Content(
+                role="user",
+                parts=[types.Part.from_text(text=f"[RESUMEN_CONVERSACION]\n{summary}")]
+            )
+        )
+
     # Add history if provided
     if history:
         for msg in history:
@@ -52,32 +140,19 @@ async def ask_gemini(
 
     # Add current message
     current_parts = [types.Part.from_text(text=message)]
-    if image_bytes and image_mime:
-        current_parts.append(types.Part.from_bytes(data=image_bytes, mime_type=image_mime))
+    if image is not None:
+        current_parts.append(image)
+    if not structured:
+        current_parts.append(types.Part.from_text(text=CHAT_MODE_HINT))
 
     contents.append(
         types.Content(role="user", parts=current_parts)
     )
+    return contents
 
-    try:
-        response = await gemini_client.aio.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=contents,
-            config=types.GenerateContentConfig(
-                system_instruction=SYSTEM_PROMPT,
-                response_mime_type="application/json",
-                response_schema=LLMResponse,
-                temperature=0.6,
-            ),
-        )
-    except Exception as e:
-        print(f"[GEMINI ERROR] API call failed: {e}")
-        return LLMResponse(
-            reply=f"Error llamando a Gemini: {e}",
-            is_final=True,
-            operation=None,
-        )
 
+def _parse_response(response) -> LLMResponse:
+    """Turn a generate_content response into an LLMResponse"""
     # Try to parse the response
     try:
         if response.parsed and isinstance(response.parsed, LLMResponse):
@@ -115,74 +190,546 @@ async def ask_gemini(
     )
 
 
+async def _call_with_cache_fallback(
+    method, contents, cached_content, structured: bool, call_info: dict | None, **policy
+):
+    """
+    method (generate_content or generate_content_stream) under the call
+    policy; if the context cache is rejected (expired or deleted
+    server-side), once more with the prompt inline
+    """
+    try:
+        return await call_with_policy(
+            partial(
+                method,
+                model=GEMINI_MODEL,
+                contents=contents,
+                config=_build_config(cached_content, structured),
+            ),
+            GEMINI_MODEL,
+            call_info,
+            **policy,
+        )
+    except Exception as e:
+        if (
+            not cached_content
+            or is_retryable(e)
+            or isinstance(e, (GeminiUnavailableError, GeminiOverloadedError))
+        ):
+            raise
+        print(f"[GEMINI] Context cache no disponible, reintentando sin cache: {e}")
+        invalidate_cached_content(cached_content)
+        if call_info is not None:
+            call_info["context_cache"] = "fallback"
+        return await call_with_policy(
+            partial(
+                method,
+                model=GEMINI_MODEL,
+                contents=contents,
+                config=_build_config(None, structured),
+            ),
+            GEMINI_MODEL,
+            call_info,
+            **policy,
+        )
+
+
+async def ask_gemini(
+    message: str,
+    image_bytes: bytes | None = None,
+    image_mime: str | None = None,
+    history: list[dict] | None = None,
+    call_info: dict | None = None,
+    summary: str | None = None,
+    structured: bool = True,
+) -> LLMResponse:
+    """
+    Ask Gemini to interpret the message and return structured response
+    with MongoDB operation if needed
+
+    If call_info is given it is filled with cache usage, latency and
+    token counts for this call. summary is the rolling summary of turns
+    older than history. structured=False is the conversational fast path:
+    plain text, wrapped in a final LLMResponse.
+    """
+    image = None
+    if image_bytes and image_mime:
+        image = await image_part(gemini_client, image_bytes, image_mime)
+    contents = _build_contents(message, image, history, summary, structured)
+
+    cached_content = await get_cached_content(gemini_client, GEMINI_MODEL, system_context())
+    if call_info is not None:
+        call_info["context_cache"] = "hit" if cached_content else "off"
+
+    started = time.perf_counter()
+    try:
+        response = await _call_with_cache_fallback(
+            gemini_client.aio.models.generate_content,
+            contents, cached_content, structured, call_info,
+        )
+    except (GeminiOverloadedError, GeminiUnavailableError) as e:
+        print(f"[GEMINI] Petición rechazada: {e}")
+        if call_info is not None:
+            call_info["shed"] = True
+        return LLMResponse(reply=str(e), is_final=True, operation=None)
+    except Exception as e:
+        print(f"[GEMINI ERROR] API call failed: {e}")
+        return LLMResponse(
+            reply=f"Error llamando a Gemini: {e}",
+            is_final=True,
+            operation=None,
+        )
+    finally:
+        elapsed = time.perf_counter() - started
+        observe_stage("gemini", elapsed, "structured" if structured else "chat")
+        if call_info is not None:
+            call_info["latency_ms"] = round(elapsed * 1000, 1)
+
+    _record_usage(call_info, response)
+    if not structured:
+        return LLMResponse(reply=(response.text or "").strip(), is_final=True, operation=None)
+    return _parse_response(response)
+
+
+# ──────────────────────────── Streaming ────────────────────────
+
+
+class ReplyStreamDecoder:
+    """
+    Incrementally decodes the "reply" string out of a streamed LLMResponse
+    JSON document, so reply text can be shown before the JSON is complete.
+    Relies on Gemini emitting properties in schema order (reply first).
+    """
+
+    _REPLY_KEY = re.compile(r'"reply"\s*:\s*"')
+
+    def __init__(self):
+        self.raw = ""
+        self.reply = ""
+        self._pos: int | None = None
+        self._done = False
+
+    def feed(self, text: str) -> str:
+        """Add a raw JSON chunk; return the newly decoded reply text"""
+        self.raw += text
+        if self._done:
+            return ""
+
+        if self._pos is None:
+            match = self._REPLY_KEY.search(self.raw)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        out = []
+        raw, i = self.raw, self._pos
+        while i < len(raw):
+            c = raw[i]
+            if c == '"':
+                self._done = True
+                i += 1
+                break
+            if c == "\\":
+                # Wait for the whole escape sequence before decoding it
+                if i + 1 >= len(raw):
+                    break
+                size = 6 if raw[i + 1] == "u" else 2
+                if size == 6 and 0xD800 <= int(raw[i + 2:i + 6] or "0", 16) < 0xDC00:
+                    size = 12  # surrogate pair
+                if i + size > len(raw):
+                    break
+                out.append(json.loads(f'"{raw[i:i + size]}"'))
+                i += size
+                continue
+            out.append(c)
+            i += 1
+
+        self._pos = i
+        delta = "".join(out)
+        self.reply += delta
+        return delta
+
+
+async def _read_stream(stream, slots: AsyncExitStack, chunks: asyncio.Queue):
+    """
+    Read a Gemini stream into `chunks`, then None (or the error), and
+    release its admission slot as soon as the upstream is done
+    """
+    try:
+        async with slots:
+            upstream = aiter(stream)
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(upstream), timeout=GEMINI_STREAM_IDLE_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise asyncio.TimeoutError(
+                        f"el stream no envió datos en {GEMINI_STREAM_IDLE_TIMEOUT:g}s"
+                    ) from None
+                chunks.put_nowait(chunk)
+        chunks.put_nowait(None)
+    except Exception as e:
+        chunks.put_nowait(e)
+
+
+async def ask_gemini_stream(
+    message: str,
+    image_bytes: bytes | None = None,
+    image_mime: str | None = None,
+    history: list[dict] | None = None,
+    call_info: dict | None = None,
+    summary: str | None = None,
+    structured: bool = True,
+):
+    """
+    Streaming version of ask_gemini.
+
+    Async generator yielding ("delta", str) with reply text as it arrives
+    and finally ("result", LLMResponse).
+    """
+    image = None
+    if image_bytes and image_mime:
+        image = await image_part(gemini_client, image_bytes, image_mime)
+    contents = _build_contents(message, image, history, summary, structured)
+
+    cached_content = await get_cached_content(gemini_client, GEMINI_MODEL, system_context())
+    if call_info is not None:
+        call_info["context_cache"] = "hit" if cached_content else "off"
+
+    decoder = ReplyStreamDecoder()
+    plain_text = ""
+    last_chunk = None
+    started = time.perf_counter()
+    try:
+        slots = AsyncExitStack()
+        try:
+            stream = await _call_with_cache_fallback(
+                gemini_client.aio.models.generate_content_stream,
+                contents, cached_content, structured, call_info,
+                hedge=False, slots=slots,
+            )
+        except BaseException:
+            await slots.aclose()
+            raise
+
+        # Upstream is read in its own task, which holds the admission slot
+        # only until the stream is exhausted: time the consumer spends on
+        # Telegram edits or a slow SSE client isn't charged to Gemini
+        chunks: asyncio.Queue = asyncio.Queue()
+        reader = asyncio.create_task(_read_stream(stream, slots, chunks))
+        # Cancelled before it ever ran, the reader never entered `slots`
+        reader.add_done_callback(lambda _: asyncio.ensure_future(slots.aclose()))
+        try:
+            while (chunk := await chunks.get()) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if call_info is not None and "ttft_ms" not in call_info:
+                    call_info["ttft_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                last_chunk = chunk
+                text = chunk.text
+                if not text:
+                    continue
+                if not structured:
+                    plain_text += text
+                    yield "delta", text
+                    continue
+                delta = decoder.feed(text)
+                if delta:
+                    yield "delta", delta
+        finally:
+            # Consumer gone (e.g. client disconnect): stop reading, free the slot
+            reader.cancel()
+    except (GeminiOverloadedError, GeminiUnavailableError) as e:
+        print(f"[GEMINI] Petición rechazada: {e}")
+        if call_info is not None:
+            call_info["shed"] = True
+        yield "result", LLMResponse(reply=str(e), is_final=True, operation=None)
+        return
+    except Exception as e:
+        print(f"[GEMINI ERROR] Streaming call failed: {e}")
+        yield "result", LLMResponse(
+            reply=f"Error llamando a Gemini: {e}",
+            is_final=True,
+            operation=None,
+        )
+        return
+    finally:
+        # Includes the time the consumer spends between chunks
+        elapsed = time.perf_counter() - started
+        observe_stage("gemini", elapsed, "stream" if structured else "chat_stream")
+        if call_info is not None:
+            call_info["latency_ms"] = round(elapsed * 1000, 1)
+
+    _record_usage(call_info, last_chunk)
+
+    if not structured:
+        yield "result", LLMResponse(reply=plain_text.strip(), is_final=True, operation=None)
+        return
+
+    try:
+        yield "result", LLMResponse.model_validate_json(decoder.raw)
+    except Exception as e:
+        print(f"[GEMINI ERROR] Streamed JSON invalid: {e}")
+        yield "result", LLMResponse(
+            reply=decoder.reply or "No pude procesar tu mensaje. Intenta de nuevo.",
+            is_final=True,
+            operation=None,
+        )
+
+
+# ──────────────────────────── Summaries ────────────────────────
+
+
+SUMMARY_PROMPT = """Resume la conversación entre el usuario y Robert (su asesor).
+Conserva hechos concretos: cifras, negocios, metas, compromisos, tareas pendientes,
+preferencias y el estado de ánimo del usuario. Descarta saludos y relleno.
+Escribe en español, en prosa compacta, máximo 250 palabras."""
+
+
+async def summarize_conversation(previous_summary: str | None, messages: list[dict]) -> str:
+    """
+    Fold new messages into the rolling summary of a conversation
+    """
+    lines = []
+    if previous_summary:
+        lines.append(f"Resumen previo:\n{previous_summary}\n")
+    lines.append("Mensajes nuevos:")
+    for msg in messages:
+        who = "Usuario" if msg["role"] == "user" else "Robert"
+        lines.append(f"{who}: {msg['message']}")
+
+    with stage("gemini", "summary"):
+        response = await call_with_policy(
+            partial(
+                gemini_client.aio.models.generate_content,
+                model=GEMINI_SUMMARY_MODEL,
+                contents="\n".join(lines),
+                config=types.GenerateContentConfig(
+                    system_instruction=SUMMARY_PROMPT,
+                    temperature=0.2,
+                ),
+            ),
+            GEMINI_SUMMARY_MODEL,
+            hedge=False,
+        )
+    _record_usage(None, response, GEMINI_SUMMARY_MODEL)
+    return (response.text or "").strip()
+
+
 # ──────────────────────────── Agent Loop ───────────────────────
 
 
-async def run_agent(
+async def run_agent_stream(
     message: str,
     image_bytes: bytes | None = None,
     image_mime: str | None = None,
     history: list[dict] | None = None,
     max_steps: int = 4,
+    summary: str | None = None,
+    stream: bool = True,
+    session_id: str | None = None,
 ):
     """
-    Agentic loop: Gemini puede pedir varias operaciones MongoDB antes
-    de dar una respuesta final basada en datos reales.
+    Route the turn, then run either the plain conversational reply or the
+    agentic loop, as an async generator of events:
+
+    - {"type": "token", "step": n, "text": ...}  reply text (only if stream)
+    - {"type": "step", "step": n, "info": {...}}  after each agent step
+    - {"type": "final", "llm": LLMResponse, "steps": [...]}  always last
+
+    session_id identifies the caller for Gemini admission fair queuing.
     """
+    if session_id:
+        current_session.set(session_id)
+    started = time.perf_counter()
+    decision = await route_message(gemini_client, message, has_image=bool(image_bytes))
+
+    if decision["route"] == Route.chat.value:
+        events = _chat_turn(message, history, summary, stream)
+    else:
+        events = _agent_loop(
+            message, image_bytes, image_mime, history, max_steps, summary, stream
+        )
+
+    async for event in events:
+        if event["type"] == "final":
+            turn_ms = round((time.perf_counter() - started) * 1000, 1)
+            decision["turn_ms"] = turn_ms
+            record_turn(decision["route"], len(event["steps"]), turn_ms / 1000)
+            saved = record_turn_latency(decision["route"], turn_ms)
+            if saved is not None:
+                decision["saved_ms"] = saved
+                print(f"[ROUTER] Turno conversacional en {turn_ms}ms (~{saved}ms ahorrados)")
+            if event["steps"]:
+                event["steps"][0]["route"] = decision
+        yield event
+
+
+async def _chat_turn(
+    message: str,
+    history: list[dict] | None,
+    summary: str | None,
+    stream: bool,
+):
+    """Conversational fast path: one plain-text generation, no tools"""
+    call_info = {}
+    mark = timings_mark()
+    if stream:
+        llm = None
+        async for kind, payload in ask_gemini_stream(
+            message, history=history, call_info=call_info, summary=summary, structured=False
+        ):
+            if kind == "delta":
+                yield {"type": "token", "step": 0, "text": payload}
+            else:
+                llm = payload
+    else:
+        llm = await ask_gemini(
+            message, history=history, call_info=call_info, summary=summary, structured=False
+        )
+
+    step_info = {
+        "llm": llm.model_dump(exclude_none=True),
+        "gemini": call_info,
+        "timings": timings_since(mark),
+    }
+    yield {"type": "step", "step": 0, "info": step_info}
+    yield {"type": "final", "llm": llm, "steps": [step_info]}
+
+
+async def _agent_loop(
+    message: str,
+    image_bytes: bytes | None,
+    image_mime: str | None,
+    history: list[dict] | None,
+    max_steps: int,
+    summary: str | None,
+    stream: bool,
+):
+    """Agentic loop: LLMResponse steps with MongoDB operations in between"""
     steps = []
     working_history = list(history) if history else []
+    # (index in working_history, [(action, raw result), ...]) already shown
+    shown_results = []
 
     current_message = message
     current_image_bytes = image_bytes
     current_image_mime = image_mime
 
-    for _ in range(max_steps):
-        llm = await ask_gemini(
-            current_message,
-            current_image_bytes,
-            current_image_mime,
-            working_history,
-        )
+    for step_no in range(max_steps):
+        call_info = {}
+        mark = timings_mark()
+        if stream:
+            llm = None
+            async for kind, payload in ask_gemini_stream(
+                current_message,
+                current_image_bytes,
+                current_image_mime,
+                working_history,
+                call_info=call_info,
+                summary=summary,
+            ):
+                if kind == "delta":
+                    yield {"type": "token", "step": step_no, "text": payload}
+                else:
+                    llm = payload
+        else:
+            llm = await ask_gemini(
+                current_message,
+                current_image_bytes,
+                current_image_mime,
+                working_history,
+                call_info=call_info,
+                summary=summary,
+            )
 
         step_info = {
             "llm": llm.model_dump(exclude_none=True),
+            "gemini": call_info,
         }
         steps.append(step_info)
 
         # Guardar el mensaje que se le envió al modelo
         working_history.append({"role": "user", "message": current_message})
 
-        if llm.is_final or not llm.operation or llm.operation.action == ActionEnum.none:
-            return llm, steps
+        ops = llm.requested_operations()
+        if llm.is_final or not ops:
+            step_info["timings"] = timings_since(mark)
+            yield {"type": "step", "step": step_no, "info": step_info}
+            yield {"type": "final", "llm": llm, "steps": steps}
+            return
 
-        # Ejecutar operación solicitada
+        # Ejecutar operaciones solicitadas (lecturas en paralelo)
         try:
-            from services.mongo_service import execute_operation
+            from services.mongo_service import (
+                execute_operations,
+                to_json_text,
+                record_prompt_bytes,
+            )
 
-            result = await execute_operation(llm.operation)
-            step_info["result"] = result
+            op_infos = [{} for _ in ops]
+            step_info["mongo"] = op_infos[0] if len(ops) == 1 else op_infos
+            results = await execute_operations(ops, op_infos)
+            step_info["result"] = results[0] if len(ops) == 1 else results
         except Exception as e:
             error_msg = f"Error ejecutando operación: {e}"
             final_reply = f"{llm.reply}\n\n⚠️ {error_msg}"
-            return LLMResponse(reply=final_reply, is_final=True, operation=None), steps
+            step_info["timings"] = timings_since(mark)
+            yield {"type": "step", "step": step_no, "info": step_info}
+            yield {
+                "type": "final",
+                "llm": LLMResponse(reply=final_reply, is_final=True, operation=None),
+                "steps": steps,
+            }
+            return
+
+        # The model already analysed earlier results: keep just one line each
+        for index, previous in shown_results:
+            working_history[index]["message"] = "[RESULTADO_MONGO_PREVIO] " + " | ".join(
+                summarize_result(action, result) for action, result in previous
+            )
+
+        actions = [op.action.value for op in ops]
+        raw_texts = [to_json_text(result) for result in results]
+        compacted = [
+            compact_result(result, raw) for result, raw in zip(results, raw_texts)
+        ]
+        for info, text in zip(op_infos, compacted):
+            record_prompt_bytes(info, text)
+        if len(ops) == 1:
+            prompt_result = compacted[0]
+        else:
+            prompt_result = "\n".join(
+                f"#{i + 1} {action}: {text}"
+                for i, (action, text) in enumerate(zip(actions, compacted))
+            )
+        step_info["result_chars"] = sum(len(raw) for raw in raw_texts)
+        step_info["prompt_result_chars"] = len(prompt_result)
+        step_info["timings"] = timings_since(mark)
+
+        yield {"type": "step", "step": step_no, "info": step_info}
 
         # Añadir respuesta y resultado al historial para la siguiente iteración
         working_history.append({"role": "assistant", "message": llm.reply})
         working_history.append(
             {
                 "role": "user",
-                "message": "[RESULTADO_MONGO]\n"
-                + json.dumps(result, ensure_ascii=False),
+                "message": "[RESULTADO_MONGO]\n" + prompt_result,
             }
         )
+        shown_results.append(
+            (len(working_history) - 1, list(zip(actions, results)))
+        )
 
         current_message = "Analiza el resultado y decide si necesitas otra operación."
         current_image_bytes = None
         current_image_mime = None
 
     # Si se agotaron pasos, cerrar con respuesta segura
-    return (
-        LLMResponse(
+    yield {
+        "type": "final",
+        "llm": LLMResponse(
             reply=(
                 "Me quedé sin pasos para analizar más. "
                 "Dime qué parte quieres que profundice."
@@ -190,5 +737,26 @@ async def run_agent(
             is_final=True,
             operation=None,
         ),
-        steps,
-    )
+        "steps": steps,
+    }
+
+
+async def run_agent(
+    message: str,
+    image_bytes: bytes | None = None,
+    image_mime: str | None = None,
+    history: list[dict] | None = None,
+    max_steps: int = 4,
+    summary: str | None = None,
+    session_id: str | None = None,
+):
+    """
+    Agentic loop: Gemini puede pedir varias operaciones MongoDB antes
+    de dar una respuesta final basada en datos reales.
+    """
+    async for event in run_agent_stream(
+        message, image_bytes, image_mime, history, max_steps, summary,
+        stream=False, session_id=session_id,
+    ):
+        if event["type"] == "final":
+            return event["llm"], event["steps"]
@@ -0,0 +1,203 @@
+"""
+Image preprocessing before images reach Gemini
+
+Photos are downscaled to IMAGE_MAX_SIDE and re-encoded as JPEG in a
+thread pool (Pillow releases the GIL while decoding/resizing), capped at
+IMAGE_MAX_BYTES, and cached by Telegram file_unique_id or content hash so
+repeated or forwarded images are processed once. With
+GEMINI_FILE_UPLOADS the processed bytes are uploaded once to the Gemini
+Files API and later turns reuse the file URI instead of inlining them.
+"""
+import asyncio
+import hashlib
+import io
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from google.genai import types
+
+from config.settings import (
+    IMAGE_MAX_SIDE,
+    IMAGE_JPEG_QUALITY,
+    IMAGE_MAX_BYTES,
+    IMAGE_CACHE_MAX_ENTRIES,
+    IMAGE_WORKERS,
+    GEMINI_FILE_UPLOADS,
+)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow missing: images pass through unchanged
+    Image = None
+
+# Uploaded files live 48h on Gemini's side; stop reusing them a bit earlier
+FILE_UPLOAD_TTL = 46 * 3600
+
+
+class ImageTooLargeError(ValueError):
+    """The image can't be brought under IMAGE_MAX_BYTES"""
+
+
+# ──────────────────────────── State ─────────────────────────────
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# key (file_unique_id or sha256) → (bytes, mime)
+_processed: "OrderedDict[str, tuple[bytes, str]]" = OrderedDict()
+
+# sha256 of processed bytes → (file uri, mime, uploaded_at)
+_uploads: "OrderedDict[str, tuple[str, str, float]]" = OrderedDict()
+
+image_stats = {
+    "processed": 0,
+    "cache_hits": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "uploads": 0,
+    "upload_reuses": 0,
+}
+
+
+def _remember(cache: OrderedDict, key: str, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > IMAGE_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+# ──────────────────────────── Selection ─────────────────────────
+
+
+def select_photo(photos):
+    """
+    Smallest Telegram PhotoSize whose longest side still reaches
+    IMAGE_MAX_SIDE (or the largest one if none does)
+    """
+    ordered = sorted(photos, key=lambda p: p.width * p.height)
+    for photo in ordered:
+        if max(photo.width, photo.height) >= IMAGE_MAX_SIDE:
+            return photo
+    return ordered[-1]
+
+
+# ──────────────────────────── Processing ────────────────────────
+
+
+def _encode(img, quality: int) -> bytes:
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def _process(data: bytes, mime: str | None) -> tuple[bytes, str]:
+    """Downscale + re-encode (runs in the thread pool)"""
+    if Image is None:
+        if len(data) > IMAGE_MAX_BYTES:
+            raise ImageTooLargeError(f"La imagen pesa {len(data)} bytes (máximo {IMAGE_MAX_BYTES})")
+        return data, mime or "image/jpeg"
+
+    img = Image.open(io.BytesIO(data))
+    fits = max(img.size) <= IMAGE_MAX_SIDE
+    if fits and mime == "image/jpeg" and len(data) <= IMAGE_MAX_BYTES:
+        return data, mime
+
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if not fits:
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+
+    quality = IMAGE_JPEG_QUALITY
+    out = _encode(img, quality)
+    while len(out) > IMAGE_MAX_BYTES:
+        if quality > 50:
+            quality -= 15
+        elif min(img.size) > 256:
+            img = img.resize((img.width * 3 // 4, img.height * 3 // 4), Image.LANCZOS)
+        else:
+            raise ImageTooLargeError(f"No pude reducir la imagen por debajo de {IMAGE_MAX_BYTES} bytes")
+        out = _encode(img, quality)
+
+    # Re-encoding a small, already compressed image can make it bigger
+    if len(out) >= len(data) and fits and len(data) <= IMAGE_MAX_BYTES:
+        return data, mime or "image/jpeg"
+    return out, "image/jpeg"
+
+
+def get_cached_image(key: str) -> tuple[bytes, str] | None:
+    """Processed image for a key, if already seen"""
+    cached = _processed.get(key)
+    if cached is not None:
+        _processed.move_to_end(key)
+        image_stats["cache_hits"] += 1
+    return cached
+
+
+async def prepare_image(
+    data: bytes, mime: str | None, key: str | None = None
+) -> tuple[bytes, str]:
+    """
+    Processed (bytes, mime) for an image, cached under key (e.g. a
+    Telegram file_unique_id) or the content hash.
+
+    Raises ImageTooLargeError if it can't be brought under IMAGE_MAX_BYTES.
+    """
+    key = key or content_key(data)
+    cached = get_cached_image(key)
+    if cached is not None:
+        return cached
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(_executor, _process, data, mime)
+    image_stats["processed"] += 1
+    image_stats["bytes_in"] += len(data)
+    image_stats["bytes_out"] += len(result[0])
+    print(f"[IMAGE] {len(data)} → {len(result[0])} bytes ({result[1]})")
+    _remember(_processed, key, result)
+    return result
+
+
+# ──────────────────────────── Gemini Parts ──────────────────────
+
+
+async def image_part(client, data: bytes, mime: str) -> types.Part:
+    """
+    Part for an image: inline bytes, or with GEMINI_FILE_UPLOADS a Files
+    API upload reused across turns while it is still valid
+    """
+    if not GEMINI_FILE_UPLOADS:
+        return types.Part.from_bytes(data=data, mime_type=mime)
+
+    key = content_key(data)
+    uploaded = _uploads.get(key)
+    if uploaded and time.time() - uploaded[2] < FILE_UPLOAD_TTL:
+        _uploads.move_to_end(key)
+        image_stats["upload_reuses"] += 1
+        return types.Part.from_uri(file_uri=uploaded[0], mime_type=uploaded[1])
+
+    try:
+        file = await client.aio.files.upload(
+            file=io.BytesIO(data),
+            config=types.UploadFileConfig(mime_type=mime),
+        )
+    except Exception as e:
+        print(f"[IMAGE] Subida a Gemini falló, envío la imagen inline: {e}")
+        return types.Part.from_bytes(data=data, mime_type=mime)
+
+    image_stats["uploads"] += 1
+    _remember(_uploads, key, (file.uri, file.mime_type or mime, time.time()))
+    return types.Part.from_uri(file_uri=file.uri, mime_type=file.mime_type or mime)
+
+
+def get_image_stats() -> dict:
+    """Processing and upload counters for /stats"""
+    return {
+        **image_stats,
+        "cached_images": len(_processed),
+        "cached_uploads": len(_uploads),
+        "pillow": Image is not None,
+    }
@@ -1,10 +1,209 @@
 """
 Memory service for storing and retrieving chat history
 """
-from datetime import datetime
-from typing import List, Dict
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import List, Dict, Set
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 import database.mongodb as db
-from config.settings import MEMORY_DB_NAME, MEMORY_COLLECTION
+from services.metrics import stage, start_timings
+from config.settings import (
+    MEMORY_DB_NAME,
+    MEMORY_COLLECTION,
+    MEMORY_LAYOUT,
+    MEMORY_SESSION_COLLECTION,
+    MEMORY_ARCHIVE_COLLECTION,
+    MEMORY_SESSION_MAX_MESSAGES,
+    MEMORY_ARCHIVE_BUCKET_HOURS,
+    MEMORY_WRITE_BEHIND,
+    MEMORY_FLUSH_INTERVAL,
+    MEMORY_FLUSH_BATCH,
+    MEMORY_MAX_PENDING,
+    SUMMARY_COLLECTION,
+    HISTORY_CACHE_ENABLED,
+    HISTORY_CACHE_MAX_SESSIONS,
+    HISTORY_CACHE_MAX_BYTES,
+    HISTORY_CACHE_MAX_MESSAGES,
+    HISTORY_CACHE_TTL,
+    HISTORY_TOKEN_BUDGET,
+    HISTORY_SUMMARY_EVERY,
+    HISTORY_SUMMARY_KEEP,
+    HISTORY_SUMMARY_CHUNK,
+)
+
+# ──────────────────────────── Utilities ─────────────────────────
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (~4 chars per token)"""
+    return max(1, (len(text) + 3) // 4)
+
+
+# ──────────────────────────── History Cache ─────────────────────
+
+# session_id → {"messages": [...], "summary": dict | None, "bytes": int,
+#               "complete": bool, "loaded_at": float}
+# Cached messages keep role, message, timestamp and tokens.
+# Most recently used sessions live at the end of the OrderedDict.
+_history_cache: "OrderedDict[str, dict]" = OrderedDict()
+_history_cache_bytes = 0
+
+history_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "expirations": 0,
+}
+
+# Rough per-message overhead (dict + keys) on top of the text itself
+_MESSAGE_OVERHEAD = 64
+
+
+def _message_size(msg: Dict) -> int:
+    return len(msg["message"].encode("utf-8")) + _MESSAGE_OVERHEAD
+
+
+def _drop_entry(session_id: str):
+    global _history_cache_bytes
+    entry = _history_cache.pop(session_id, None)
+    if entry:
+        _history_cache_bytes -= entry["bytes"]
+
+
+def _enforce_limits():
+    """Evict least recently used sessions until within entry/byte limits"""
+    while _history_cache and (
+        len(_history_cache) > HISTORY_CACHE_MAX_SESSIONS
+        or _history_cache_bytes > HISTORY_CACHE_MAX_BYTES
+    ):
+        session_id = next(iter(_history_cache))
+        _drop_entry(session_id)
+        history_cache_stats["evictions"] += 1
+
+
+def _store_entry(
+    session_id: str,
+    messages: List[Dict],
+    complete: bool,
+    summary: Dict | None = None,
+):
+    global _history_cache_bytes
+    _drop_entry(session_id)
+    # Older messages cut off here are no longer in the entry
+    complete = complete and len(messages) <= HISTORY_CACHE_MAX_MESSAGES
+    messages = messages[-HISTORY_CACHE_MAX_MESSAGES:]
+    size = sum(_message_size(m) for m in messages)
+    if summary:
+        size += len(summary["summary"].encode("utf-8"))
+    _history_cache[session_id] = {
+        "messages": messages,
+        "summary": summary,
+        "bytes": size,
+        "complete": complete,
+        "loaded_at": time.monotonic(),
+    }
+    _history_cache_bytes += size
+    _enforce_limits()
+
+
+def _cached_entry(session_id: str, limit: int) -> Dict | None:
+    """Return the cache entry if it can serve `limit` messages, else None"""
+    entry = _history_cache.get(session_id)
+    if entry is None:
+        return None
+
+    if time.monotonic() - entry["loaded_at"] > HISTORY_CACHE_TTL:
+        _drop_entry(session_id)
+        history_cache_stats["expirations"] += 1
+        return None
+
+    if len(entry["messages"]) < limit and not entry["complete"]:
+        # Caller wants more than the cache holds
+        return None
+
+    _history_cache.move_to_end(session_id)
+    return entry
+
+
+def _append_cached(session_id: str, msg: Dict):
+    """Write-through: append a new message to an already cached session"""
+    global _history_cache_bytes
+    entry = _history_cache.get(session_id)
+    if entry is None:
+        return
+
+    entry["messages"].append(msg)
+    entry["bytes"] += _message_size(msg)
+    _history_cache_bytes += _message_size(msg)
+
+    overflow = len(entry["messages"]) - HISTORY_CACHE_MAX_MESSAGES
+    if overflow > 0:
+        dropped = entry["messages"][:overflow]
+        del entry["messages"][:overflow]
+        freed = sum(_message_size(m) for m in dropped)
+        entry["bytes"] -= freed
+        _history_cache_bytes -= freed
+        entry["complete"] = False
+
+    _history_cache.move_to_end(session_id)
+    _enforce_limits()
+
+
+def _set_cached_summary(session_id: str, summary: Dict):
+    """Write-through for the rolling summary"""
+    global _history_cache_bytes
+    entry = _history_cache.get(session_id)
+    if entry is None:
+        return
+    old = entry["summary"]
+    delta = len(summary["summary"].encode("utf-8"))
+    if old:
+        delta -= len(old["summary"].encode("utf-8"))
+    entry["summary"] = summary
+    entry["bytes"] += delta
+    _history_cache_bytes += delta
+    _enforce_limits()
+
+
+def get_history_cache_stats() -> dict:
+    """Hit-rate and size metrics for the history cache"""
+    total = history_cache_stats["hits"] + history_cache_stats["misses"]
+    return {
+        **history_cache_stats,
+        "enabled": HISTORY_CACHE_ENABLED,
+        "sessions": len(_history_cache),
+        "bytes": _history_cache_bytes,
+        "hit_rate": round(history_cache_stats["hits"] / total, 4) if total else 0.0,
+    }
+
+
+# ──────────────────────────── Memory Store ──────────────────────
+
+# "session" layout: one document per session in MEMORY_SESSION_COLLECTION
+#   {_id: session_id, messages: [...newest MEMORY_SESSION_MAX_MESSAGES],
+#    total: int, updated_at}
+# and the turns pushed out of it in MEMORY_ARCHIVE_COLLECTION, one
+# document per session per MEMORY_ARCHIVE_BUCKET_HOURS window
+#   {sessionID, bucket: window start, messages: [...], count, first, last}
+SESSION_LAYOUT = MEMORY_LAYOUT == "session"
+
+_EPOCH = datetime(1970, 1, 1)
+
+memory_stats = {
+    "messages_saved": 0,
+    "writes": 0,
+    "archived_messages": 0,
+    "archive_errors": 0,
+    "flushes": 0,
+    "flush_errors": 0,
+    "largest_flush": 0,
+    "backpressure_waits": 0,
+    "rejected_messages": 0,
+}
 
 
 def get_memory_collection():
@@ -12,7 +211,323 @@ def get_memory_collection():
     return db.db_client[MEMORY_DB_NAME][MEMORY_COLLECTION]
 
 
-async def save_message(session_id: str, role: str, message: str):
+def get_session_collection():
+    """Get the per-session documents collection ("session" layout)"""
+    return db.db_client[MEMORY_DB_NAME][MEMORY_SESSION_COLLECTION]
+
+
+def get_archive_collection():
+    """Get the archived turns collection ("session" layout)"""
+    return db.db_client[MEMORY_DB_NAME][MEMORY_ARCHIVE_COLLECTION]
+
+
+def get_summary_collection():
+    """Get the rolling summaries collection"""
+    return db.db_client[MEMORY_DB_NAME][SUMMARY_COLLECTION]
+
+
+async def ensure_memory_indexes():
+    """Create the indexes the history queries rely on (idempotent)"""
+    col = get_memory_collection()
+    await col.create_index(
+        [("sessionID", 1), ("timestamp", -1)],
+        name="session_timestamp",
+    )
+    if SESSION_LAYOUT:
+        await ensure_session_indexes()
+    await get_summary_collection().create_index(
+        "sessionID", name="session", unique=True
+    )
+
+
+async def ensure_session_indexes():
+    """Session documents are looked up by _id; only the archive needs one"""
+    await get_archive_collection().create_index(
+        [("sessionID", 1), ("bucket", -1)],
+        name="session_bucket",
+        unique=True,
+    )
+
+
+def _to_millis(timestamp: datetime) -> datetime:
+    """BSON dates keep milliseconds: truncate so queued and cached copies
+    compare equal to what MongoDB returns for the same message"""
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+
+def _message_doc(role: str, message: str, timestamp: datetime | None = None) -> Dict:
+    return {
+        "role": role,
+        "message": message,
+        "timestamp": _to_millis(timestamp or datetime.utcnow()),
+        "tokens": estimate_tokens(message),
+    }
+
+
+def archive_bucket(timestamp: datetime) -> datetime:
+    """Start of the MEMORY_ARCHIVE_BUCKET_HOURS window a timestamp falls in"""
+    width = MEMORY_ARCHIVE_BUCKET_HOURS * 3600
+    seconds = int((timestamp - _EPOCH).total_seconds())
+    return _EPOCH + timedelta(seconds=seconds - seconds % width)
+
+
+def archive_requests(session_id: str, messages: List[Dict]) -> List[UpdateOne]:
+    """Upserts appending messages to their archive buckets"""
+    buckets: Dict[datetime, List[Dict]] = {}
+    for msg in messages:
+        buckets.setdefault(archive_bucket(msg["timestamp"]), []).append(msg)
+    return [
+        UpdateOne(
+            {"sessionID": session_id, "bucket": bucket},
+            {
+                "$push": {"messages": {"$each": msgs}},
+                "$inc": {"count": len(msgs)},
+                "$min": {"first": msgs[0]["timestamp"]},
+                "$max": {"last": msgs[-1]["timestamp"]},
+            },
+            upsert=True,
+        )
+        for bucket, msgs in buckets.items()
+    ]
+
+
+async def _archive(session_id: str, messages: List[Dict]):
+    """
+    Move turns that were sliced off the session document into the archive.
+    They are already gone from the session document, so a failure here is
+    logged and counted rather than retried.
+    """
+    try:
+        await get_archive_collection().bulk_write(
+            archive_requests(session_id, messages), ordered=False
+        )
+        memory_stats["archived_messages"] += len(messages)
+    except Exception as e:
+        memory_stats["archive_errors"] += 1
+        print(f"[MEMORY ERROR] No se pudieron archivar {len(messages)} mensajes de {session_id}: {e}")
+
+
+def session_push(messages: List[Dict], cap: int = MEMORY_SESSION_MAX_MESSAGES) -> tuple[dict, dict]:
+    """
+    (update, projection) for find_one_and_update on a session document:
+    append + cap, and project the pre-update document down to the
+    messages the $slice is about to drop
+    """
+    n = len(messages)
+    update = {
+        "$push": {"messages": {"$each": messages, "$slice": -cap}},
+        "$inc": {"total": n},
+        "$set": {"updated_at": datetime.utcnow()},
+    }
+    projection = {
+        "_id": 0,
+        "dropped": {"$let": {
+            "vars": {"msgs": {"$ifNull": ["$messages", []]}},
+            "in": {"$slice": ["$$msgs", {"$max": [
+                0, {"$subtract": [{"$add": [{"$size": "$$msgs"}, n]}, cap]},
+            ]}]},
+        }},
+    }
+    return update, projection
+
+
+async def _push_session(session_id: str, messages: List[Dict]):
+    """
+    Append to the capped session document in one atomic update. The
+    pre-update document comes back projected down to the messages the
+    $slice drops, which then go to the archive.
+    """
+    update, projection = session_push(messages)
+    before = await get_session_collection().find_one_and_update(
+        {"_id": session_id}, update, projection=projection, upsert=True
+    )
+    if before and before["dropped"]:
+        await _archive(session_id, before["dropped"])
+
+
+async def _write_batch(items: List[tuple[str, Dict]]) -> List[tuple[str, Dict]]:
+    """
+    Persist (session_id, message) pairs in arrival order; returns the
+    pairs that were not written. "messages" layout: one ordered
+    insert_many. "session" layout: one $push per session, sessions in
+    parallel (the push needs its pre-image to archive what it drops, which
+    bulk_write can't return).
+    """
+    with stage("memory_save", "session" if SESSION_LAYOUT else "messages"):
+        if SESSION_LAYOUT:
+            by_session: Dict[str, List[Dict]] = {}
+            for session_id, msg in items:
+                by_session.setdefault(session_id, []).append(msg)
+            outcomes = await asyncio.gather(
+                *(_push_session(s, msgs) for s, msgs in by_session.items()),
+                return_exceptions=True,
+            )
+            failed_sessions = set()
+            for session_id, outcome in zip(by_session, outcomes):
+                if isinstance(outcome, Exception):
+                    failed_sessions.add(session_id)
+                    print(f"[MEMORY ERROR] No se pudo guardar el historial de {session_id}: {outcome}")
+            failed = [item for item in items if item[0] in failed_sessions]
+        else:
+            docs = [{"sessionID": session_id, **msg} for session_id, msg in items]
+            try:
+                await get_memory_collection().insert_many(docs, ordered=True)
+                failed = []
+            except BulkWriteError as e:
+                # Ordered: everything before the first error went in
+                failed = items[e.details.get("nInserted", 0):]
+                print(f"[MEMORY ERROR] insert_many parcial, {len(failed)} mensajes pendientes: {e}")
+            except Exception as e:
+                failed = items
+                print(f"[MEMORY ERROR] No se pudieron guardar {len(items)} mensajes: {e}")
+
+    written = len(items) - len(failed)
+    memory_stats["writes"] += 1
+    memory_stats["messages_saved"] += written
+    return failed
+
+
+async def _store(session_id: str, messages: List[Dict]):
+    """
+    Save messages (oldest first): queued for the write-behind flusher, or
+    written right away with MEMORY_WRITE_BEHIND off. Either way the history
+    cache sees them immediately.
+    """
+    if HISTORY_CACHE_ENABLED:
+        for msg in messages:
+            _append_cached(session_id, dict(msg))
+
+    if MEMORY_WRITE_BEHIND:
+        await _enqueue(session_id, messages)
+        return
+
+    failed = await _write_batch([(session_id, msg) for msg in messages])
+    if failed:
+        raise RuntimeError(f"No se pudieron guardar {len(failed)} mensajes de {session_id}")
+
+
+# ──────────────────────────── Write-Behind ──────────────────────
+
+# (session_id, message) in arrival order, not yet written
+_queue: List[tuple[str, Dict]] = []
+# session_id → its queued messages (oldest first), for read-your-writes
+_unflushed: Dict[str, List[Dict]] = {}
+_wakeup = asyncio.Event()
+_flush_lock = asyncio.Lock()
+# Sessions cleared while the batch being written held their messages:
+# if that batch fails, those messages must not go back to the queue
+_cleared_in_flight: Set[str] = set()
+_in_flight: List[tuple[str, Dict]] = []
+_flusher: asyncio.Task | None = None
+# Asks the flusher to exit after its current flush (stop_memory_writer)
+_stopping = False
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None or _flusher.done():
+        # Fresh context: the flusher must not inherit the first caller's
+        # request timings or admission session
+        loop = asyncio.get_running_loop()
+        _flusher = contextvars.Context().run(loop.create_task, _flush_loop())
+
+
+async def _enqueue(session_id: str, messages: List[Dict]):
+    _ensure_flusher()
+    if len(_queue) >= MEMORY_MAX_PENDING:
+        # MongoDB is slow or down: make callers wait instead of growing,
+        # and refuse the messages if the flush couldn't make room
+        memory_stats["backpressure_waits"] += 1
+        if await flush_memory() >= MEMORY_MAX_PENDING:
+            memory_stats["rejected_messages"] += len(messages)
+            raise RuntimeError(
+                f"Cola de memoria llena ({len(_queue)} mensajes): no se guardó el historial de {session_id}"
+            )
+
+    for msg in messages:
+        _queue.append((session_id, msg))
+    _unflushed.setdefault(session_id, []).extend(messages)
+    if len(_queue) >= MEMORY_FLUSH_BATCH:
+        _wakeup.set()
+
+
+def _mark_written(items: List[tuple[str, Dict]]):
+    """Drop written messages from the read-your-writes view"""
+    for session_id, msg in items:
+        pending = _unflushed.get(session_id)
+        # Per-session order is preserved, so written ones are the oldest
+        if pending and pending[0] is msg:
+            pending.pop(0)
+        if not pending:
+            _unflushed.pop(session_id, None)
+
+
+async def flush_memory() -> int:
+    """
+    Write everything queued, in batches of MEMORY_FLUSH_BATCH. Stops at
+    the first failed batch (it goes back to the front of the queue for
+    the next attempt). Returns how many messages are still queued.
+    """
+    global _in_flight
+    async with _flush_lock:
+        while _queue:
+            batch = _queue[:MEMORY_FLUSH_BATCH]
+            del _queue[:len(batch)]
+            _in_flight = batch
+            try:
+                failed = await _write_batch(batch)
+            finally:
+                _in_flight = []
+            if _cleared_in_flight:
+                failed = [item for item in failed if item[0] not in _cleared_in_flight]
+                _cleared_in_flight.clear()
+            failed_ids = {id(msg) for _, msg in failed}
+            written = [item for item in batch if id(item[1]) not in failed_ids]
+            _mark_written(written)
+            memory_stats["flushes"] += 1
+            memory_stats["largest_flush"] = max(memory_stats["largest_flush"], len(written))
+            if failed:
+                memory_stats["flush_errors"] += 1
+                _queue[:0] = failed
+                break
+        return len(_queue)
+
+
+async def _flush_loop():
+    while not _stopping:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), MEMORY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        if _queue:
+            await flush_memory()
+
+
+async def stop_memory_writer():
+    """Flush what is queued and stop the flusher (call before close_db)"""
+    global _flusher, _stopping
+    if _flusher is not None:
+        # Not cancelled: that could interrupt a batch already taken off
+        # the queue and lose it
+        _stopping = True
+        _wakeup.set()
+        try:
+            await _flusher
+        except Exception as e:
+            print(f"[MEMORY ERROR] El flusher terminó con error: {e}")
+        _flusher = None
+        _stopping = False
+    left = await flush_memory()
+    if left:
+        print(f"[MEMORY ERROR] {left} mensajes sin guardar al apagar")
+
+
+def _pending_for(session_id: str) -> List[Dict]:
+    return list(_unflushed.get(session_id, ()))
+
+
+async def save_message(session_id: str, role: str, message: str, at: datetime | None = None):
     """
     Save a message to chat history
 
@@ -20,20 +535,169 @@ async def save_message(session_id: str, role: str, message: str):
         session_id: Unique identifier for the conversation session
         role: Either 'user' or 'assistant'
         message: The message content
+        at: When it was sent (defaults to now)
     """
-    col = get_memory_collection()
-    await col.insert_one({
-        "sessionID": session_id,
-        "role": role,
-        "message": message,
-        "timestamp": datetime.utcnow()
-    })
+    await _store(session_id, [_message_doc(role, message, at)])
+
+
+async def save_turn(
+    session_id: str,
+    user_message: str,
+    reply: str,
+    user_at: datetime | None = None,
+):
+    """
+    Save a user message and the assistant reply together: one atomic
+    update in the "session" layout, one insert_many otherwise
+
+    Args:
+        session_id: Unique identifier for the conversation session
+        user_message: What the user sent
+        reply: The assistant reply
+        user_at: When the user message arrived (defaults to now)
+    """
+    user = _message_doc("user", user_message, user_at)
+    assistant = _message_doc("assistant", reply)
+    # Keep the pair ordered even if the clock didn't move
+    if assistant["timestamp"] <= user["timestamp"]:
+        assistant["timestamp"] = user["timestamp"] + timedelta(milliseconds=1)
+    await _store(session_id, [user, assistant])
+
+
+async def save_unanswered(session_id: str, user_message: str, user_at: datetime | None = None):
+    """
+    Keep a user message whose turn failed before there was a reply to
+    pair it with (save_turn). Runs on error paths, so a failure here is
+    logged rather than raised over the original error.
+    """
+    try:
+        await save_message(session_id, "user", user_message, at=user_at)
+    except Exception as e:
+        print(f"[MEMORY ERROR] No se pudo guardar el mensaje de {session_id}: {e}")
+
+
+async def _fetch_session_messages(session_id: str, limit: int) -> List[Dict]:
+    """
+    Latest `limit` messages from the session document, topped up from
+    the newest archive buckets when the document holds fewer
+    """
+    doc = await get_session_collection().find_one(
+        {"_id": session_id},
+        {"_id": 0, "messages": {"$slice": -limit}, "total": 1},
+    )
+    if not doc:
+        return []
+    messages = doc.get("messages") or []
+
+    needed = limit - len(messages)
+    if needed > 0 and doc.get("total", 0) > len(messages):
+        older: List[Dict] = []
+        cursor = get_archive_collection().find(
+            {"sessionID": session_id}, {"_id": 0, "messages": 1}
+        ).sort("bucket", -1)
+        async for bucket in cursor:
+            older = bucket["messages"] + older
+            if len(older) >= needed:
+                break
+        messages = older[-needed:] + messages
+    return messages
+
+
+async def _fetch_history(session_id: str, limit: int) -> List[Dict]:
+    """
+    Read the latest `limit` messages straight from MongoDB
+
+    "messages" layout: walks the (sessionID, timestamp) index newest-first
+    so only `limit` entries are touched, then reverses to chronological
+    order. "session" layout: one _id lookup with a $slice projection.
+    """
+    if SESSION_LAYOUT:
+        messages = await _fetch_session_messages(session_id, limit)
+    else:
+        col = get_memory_collection()
+        cursor = col.find(
+            {"sessionID": session_id},
+            {"_id": 0, "role": 1, "message": 1, "timestamp": 1, "tokens": 1},
+        ).sort("timestamp", -1).limit(limit)
+
+        messages = await cursor.to_list(length=limit)
+        messages.reverse()
+
+    return [
+        {
+            "role": msg["role"],
+            "message": msg["message"],
+            "timestamp": msg.get("timestamp"),
+            # Messages saved before token caching get estimated once here
+            "tokens": msg.get("tokens") or estimate_tokens(msg["message"]),
+        }
+        for msg in messages
+    ]
+
+
+async def _fetch_summary(session_id: str) -> Dict | None:
+    return await get_summary_collection().find_one(
+        {"sessionID": session_id},
+        {"_id": 0, "summary": 1, "covered_until": 1, "tokens": 1},
+    )
+
+
+def _unread(msg: Dict, messages: List[Dict]) -> bool:
+    """
+    Whether a queued message is missing from what was read (oldest
+    first): newer than the last one, or as new but not the same message
+    (timestamps are millisecond-precise, see _to_millis)
+    """
+    if not messages:
+        return True
+    newest = messages[-1]["timestamp"]
+    if msg["timestamp"] != newest:
+        return msg["timestamp"] > newest
+    return not any(
+        m["timestamp"] == newest and m["role"] == msg["role"] and m["message"] == msg["message"]
+        for m in messages
+    )
+
+
+async def _load_session(session_id: str, limit: int) -> Dict:
+    """Cache entry for a session, loading history + summary on a miss"""
+    if HISTORY_CACHE_ENABLED:
+        entry = _cached_entry(session_id, limit)
+        if entry is not None:
+            history_cache_stats["hits"] += 1
+            return entry
+        history_cache_stats["misses"] += 1
+
+    fetch_limit = max(limit, HISTORY_CACHE_MAX_MESSAGES)
+    # Taken before the read: a flush may land while it runs
+    pending = _pending_for(session_id)
+    messages, summary = await asyncio.gather(
+        _fetch_history(session_id, fetch_limit),
+        _fetch_summary(session_id),
+    )
+    complete = len(messages) < fetch_limit
+
+    # Read-your-writes: queued messages the read didn't see yet
+    pending += [m for m in _pending_for(session_id) if not any(m is p for p in pending)]
+    if pending:
+        messages = (messages + [dict(m) for m in pending if _unread(m, messages)])[-fetch_limit:]
+
+    if HISTORY_CACHE_ENABLED:
+        _store_entry(session_id, messages, complete, summary)
+    return {"messages": messages, "summary": summary, "complete": complete}
+
+
+def _public(messages: List[Dict]) -> List[Dict[str, str]]:
+    return [{"role": m["role"], "message": m["message"]} for m in messages]
 
 
 async def get_chat_history(session_id: str, limit: int = 20) -> List[Dict[str, str]]:
     """
     Retrieve chat history for a session
 
+    Warm sessions are served from the in-process cache without touching
+    MongoDB.
+
     Args:
         session_id: Unique identifier for the conversation session
         limit: Maximum number of messages to retrieve (default 20)
@@ -41,17 +705,169 @@ async def get_chat_history(session_id: str, limit: int = 20) -> List[Dict[str, s
     Returns:
         List of messages in format [{"role": "user", "message": "..."}, ...]
     """
-    col = get_memory_collection()
-    cursor = col.find(
-        {"sessionID": session_id}
-    ).sort("timestamp", 1).limit(limit)
+    if limit <= 0:
+        return []
+    with stage("history"):
+        entry = await _load_session(session_id, limit)
+    return _public(entry["messages"][-limit:])
 
-    messages = await cursor.to_list(length=limit)
 
-    return [
-        {"role": msg["role"], "message": msg["message"]}
-        for msg in messages
-    ]
+async def get_context(
+    session_id: str, token_budget: int = HISTORY_TOKEN_BUDGET
+) -> tuple[str | None, List[Dict[str, str]]]:
+    """
+    Build the model context for a session: rolling summary + newest turns
+
+    Returns (summary, history) where history holds the newest messages not
+    yet covered by the summary that fit in token_budget. Also schedules a
+    background summary update once enough uncovered turns pile up.
+    """
+    with stage("history"):
+        entry = await _load_session(session_id, HISTORY_CACHE_MAX_MESSAGES)
+    summary = entry["summary"]
+
+    messages = entry["messages"]
+    if summary and summary.get("covered_until"):
+        covered_until = summary["covered_until"]
+        messages = [
+            m for m in messages
+            if m["timestamp"] is None or m["timestamp"] > covered_until
+        ]
+
+    budget = token_budget
+    if summary:
+        budget -= summary.get("tokens") or estimate_tokens(summary["summary"])
+
+    selected = []
+    for msg in reversed(messages):
+        if msg["tokens"] > budget:
+            break
+        selected.append(msg)
+        budget -= msg["tokens"]
+    selected.reverse()
+
+    if len(messages) >= HISTORY_SUMMARY_KEEP + 2 * HISTORY_SUMMARY_EVERY:
+        _schedule_summary(session_id)
+
+    return (summary["summary"] if summary else None), _public(selected)
+
+
+# ──────────────────────────── Rolling Summary ───────────────────
+
+_summarizing: set[str] = set()
+# Strong references: the loop only keeps weak ones to running tasks
+_summary_tasks: set[asyncio.Task] = set()
+
+
+def _schedule_summary(session_id: str):
+    if session_id in _summarizing:
+        return
+    _summarizing.add(session_id)
+    task = asyncio.get_running_loop().create_task(_update_summary(session_id))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_done)
+
+
+def _summary_done(task: asyncio.Task):
+    _summary_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[MEMORY ERROR] Tarea de resumen falló: {task.exception()!r}")
+
+
+async def _uncovered(session_id: str, covered_until: datetime | None, limit: int) -> List[Dict]:
+    """Up to `limit` of the oldest messages newer than covered_until"""
+    if SESSION_LAYOUT:
+        doc = await get_session_collection().find_one(
+            {"_id": session_id}, {"_id": 0, "messages": 1, "total": 1}
+        )
+        if not doc:
+            return []
+        messages = doc.get("messages") or []
+        # Turns archived since covered_until (e.g. a session migrated from
+        # the messages layout, or one that filled its document before its
+        # first summary) come before what the document holds
+        if doc.get("total", 0) > len(messages) and (
+            covered_until is None or not messages or messages[0]["timestamp"] > covered_until
+        ):
+            query = {"sessionID": session_id}
+            if covered_until:
+                query["last"] = {"$gt": covered_until}
+            archived: List[Dict] = []
+            cursor = get_archive_collection().find(query, {"_id": 0, "messages": 1}).sort("bucket", 1)
+            async for bucket in cursor:
+                archived += [
+                    m for m in bucket["messages"]
+                    if covered_until is None or m["timestamp"] > covered_until
+                ]
+                if len(archived) >= limit:
+                    return archived[:limit]
+            messages = archived + messages
+        return [
+            m for m in messages
+            if covered_until is None or m["timestamp"] > covered_until
+        ][:limit]
+
+    query = {"sessionID": session_id}
+    if covered_until:
+        query["timestamp"] = {"$gt": covered_until}
+    return await get_memory_collection().find(
+        query, {"_id": 0, "role": 1, "message": 1, "timestamp": 1}
+    ).sort("timestamp", 1).limit(limit).to_list(length=None)
+
+
+async def _update_summary(session_id: str):
+    """
+    Fold every message older than the newest HISTORY_SUMMARY_KEEP into the
+    session summary, at most HISTORY_SUMMARY_CHUNK per Gemini call (the
+    first summary of a long session takes several). Runs off the reply path.
+    """
+    from services.gemini_service import summarize_conversation
+    from services.admission import current_session
+
+    current_session.set(session_id)
+    # Off the reply path: keep these timings out of the triggering request
+    start_timings()
+    try:
+        summary = await _fetch_summary(session_id)
+        window = HISTORY_SUMMARY_CHUNK + HISTORY_SUMMARY_KEEP
+        folded = 0
+        while True:
+            covered_until = summary.get("covered_until") if summary else None
+            pending = await _uncovered(session_id, covered_until, window)
+
+            to_fold = pending[:len(pending) - HISTORY_SUMMARY_KEEP][:HISTORY_SUMMARY_CHUNK]
+            if not to_fold:
+                break
+
+            text = await summarize_conversation(
+                summary["summary"] if summary else None, to_fold
+            )
+            if not text:
+                break
+
+            # Saved per chunk: progress survives a failure further on
+            summary = {
+                "summary": text,
+                "covered_until": to_fold[-1]["timestamp"],
+                "tokens": estimate_tokens(text),
+            }
+            await get_summary_collection().update_one(
+                {"sessionID": session_id},
+                {"$set": {**summary, "updated_at": datetime.utcnow()}},
+                upsert=True,
+            )
+            if HISTORY_CACHE_ENABLED:
+                _set_cached_summary(session_id, summary)
+            folded += len(to_fold)
+            if len(pending) < window:
+                break
+
+        if folded:
+            print(f"[MEMORY] Resumen actualizado para {session_id} ({folded} mensajes)")
+    except Exception as e:
+        print(f"[MEMORY ERROR] No se pudo actualizar el resumen de {session_id}: {e}")
+    finally:
+        _summarizing.discard(session_id)
 
 
 async def clear_session_history(session_id: str):
@@ -61,5 +877,35 @@ async def clear_session_history(session_id: str):
     Args:
         session_id: Unique identifier for the conversation session
     """
-    col = get_memory_collection()
-    await col.delete_many({"sessionID": session_id})
+    # Forget queued messages (including any in the batch being written,
+    # should it fail and be re-queued) and let an in-flight flush finish
+    # first, so nothing of this session is written after the delete
+    _queue[:] = [item for item in _queue if item[0] != session_id]
+    if any(item[0] == session_id for item in _in_flight):
+        _cleared_in_flight.add(session_id)
+    _unflushed.pop(session_id, None)
+    async with _flush_lock:
+        if SESSION_LAYOUT:
+            deletes = [
+                get_session_collection().delete_one({"_id": session_id}),
+                get_archive_collection().delete_many({"sessionID": session_id}),
+            ]
+        else:
+            deletes = [get_memory_collection().delete_many({"sessionID": session_id})]
+        await asyncio.gather(
+            *deletes,
+            get_summary_collection().delete_one({"sessionID": session_id}),
+        )
+    if HISTORY_CACHE_ENABLED:
+        _store_entry(session_id, [], complete=True)
+
+
+def get_memory_stats() -> dict:
+    """Write/archive counters for the chat store"""
+    return {
+        **memory_stats,
+        "layout": "session" if SESSION_LAYOUT else "messages",
+        "session_max_messages": MEMORY_SESSION_MAX_MESSAGES if SESSION_LAYOUT else None,
+        "write_behind": MEMORY_WRITE_BEHIND,
+        "queued": len(_queue),
+    }
@@ -0,0 +1,180 @@
+"""
+In-process latency and token metrics in Prometheus format
+
+Histograms are aggregated in memory and rendered as Prometheus text on
+GET /metrics. stage() times a block into robert_stage_seconds{stage=...};
+inside a request that called start_timings() the same measurement is
+also appended to that request's timings list, which /chat returns next
+to its steps.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Seconds: from a cached Mongo read to a slow multi-step Gemini turn
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+STEP_BUCKETS = (1, 2, 3, 4, 5, 8)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...], buckets: tuple):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values → [bucket counts..., sum, count]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            base = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)]
+            for bound, count in zip(self.buckets, series):
+                le = ",".join(base + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{le}}} {count}")
+            le = ",".join(base + ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{{{le}}} {series[-1]}")
+            suffix = f"{{{','.join(base)}}}" if base else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-2]:.6g}")
+            lines.append(f"{self.name}_count{suffix} {series[-1]}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# ──────────────────────────── Metrics ───────────────────────────
+
+stage_seconds = Histogram(
+    "robert_stage_seconds",
+    "Latency of each stage of a turn (history, gemini, mongo, memory_save, telegram_send)",
+    ("stage", "detail"),
+    LATENCY_BUCKETS,
+)
+turn_seconds = Histogram(
+    "robert_turn_seconds",
+    "Latency of a whole agent turn by route",
+    ("route",),
+    LATENCY_BUCKETS,
+)
+agent_steps = Histogram(
+    "robert_agent_steps",
+    "Gemini calls per agent turn by route",
+    ("route",),
+    STEP_BUCKETS,
+)
+gemini_tokens = Histogram(
+    "robert_gemini_tokens",
+    "Tokens per Gemini call from usage_metadata (prompt, cached, output, thoughts)",
+    ("model", "kind"),
+    TOKEN_BUCKETS,
+)
+
+_registry = [stage_seconds, turn_seconds, agent_steps, gemini_tokens]
+
+
+# ──────────────────────────── Request Timings ───────────────────
+
+_timings: ContextVar[list | None] = ContextVar("request_timings", default=None)
+
+
+def start_timings(timings: list[dict] | None = None) -> list[dict]:
+    """
+    Start collecting stage timings for the current request (or resume an
+    existing list, e.g. inside a streaming response body). Returns the
+    list they are appended to; tasks spawned afterwards share it.
+    """
+    timings = [] if timings is None else timings
+    _timings.set(timings)
+    return timings
+
+
+def timings_mark() -> int:
+    """Position in the current request's timings (see timings_since)"""
+    timings = _timings.get()
+    return len(timings) if timings is not None else 0
+
+
+def timings_since(mark: int) -> list[dict]:
+    """Timings recorded in the current request after mark"""
+    timings = _timings.get()
+    return timings[mark:] if timings is not None else []
+
+
+# ──────────────────────────── Recording ─────────────────────────
+
+
+def observe_stage(name: str, seconds: float, detail: str = ""):
+    """Record one stage measurement (histogram + request timings)"""
+    stage_seconds.observe(seconds, stage=name, detail=detail)
+    timings = _timings.get()
+    if timings is not None:
+        entry = {"stage": name, "ms": round(seconds * 1000, 1)}
+        if detail:
+            entry["detail"] = detail
+        timings.append(entry)
+
+
+@contextmanager
+def stage(name: str, detail: str = ""):
+    """Time a block as a stage; recorded even if it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started, detail)
+
+
+def format_timings(timings: list[dict]) -> str:
+    """One-line per-stage totals for logs (history 12ms, gemini 2×840ms, ...)"""
+    totals: dict[str, list] = {}
+    for entry in timings:
+        total = totals.setdefault(entry["stage"], [0, 0.0])
+        total[0] += 1
+        total[1] += entry["ms"]
+    return ", ".join(
+        f"{name} {f'{n}×' if n > 1 else ''}{ms / n:.0f}ms" for name, (n, ms) in totals.items()
+    )
+
+
+def record_gemini_usage(model: str, usage):
+    """Token counts from a response's usage_metadata"""
+    if not usage:
+        return
+    counts = {
+        "prompt": usage.prompt_token_count,
+        "cached": usage.cached_content_token_count,
+        "output": usage.candidates_token_count,
+        "thoughts": getattr(usage, "thoughts_token_count", None),
+    }
+    for kind, count in counts.items():
+        if count:
+            gemini_tokens.observe(count, model=model, kind=kind)
+
+
+def record_turn(route: str, steps: int, seconds: float):
+    turn_seconds.observe(seconds, route=route)
+    agent_steps.observe(steps, route=route)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -1,38 +1,520 @@
 """
 MongoDB operations executor service
 """
+import asyncio
+import base64
+import copy
+import hashlib
 import json
-from bson import json_util
+import struct
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+import pymongo
+import bson
+from bson import ObjectId, Decimal128, Int64, Binary, Regex, Timestamp, Code, DBRef
+from pymongo.errors import PyMongoError
 
+from config.settings import (
+    MONGO_RESULT_CACHE,
+    MONGO_RESULT_CACHE_TTL,
+    MONGO_RESULT_CACHE_MAX_ENTRIES,
+    MONGO_RESULT_LIMIT,
+    MONGO_AGG_ALLOW_DISK_USE,
+)
 from models.schemas import MongoOperation, ActionEnum
 from database.mongodb import get_collection
+from services.query_guard import check_operation, record_execution, QueryRejectedError
+from services.rollup_service import get_rollup_collection, capture_before, apply_write
+from services.metrics import stage
 
 
 # ──────────────────────────── Utilities ─────────────────────────
 
 
+def _iso_datetime(value: datetime) -> str:
+    # PyMongo returns naive datetimes in UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec="milliseconds") + "Z"
+
+
+_D128_SIGN = 1 << 63
+_D128_LARGE_FORM = 0x6000000000000000  # also set for NaN/Infinity
+_D128_EXPONENT_BIAS = 6176
+
+
+def _decimal_number(value: Decimal128):
+    """
+    Decimal128 → float straight from the BID bits; Decimal128.to_decimal
+    goes through a digit tuple and is ~20x slower for money amounts.
+    """
+    low, high = struct.unpack("<QQ", value.bid)
+    if (high & _D128_LARGE_FORM) == _D128_LARGE_FORM:
+        d = value.to_decimal()
+        return float(d) if d.is_finite() else str(d)
+    exponent = ((high & 0x7FFF800000000000) >> 49) - _D128_EXPONENT_BIAS
+    significand = ((high & 0x0001FFFFFFFFFFFF) << 64) | low
+    try:
+        if exponent >= 0:
+            number = float(significand * 10 ** exponent)
+        else:
+            number = significand / 10 ** -exponent
+    except OverflowError:
+        return str(value.to_decimal())
+    return -number if high & _D128_SIGN else number
+
+
+_NATIVE = {str, int, float, bool, type(None)}
+
+
+def _convert_dict(doc) -> dict:
+    return {
+        k: v if type(v) in _NATIVE else _convert(v)
+        for k, v in doc.items()
+    }
+
+
+def _convert_list(items) -> list:
+    return [v if type(v) in _NATIVE else _convert(v) for v in items]
+
+# Exact-type dispatch keeps the common path to one dict lookup per value
+_CONVERTERS = {
+    dict: _convert_dict,
+    list: _convert_list,
+    tuple: _convert_list,
+    ObjectId: str,
+    datetime: _iso_datetime,
+    Decimal128: _decimal_number,
+    Int64: int,
+    uuid.UUID: str,
+    bytes: lambda v: base64.b64encode(v).decode("ascii"),
+    Binary: lambda v: base64.b64encode(v).decode("ascii"),
+    Regex: lambda v: v.pattern,
+    Timestamp: lambda v: _iso_datetime(v.as_datetime()),
+    Code: str,
+    DBRef: lambda v: {"$ref": v.collection, "$id": _convert(v.id)},
+}
+
+
+def _convert(value):
+    if type(value) in _NATIVE:
+        return value
+    converter = _CONVERTERS.get(type(value))
+    if converter is not None:
+        return converter(value)
+    # Subclasses (SON, RawBSONDocument, bool/int subclasses, aware datetimes...)
+    if isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, datetime):
+        return _iso_datetime(value)
+    if hasattr(value, "items"):
+        return _convert_dict(value)
+    if isinstance(value, (list, tuple)):
+        return _convert_list(value)
+    return str(value)
+
+
 def bson_to_json(doc):
-    """BSON → JSON-serializable."""
-    return json.loads(json_util.dumps(doc))
+    """
+    BSON → JSON-native values in a single pass.
+
+    ObjectId → hex string, datetime → ISO 8601 UTC string, Decimal128 →
+    number; no intermediate JSON text is produced.
+    """
+    return _convert(doc)
+
+
+def to_json_text(obj) -> str:
+    """Compact JSON text for the prompt (built once per result)"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+READ_ACTIONS = {
+    ActionEnum.find,
+    ActionEnum.find_one,
+    ActionEnum.aggregate,
+    ActionEnum.count,
+    ActionEnum.rollup,
+}
+WRITE_ACTIONS = {
+    ActionEnum.insert_one,
+    ActionEnum.insert_many,
+    ActionEnum.update_one,
+    ActionEnum.update_many,
+    ActionEnum.delete_one,
+    ActionEnum.delete_many,
+}
+
+# Aggregation stages that write to a collection
+_WRITE_STAGES = {"$out", "$merge"}
+
+
+def _pipeline_writes(pipeline) -> bool:
+    return any(
+        isinstance(stage, dict) and _WRITE_STAGES & stage.keys()
+        for stage in pipeline or []
+    )
+
+
+def is_write(op: MongoOperation) -> bool:
+    """True if the operation modifies data"""
+    return op.action in WRITE_ACTIONS or (
+        op.action == ActionEnum.aggregate and _pipeline_writes(op.pipeline)
+    )
+
+
+# ──────────────────────────── Result Cache ──────────────────────
+
+# (collection name, query hash) → (expires_at, result); LRU order
+_result_cache: "OrderedDict[tuple[str, str], tuple[float, object]]" = OrderedDict()
+
+result_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+}
+
+
+# Operators whose value is a list of query documents / a query document
+_QUERY_LISTS = {"$and", "$or", "$nor"}
+_QUERY_DOCS = {"$elemMatch"}
+
+
+def _canonical_query(query: dict) -> dict:
+    """
+    A query document with its keys sorted where MongoDB ignores their order:
+    field names, logical clauses and operator documents ({"$gte":..,"$lt":..}).
+    Embedded documents compared by equality keep their order, since
+    {"a": {"x": 1, "y": 2}} and {"a": {"y": 2, "x": 1}} match different docs.
+    """
+    canonical = {}
+    for key in sorted(query):
+        value = query[key]
+        if key in _QUERY_LISTS and isinstance(value, list):
+            value = [_canonical_query(q) if isinstance(q, dict) else q for q in value]
+        elif key in _QUERY_DOCS and isinstance(value, dict):
+            value = _canonical_query(value)
+        elif isinstance(value, dict) and value and all(str(k).startswith("$") for k in value):
+            value = _canonical_query(value)
+        canonical[key] = value
+    return canonical
+
+
+def _query_key(op: MongoOperation) -> str:
+    """
+    Canonical hash of a read operation.
+
+    Filter keys are sorted where their order doesn't change the match (see
+    _canonical_query); the pipeline keeps its order since stage and $sort
+    key order matter.
+    """
+    canonical = json.dumps(
+        {
+            "action": op.action.value,
+            "filter": _canonical_query(op.filter or {}),
+            "pipeline": op.pipeline or [],
+            "projection": sorted(op.projection or []),
+        },
+        default=str,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _cache_get(collection: str, key: str):
+    """Return (True, result) on a live hit, (False, None) otherwise. The
+    result is a copy: callers may mutate it without touching the cache"""
+    entry = _result_cache.get((collection, key))
+    if entry is None:
+        return False, None
+    expires_at, result = entry
+    if time.monotonic() > expires_at:
+        del _result_cache[(collection, key)]
+        return False, None
+    _result_cache.move_to_end((collection, key))
+    return True, copy.deepcopy(result)
+
+
+def _cache_put(collection: str, key: str, result):
+    _result_cache[(collection, key)] = (time.monotonic() + MONGO_RESULT_CACHE_TTL, copy.deepcopy(result))
+    _result_cache.move_to_end((collection, key))
+    while len(_result_cache) > MONGO_RESULT_CACHE_MAX_ENTRIES:
+        _result_cache.popitem(last=False)
+
+
+def invalidate_collection(collection: str):
+    """Drop every cached result for a collection"""
+    stale = [k for k in _result_cache if k[0] == collection]
+    for k in stale:
+        del _result_cache[k]
+    result_cache_stats["invalidations"] += 1
+
+
+def _hit_rate() -> float:
+    total = result_cache_stats["hits"] + result_cache_stats["misses"]
+    return round(result_cache_stats["hits"] / total, 4) if total else 0.0
+
+
+def get_result_cache_stats() -> dict:
+    """Hit-rate metrics for the read-result cache"""
+    return {
+        **result_cache_stats,
+        "enabled": MONGO_RESULT_CACHE,
+        "entries": len(_result_cache),
+        "hit_rate": _hit_rate(),
+    }
+
+
+# ──────────────────────────── Pushdown ──────────────────────────
+
+# Pipelines made only of these stages return whole documents
+_FIND_LIKE_STAGES = {"$match", "$sort", "$skip", "$limit"}
+
+# Stages that may need to spill to disk on large inputs
+_DISK_STAGES = {"$group", "$sort", "$bucket", "$bucketAuto", "$setWindowFields", "$sortByCount"}
+
+pushdown_stats = {
+    "limits_added": 0,
+    "projections_added": 0,
+    "disk_use": 0,
+    "transferred_bytes": 0,
+    "prompt_bytes": 0,
+}
+
+
+def _filter_fields(filt, fields: list):
+    """Field names a filter references (through $and/$or/$nor too)"""
+    if not isinstance(filt, dict):
+        return
+    for key, value in filt.items():
+        if key in ("$and", "$or", "$nor") and isinstance(value, list):
+            for sub in value:
+                _filter_fields(sub, fields)
+        elif not key.startswith("$") and key not in fields:
+            fields.append(key)
+
+
+def _stage_name(stage) -> str | None:
+    return next(iter(stage), None) if isinstance(stage, dict) and len(stage) == 1 else None
+
+
+def find_projection(op: MongoOperation) -> dict | None:
+    """Projection for the fields the model asked for plus the ones it filters on"""
+    if not op.projection:
+        return None
+    fields = list(op.projection)
+    _filter_fields(op.filter, fields)
+    return {field: 1 for field in fields}
+
+
+def rewrite_pipeline(op: MongoOperation) -> tuple[list, list[str]]:
+    """
+    Pipeline to send to the server and the list of rewrites applied:
+    a $project for requested fields on pipelines that return whole
+    documents, and a $limit when the model didn't set one.
+    """
+    pipeline = list(op.pipeline or [])
+    names = [_stage_name(stage) for stage in pipeline]
+    changes = []
+    if _pipeline_writes(pipeline):
+        return pipeline, changes
+
+    if "$limit" not in names:
+        pipeline.append({"$limit": MONGO_RESULT_LIMIT})
+        changes.append("limit")
+    if op.projection and all(name in _FIND_LIKE_STAGES for name in names):
+        fields = list(op.projection)
+        for stage in pipeline:
+            if "$match" in stage:
+                _filter_fields(stage["$match"], fields)
+            elif "$sort" in stage and isinstance(stage["$sort"], dict):
+                fields.extend(f for f in stage["$sort"] if f not in fields)
+        pipeline.append({"$project": {field: 1 for field in fields}})
+        changes.append("project")
+
+    return pipeline, changes
+
+
+def _needs_disk(pipeline: list) -> bool:
+    return any(_stage_name(stage) in _DISK_STAGES for stage in pipeline)
+
+
+# Documents re-encoded to estimate the bytes a read transferred
+_SIZE_SAMPLE = 8
+
+
+def _bson_size(docs) -> int:
+    """
+    Bytes the server sent for these documents, estimated from up to
+    _SIZE_SAMPLE evenly spaced ones: it only feeds a counter, so it must
+    not re-encode every document of every read
+    """
+    if isinstance(docs, dict):
+        return len(bson.encode(docs))
+    if len(docs) <= _SIZE_SAMPLE:
+        return sum(len(bson.encode(doc)) for doc in docs)
+    step = len(docs) / _SIZE_SAMPLE
+    sampled = sum(len(bson.encode(docs[int(i * step)])) for i in range(_SIZE_SAMPLE))
+    return round(sampled * len(docs) / _SIZE_SAMPLE)
+
+
+def record_prompt_bytes(op_info: dict | None, text: str):
+    """Bytes of a result as it goes into the prompt"""
+    size = len(text.encode("utf-8"))
+    pushdown_stats["prompt_bytes"] += size
+    if op_info is not None:
+        op_info["prompt_bytes"] = size
+
+
+def get_pushdown_stats() -> dict:
+    """Rewrites applied and bytes moved (server → app → prompt)"""
+    stats = dict(pushdown_stats)
+    if stats["transferred_bytes"]:
+        stats["prompt_ratio"] = round(stats["prompt_bytes"] / stats["transferred_bytes"], 4)
+    return stats
 
 
 # ──────────────────────────── MongoDB Executor ──────────────────
 
 
-async def execute_operation(op: MongoOperation) -> list | dict | None:
+async def execute_operation(op: MongoOperation, op_info: dict | None = None) -> list | dict | None:
     """
     Execute MongoDB operation based on the LLM-generated operation schema
+
+    Reads are served from the result cache when possible; writes
+    invalidate the collection's cached results. Everything else passes
+    the query guard first and runs under a maxTimeMS budget; rejected or
+    timed-out operations return an {"error", "sugerencia"} result the
+    model can react to. If op_info is given it is filled with the cache
+    outcome, the running hit rate and the query plan.
+    """
+    with stage("mongo", op.action.value):
+        return await _execute_operation(op, op_info)
+
+
+async def _execute_operation(op: MongoOperation, op_info: dict | None) -> list | dict | None:
+    col = get_rollup_collection() if op.action == ActionEnum.rollup else get_collection()
+    writes = is_write(op)
+    cacheable = MONGO_RESULT_CACHE and op.action in READ_ACTIONS and not writes
+
+    key = None
+    if cacheable:
+        key = _query_key(op)
+        hit, cached = _cache_get(col.name, key)
+        if hit:
+            result_cache_stats["hits"] += 1
+            if op_info is not None:
+                op_info.update({"cache": "hit", "cache_hit_rate": _hit_rate()})
+            return cached
+        result_cache_stats["misses"] += 1
+
+    try:
+        guard = await check_operation(col, op, writes)
+    except QueryRejectedError as e:
+        print(f"[QUERY GUARD] Operación rechazada: {e}")
+        if op_info is not None:
+            op_info["guard"] = "rejected"
+        return {"error": str(e), "sugerencia": e.hint}
+
+    started = time.perf_counter()
+    try:
+        # Client-side operation timeout: pymongo sends it as maxTimeMS
+        with pymongo.timeout(guard["max_time_ms"] / 1000):
+            before = await capture_before(col, op) if writes else None
+            result = await _run_operation(col, op, op_info)
+    except PyMongoError as e:
+        if not e.timeout:
+            raise
+        record_execution(guard["shape"], (time.perf_counter() - started) * 1000, timed_out=True)
+        if op_info is not None:
+            op_info["guard"] = f"{guard['verdict']}, timeout"
+        return {
+            "error": f"La consulta superó el tiempo máximo ({guard['max_time_ms']} ms).",
+            "sugerencia": "Acota la consulta con filtros más selectivos.",
+        }
+    record_execution(guard["shape"], (time.perf_counter() - started) * 1000)
+    if op_info is not None:
+        op_info["plan"] = guard["plan"]
+        if guard["verdict"] != "allowed":
+            op_info["guard"] = guard["verdict"]
+
+    if writes:
+        invalidate_collection(col.name)
+        await apply_write(col, op, before)
+    elif cacheable:
+        _cache_put(col.name, key, result)
+
+    if op_info is not None:
+        op_info["cache"] = "miss" if cacheable else ("invalidate" if writes else "off")
+        op_info["cache_hit_rate"] = _hit_rate()
+    return result
+
+
+async def execute_operations(
+    ops: list[MongoOperation], op_infos: list[dict] | None = None
+) -> list:
+    """
+    Execute several operations from one agent step.
+
+    Consecutive reads run concurrently; each write waits for everything
+    before it and runs alone, so writes keep their requested order.
+    Results come back in the same order as ops.
     """
-    col = get_collection()
+    infos = op_infos if op_infos is not None else [{} for _ in ops]
+    results = [None] * len(ops)
+
+    batch: list[int] = []
+
+    async def flush():
+        gathered = await asyncio.gather(
+            *(execute_operation(ops[i], infos[i]) for i in batch)
+        )
+        for i, result in zip(batch, gathered):
+            results[i] = result
+        batch.clear()
+
+    for i, op in enumerate(ops):
+        if is_write(op):
+            if batch:
+                await flush()
+            results[i] = await execute_operation(op, infos[i])
+        else:
+            batch.append(i)
+    if batch:
+        await flush()
+
+    return results
+
+
+def _record_transfer(op_info: dict | None, docs, changes: list[str] | None = None):
+    size = _bson_size(docs) if docs else 0
+    pushdown_stats["transferred_bytes"] += size
+    if op_info is not None:
+        op_info["transferred_bytes"] = size
+        if changes:
+            op_info["pushdown"] = changes
+
+
+async def _run_operation(col, op: MongoOperation, op_info: dict | None = None) -> list | dict | None:
     filt = op.filter or {}
 
     match op.action:
         case ActionEnum.find:
-            docs = await col.find(filt).to_list(length=100)
+            projection = find_projection(op)
+            changes = ["limit"] + (["project"] if projection else [])
+            pushdown_stats["limits_added"] += 1
+            pushdown_stats["projections_added"] += bool(projection)
+            docs = await col.find(filt, projection).limit(MONGO_RESULT_LIMIT).to_list(length=None)
+            _record_transfer(op_info, docs, changes)
             return bson_to_json(docs)
 
         case ActionEnum.find_one:
-            doc = await col.find_one(filt)
+            projection = find_projection(op)
+            pushdown_stats["projections_added"] += bool(projection)
+            doc = await col.find_one(filt, projection)
+            _record_transfer(op_info, doc, ["project"] if projection else None)
             return bson_to_json(doc) if doc else None
 
         case ActionEnum.insert_one:
@@ -60,11 +542,34 @@ async def execute_operation(op: MongoOperation) -> list | dict | None:
             return {"deleted": r.deleted_count}
 
         case ActionEnum.aggregate:
-            docs = await col.aggregate(op.pipeline or []).to_list(length=100)
+            pipeline, changes = rewrite_pipeline(op)
+            pushdown_stats["limits_added"] += "limit" in changes
+            pushdown_stats["projections_added"] += "project" in changes
+            options = {}
+            if MONGO_AGG_ALLOW_DISK_USE and _needs_disk(pipeline):
+                options["allowDiskUse"] = True
+                pushdown_stats["disk_use"] += 1
+                changes.append("allowDiskUse")
+            docs = await col.aggregate(pipeline, **options).to_list(length=MONGO_RESULT_LIMIT)
+            _record_transfer(op_info, docs, changes)
             return bson_to_json(docs)
 
         case ActionEnum.count:
             return {"count": await col.count_documents(filt)}
 
+        case ActionEnum.rollup:
+            if _pipeline_writes(op.pipeline):
+                return {"error": "rollup es de solo lectura"}
+            if op.pipeline:
+                pipeline, changes = rewrite_pipeline(op)
+                docs = await col.aggregate(pipeline).to_list(length=MONGO_RESULT_LIMIT)
+            else:
+                changes = ["limit"]
+                docs = await col.find(filt, {"_id": 0, "updated_at": 0}).sort(
+                    "total", -1
+                ).limit(MONGO_RESULT_LIMIT).to_list(length=None)
+            _record_transfer(op_info, docs, changes)
+            return bson_to_json(docs)
+
         case _:
             return None
@@ -0,0 +1,406 @@
+"""
+Query guard and index advisor for model-generated MongoDB operations
+
+Before an operation runs, its query shape (the filter/pipeline with
+values replaced by placeholders) is explained once and the plan cached
+per shape. Server-side JavaScript is always refused; a COLLSCAN over a
+collection larger than QUERY_GUARD_COLLSCAN_MAX_DOCS is refused or run
+under a tighter time budget depending on QUERY_GUARD_MODE. Every shape
+seen is kept for the advisor report, which suggests the index that would
+serve it.
+"""
+import hashlib
+import json
+import time
+import pymongo
+
+from config.settings import (
+    MONGO_MAX_TIME_MS,
+    QUERY_GUARD_MODE,
+    QUERY_GUARD_COLLSCAN_MAX_DOCS,
+    QUERY_GUARD_SCAN_MAX_TIME_MS,
+    QUERY_GUARD_PLAN_TTL,
+)
+from models.schemas import MongoOperation, ActionEnum
+
+# Operators that run JavaScript on the server
+_JS_OPERATORS = {"$where", "$function", "$accumulator"}
+
+_RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte", "$ne", "$nin", "$exists", "$regex"}
+
+_COUNT_TTL = 60
+
+
+class QueryRejectedError(Exception):
+    """The guard refused to run an operation"""
+
+    def __init__(self, message: str, hint: str | None = None):
+        super().__init__(message)
+        self.hint = hint
+
+
+# ──────────────────────────── State ─────────────────────────────
+
+# shape key → {"plan": ..., "index": ..., "checked_at": ...}
+_plans: dict[str, dict] = {}
+
+# shape key → usage record for the advisor
+_shapes: dict[str, dict] = {}
+
+# collection name → (checked_at, estimated document count)
+_doc_counts: dict[str, tuple[float, int]] = {}
+
+# collection name → (checked_at, index_information())
+_index_info: dict[str, tuple[float, dict]] = {}
+
+guard_stats = {
+    "explains": 0,
+    "plan_hits": 0,
+    "rejected": 0,
+    "restricted": 0,
+    "timeouts": 0,
+}
+
+
+# ──────────────────────────── Shapes ────────────────────────────
+
+
+def _shape(value):
+    """Structure of a filter/pipeline with literal values replaced by '?'"""
+    if isinstance(value, dict):
+        shaped = {}
+        for key, v in value.items():
+            if key == "$regex" and isinstance(v, str):
+                shaped[key] = "anchored" if v.startswith("^") else "unanchored"
+            elif key == "$sort" and isinstance(v, dict):
+                # Sort directions are part of the shape
+                shaped[key] = v
+            else:
+                shaped[key] = _shape(v)
+        return shaped
+    if isinstance(value, list):
+        if any(isinstance(v, (dict, list)) for v in value):
+            return [_shape(v) for v in value]
+        return ["?"]
+    return "?"
+
+
+def query_shape(op: MongoOperation) -> dict:
+    shape = {"action": op.action.value}
+    if op.action == ActionEnum.aggregate or (op.action == ActionEnum.rollup and op.pipeline):
+        shape["pipeline"] = _shape(op.pipeline or [])
+    else:
+        shape["filter"] = _shape(op.filter or {})
+    return shape
+
+
+def shape_key(shape: dict) -> str:
+    canonical = json.dumps(shape, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+def _uses_javascript(value) -> bool:
+    if isinstance(value, dict):
+        return any(k in _JS_OPERATORS or _uses_javascript(v) for k, v in value.items())
+    if isinstance(value, list):
+        return any(_uses_javascript(v) for v in value)
+    return False
+
+
+# ──────────────────────────── Plans ─────────────────────────────
+
+
+def _winning_plans(doc):
+    if isinstance(doc, dict):
+        for key, value in doc.items():
+            if key == "winningPlan":
+                yield value
+            elif key != "rejectedPlans":
+                yield from _winning_plans(value)
+    elif isinstance(doc, list):
+        for value in doc:
+            yield from _winning_plans(value)
+
+
+def _plan_nodes(plan):
+    """Every stage node of a winning plan (classic or SBE queryPlan)"""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan
+        for key, value in plan.items():
+            if key != "slotBasedPlan":
+                yield from _plan_nodes(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_nodes(value)
+
+
+def summarize_plan(explain: dict) -> dict:
+    """{"plan": "COLLSCAN"|"IXSCAN"|..., "index": name|None} from explain output"""
+    stages, index = set(), None
+    for plan in _winning_plans(explain):
+        for node in _plan_nodes(plan):
+            stages.add(node["stage"])
+            index = index or node.get("indexName")
+    if "COLLSCAN" in stages:
+        plan = "COLLSCAN"
+    elif "IXSCAN" in stages or "IDHACK" in stages or "EXPRESS_IXSCAN" in stages:
+        plan = "IXSCAN"
+    elif "EOF" in stages:
+        plan = "EOF"
+    else:
+        # An aggregation with no leading $match reads the whole collection
+        plan = "COLLSCAN" if explain and not stages else "UNKNOWN"
+    return {"plan": plan, "index": index}
+
+
+def _explain_command(col, op: MongoOperation) -> dict | None:
+    if op.action == ActionEnum.aggregate or (op.action == ActionEnum.rollup and op.pipeline):
+        return {"aggregate": col.name, "pipeline": op.pipeline or [], "cursor": {}}
+    if op.action == ActionEnum.count:
+        return {"count": col.name, "query": op.filter or {}}
+    if op.action in (ActionEnum.insert_one, ActionEnum.insert_many):
+        return None
+    # find/find_one/update/delete: the filter decides the plan
+    return {"find": col.name, "filter": op.filter or {}}
+
+
+async def _plan_for(col, op: MongoOperation, key: str) -> dict:
+    cached = _plans.get(key)
+    if cached and time.monotonic() - cached["checked_at"] < QUERY_GUARD_PLAN_TTL:
+        guard_stats["plan_hits"] += 1
+        return cached
+
+    command = _explain_command(col, op)
+    if command is None:
+        return {"plan": "NONE", "index": None}
+
+    try:
+        with pymongo.timeout(MONGO_MAX_TIME_MS / 1000):
+            explain = await col.database.command("explain", command, verbosity="queryPlanner")
+    except Exception as e:
+        # Let the operation itself report invalid queries
+        print(f"[QUERY GUARD] explain falló: {e}")
+        return {"plan": "UNKNOWN", "index": None}
+
+    guard_stats["explains"] += 1
+    plan = {**summarize_plan(explain), "checked_at": time.monotonic()}
+    _plans[key] = plan
+    return plan
+
+
+async def _doc_count(col) -> int:
+    cached = _doc_counts.get(col.name)
+    if cached and time.monotonic() - cached[0] < _COUNT_TTL:
+        return cached[1]
+    count = await col.estimated_document_count()
+    _doc_counts[col.name] = (time.monotonic(), count)
+    return count
+
+
+async def _indexes(col) -> dict:
+    cached = _index_info.get(col.name)
+    if cached and time.monotonic() - cached[0] < _COUNT_TTL:
+        return cached[1]
+    try:
+        indexes = await col.index_information()
+    except Exception as e:
+        print(f"[QUERY GUARD] No pude leer los índices: {e}")
+        return {}
+    _index_info[col.name] = (time.monotonic(), indexes)
+    return indexes
+
+
+# ──────────────────────────── Guard ─────────────────────────────
+
+
+def _record_shape(key: str, shape: dict, plan: dict, verdict: str):
+    entry = _shapes.setdefault(key, {
+        "shape": shape,
+        "count": 0,
+        "executions": 0,
+        "total_ms": 0.0,
+        "timeouts": 0,
+        "verdicts": {},
+    })
+    entry["count"] += 1
+    entry["plan"] = plan["plan"]
+    entry["index"] = plan["index"]
+    entry["last_seen"] = time.time()
+    entry["verdicts"][verdict] = entry["verdicts"].get(verdict, 0) + 1
+
+
+async def _scan_hint(col) -> str:
+    """Tell the model which fields can be filtered on cheaply"""
+    fields = []
+    for info in (await _indexes(col)).values():
+        for field, _ in info.get("key", []):
+            if field != "_id" and field not in fields:
+                fields.append(field)
+    if fields:
+        return f"Filtra por campos indexados ({', '.join(fields)}) o acota por fecha."
+    return "Acota la consulta (por ejemplo por fecha) o usa una agregación más selectiva."
+
+
+async def check_operation(col, op: MongoOperation, writes: bool = False) -> dict:
+    """
+    Decide how an operation may run.
+
+    Returns {"shape": key, "plan", "index", "verdict", "max_time_ms"}.
+    Raises QueryRejectedError for server-side JavaScript or, in "reject"
+    mode (and for writes in "rewrite" mode), for large COLLSCANs.
+    """
+    shape = query_shape(op)
+    key = shape_key(shape)
+
+    if QUERY_GUARD_MODE == "off":
+        return {
+            "shape": key,
+            "plan": "UNCHECKED",
+            "index": None,
+            "verdict": "allowed",
+            "max_time_ms": MONGO_MAX_TIME_MS,
+        }
+
+    if _uses_javascript(op.filter) or _uses_javascript(op.pipeline):
+        guard_stats["rejected"] += 1
+        _record_shape(key, shape, {"plan": "UNCHECKED", "index": None}, "rejected")
+        raise QueryRejectedError(
+            "No se permite JavaScript en consultas ($where, $function, $accumulator).",
+            "Usa operadores de consulta normales o $expr.",
+        )
+
+    plan = await _plan_for(col, op, key)
+    verdict, max_time_ms = "allowed", MONGO_MAX_TIME_MS
+
+    if plan["plan"] == "COLLSCAN" and QUERY_GUARD_MODE != "report":
+        docs = await _doc_count(col)
+        if docs > QUERY_GUARD_COLLSCAN_MAX_DOCS:
+            if QUERY_GUARD_MODE == "reject" or writes:
+                guard_stats["rejected"] += 1
+                _record_shape(key, shape, plan, "rejected")
+                raise QueryRejectedError(
+                    f"La consulta recorrería toda la colección ({docs} documentos).",
+                    await _scan_hint(col),
+                )
+            guard_stats["restricted"] += 1
+            verdict, max_time_ms = "restricted", min(MONGO_MAX_TIME_MS, QUERY_GUARD_SCAN_MAX_TIME_MS)
+
+    _record_shape(key, shape, plan, verdict)
+    return {
+        "shape": key,
+        "plan": plan["plan"],
+        "index": plan["index"],
+        "verdict": verdict,
+        "max_time_ms": max_time_ms,
+    }
+
+
+def record_execution(key: str, elapsed_ms: float, timed_out: bool = False):
+    entry = _shapes.get(key)
+    if entry is None:
+        return
+    entry["executions"] += 1
+    entry["total_ms"] += elapsed_ms
+    if timed_out:
+        entry["timeouts"] += 1
+        guard_stats["timeouts"] += 1
+
+
+# ──────────────────────────── Advisor ───────────────────────────
+
+
+def _filter_fields(filt, equality: list, ranges: list):
+    """Split top-level filter fields into equality and range predicates"""
+    if not isinstance(filt, dict):
+        return
+    for field, cond in filt.items():
+        if field == "$and" and isinstance(cond, list):
+            for sub in cond:
+                _filter_fields(sub, equality, ranges)
+        elif field.startswith("$"):
+            continue
+        elif isinstance(cond, dict) and any(k.startswith("$") for k in cond):
+            if "$eq" in cond or "$in" in cond:
+                equality.append(field)
+            elif _RANGE_OPERATORS & cond.keys():
+                ranges.append(field)
+        else:
+            equality.append(field)
+
+
+def suggest_index(shape: dict) -> list[tuple[str, int]]:
+    """
+    Index keys for a shape following equality → sort → range order.
+    Empty if the shape filters on nothing.
+    """
+    equality, ranges, sort = [], [], {}
+    if "pipeline" in shape:
+        stages = shape["pipeline"] if isinstance(shape["pipeline"], list) else []
+        for stage in stages:
+            if not isinstance(stage, dict):
+                break
+            if "$match" in stage:
+                _filter_fields(stage["$match"], equality, ranges)
+            elif "$sort" in stage and isinstance(stage["$sort"], dict):
+                sort = stage["$sort"]
+                break
+            else:
+                break
+    else:
+        _filter_fields(shape.get("filter"), equality, ranges)
+
+    keys, seen = [], set()
+    for field in equality + list(sort) + ranges:
+        if field not in seen:
+            seen.add(field)
+            direction = sort.get(field, 1) if field not in equality else 1
+            keys.append((field, direction if direction in (1, -1) else 1))
+    return keys
+
+
+def _covered(keys: list[tuple[str, int]], indexes: dict) -> str | None:
+    """Name of an existing index whose key prefix already matches keys"""
+    wanted = [field for field, _ in keys]
+    for name, info in indexes.items():
+        fields = [field for field, _ in info.get("key", [])]
+        if wanted and fields[:len(wanted)] == wanted:
+            return name
+    return None
+
+
+async def get_advisor_report(col) -> dict:
+    """
+    Query shapes the model has used, most frequent first, with their
+    plan and the index that would serve them
+    """
+    _index_info.pop(col.name, None)
+    indexes = await _indexes(col)
+
+    shapes = []
+    for key, entry in sorted(_shapes.items(), key=lambda kv: -kv[1]["count"]):
+        keys = suggest_index(entry["shape"])
+        existing = _covered(keys, indexes)
+        shapes.append({
+            "shape_id": key,
+            "shape": entry["shape"],
+            "count": entry["count"],
+            "executions": entry["executions"],
+            "avg_ms": round(entry["total_ms"] / entry["executions"], 1) if entry["executions"] else None,
+            "timeouts": entry["timeouts"],
+            "plan": entry.get("plan"),
+            "index_used": entry.get("index"),
+            "verdicts": entry["verdicts"],
+            "suggested_index": dict(keys) if keys else None,
+            "covered_by": existing,
+            "needs_index": bool(keys) and existing is None and entry.get("plan") == "COLLSCAN",
+        })
+
+    return {
+        "collection": col.name,
+        "mode": QUERY_GUARD_MODE,
+        "collscan_max_docs": QUERY_GUARD_COLLSCAN_MAX_DOCS,
+        "existing_indexes": {name: info.get("key") for name, info in indexes.items()},
+        "shapes": shapes,
+        "stats": {**guard_stats, "cached_plans": len(_plans)},
+    }
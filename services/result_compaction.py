@@ -0,0 +1,146 @@
+"""
+Compaction of MongoDB results before they go back into the prompt
+
+The raw result stays in the step log; the model gets a bounded view
+(row count, field schema, first rows, numeric aggregates), and results
+from earlier steps are reduced to a single line.
+"""
+import json
+
+from config.settings import (
+    RESULT_COMPACT_THRESHOLD,
+    RESULT_SAMPLE_ROWS,
+    RESULT_MAX_STRING,
+)
+
+# Names of fields left out of a compacted document, at most
+MAX_OMITTED_FIELDS = 50
+
+
+# ──────────────────────────── Utilities ─────────────────────────
+
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _type_name(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, dict):
+        return "object"
+    return type(value).__name__
+
+
+def _truncate(value):
+    """Shorten long strings (recursively) so one field can't flood the prompt"""
+    if isinstance(value, str) and len(value) > RESULT_MAX_STRING:
+        return value[:RESULT_MAX_STRING] + "…"
+    if isinstance(value, list):
+        return [_truncate(v) for v in value[:RESULT_SAMPLE_ROWS]]
+    if isinstance(value, dict):
+        return {k: _truncate(v) for k, v in value.items()}
+    return value
+
+
+def _field_schema(rows: list[dict]) -> dict:
+    schema: dict[str, set] = {}
+    for row in rows:
+        for key, value in row.items():
+            schema.setdefault(key, set()).add(_type_name(value))
+    return {k: "|".join(sorted(v)) for k, v in schema.items()}
+
+
+def _numeric_aggregates(rows: list[dict]) -> dict:
+    values: dict[str, list[float]] = {}
+    for row in rows:
+        for key, value in row.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values.setdefault(key, []).append(value)
+    return {
+        key: {
+            "min": min(nums),
+            "max": max(nums),
+            "sum": round(sum(nums), 4),
+            "avg": round(sum(nums) / len(nums), 4),
+        }
+        for key, nums in values.items()
+    }
+
+
+def _fit_fields(doc: dict, budget: int) -> tuple[dict, list[str]]:
+    """Keep the fields of doc (in order) whose JSON fits in budget chars"""
+    kept, omitted, size = {}, [], 0
+    for key, value in doc.items():
+        field_size = len(_dumps({key: value}))
+        if size + field_size > budget:
+            omitted.append(key)
+            continue
+        kept[key] = value
+        size += field_size
+    return kept, omitted
+
+
+# ──────────────────────────── Compaction ────────────────────────
+
+
+def compact_result(result, raw: str | None = None) -> str:
+    """
+    JSON text to show the model for an operation result.
+
+    Small results are returned verbatim; above RESULT_COMPACT_THRESHOLD
+    characters, lists of documents become a bounded summary and a single
+    document (find_one) gets its long fields shortened and, if still too
+    big, only the fields that fit. Pass raw (the result's JSON text) if it
+    was already serialized.
+    """
+    if raw is None:
+        raw = _dumps(result)
+    if len(raw) <= RESULT_COMPACT_THRESHOLD:
+        return raw
+    if isinstance(result, dict):
+        return _compact_document(result)
+    if not isinstance(result, list):
+        return raw
+
+    rows = [r for r in result if isinstance(r, dict)]
+    compact = {
+        "compactado": True,
+        "total_filas": len(result),
+        "campos": _field_schema(rows),
+        "primeras_filas": [_truncate(r) for r in result[:RESULT_SAMPLE_ROWS]],
+        "agregados": _numeric_aggregates(rows),
+    }
+    return _dumps(compact)
+
+
+def _compact_document(doc: dict) -> str:
+    truncated = _truncate(doc)
+    kept, omitted = _fit_fields(truncated, RESULT_COMPACT_THRESHOLD)
+    compact = {
+        "compactado": True,
+        "total_campos": len(doc),
+        "documento": kept,
+    }
+    if omitted:
+        compact["campos_omitidos"] = omitted[:MAX_OMITTED_FIELDS]
+    return _dumps(compact)
+
+
+def summarize_result(action: str, result) -> str:
+    """One-line description of a result the model has already analysed"""
+    if isinstance(result, list):
+        rows = [r for r in result if isinstance(r, dict)]
+        fields = ", ".join(list(_field_schema(rows))[:8])
+        return f"{action}: {len(result)} filas (campos: {fields})"
+    if isinstance(result, dict):
+        return f"{action}: {_dumps(_truncate(result))[:RESULT_MAX_STRING]}"
+    return f"{action}: sin resultados"
@@ -0,0 +1,278 @@
+"""
+Materialized spending rollups
+
+Pre-aggregated totals (per month, per business per month, per category
+per month) live in ROLLUP_COLLECTION next to the data. Writes that go
+through mongo_service.execute_operation update them incrementally: the
+affected documents are read before and after the write and the
+difference is applied with $inc. rebuild_rollups() recomputes everything
+from the data collection (backfills, or data written by other apps):
+
+    python -m tools.rebuild_rollups
+"""
+import re
+import time
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from bson import Decimal128
+from pymongo import UpdateOne
+
+from config.settings import (
+    DB_NAME,
+    ROLLUPS_ENABLED,
+    ROLLUP_COLLECTION,
+    ROLLUP_BUSINESS_FIELD,
+    ROLLUP_CATEGORY_FIELD,
+    ROLLUP_AMOUNT_FIELD,
+    ROLLUP_DATE_FIELD,
+    ROLLUP_MAX_TRACKED,
+)
+from models.schemas import MongoOperation, ActionEnum
+import database.mongodb as db
+
+# Rollup name → dimensions it groups by ("mes" is derived from the date)
+ROLLUPS = {
+    "mes": ["mes"],
+    "negocio_mes": [ROLLUP_BUSINESS_FIELD, "mes"],
+    "categoria_mes": [ROLLUP_CATEGORY_FIELD, "mes"],
+}
+
+_MONTH_PATTERN = re.compile(r"^\d{4}-\d{2}")
+
+rollup_stats = {
+    "incremental_writes": 0,
+    "docs_applied": 0,
+    "keys_updated": 0,
+    "skipped_large_writes": 0,
+    "errors": 0,
+    "rebuilds": 0,
+    "last_rebuild": None,
+    "stale": False,
+}
+
+
+def get_rollup_collection():
+    """Get the rollups collection (same database as the data)"""
+    return db.db_client[DB_NAME][ROLLUP_COLLECTION]
+
+
+async def ensure_rollup_indexes():
+    """Indexes for the rollup lookups the model makes (idempotent)"""
+    col = get_rollup_collection()
+    await col.create_index([("rollup", 1), ("mes", -1)], name="rollup_mes")
+    await col.create_index([("rollup", 1), ("total", -1)], name="rollup_total")
+
+
+# ──────────────────────────── Keys ──────────────────────────────
+
+
+def _month(value) -> str | None:
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m")
+    if isinstance(value, str) and _MONTH_PATTERN.match(value):
+        return value[:7]
+    return None
+
+
+def _amount(value) -> Decimal:
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    if isinstance(value, bool) or value is None:
+        return Decimal(0)
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        return Decimal(0)
+
+
+def _rollup_keys(doc: dict) -> list[tuple[str, dict]]:
+    """(rollup name, dimension values) for every rollup a document feeds"""
+    month = _month(doc.get(ROLLUP_DATE_FIELD))
+    if month is None:
+        return []
+    values = {"mes": month}
+    keys = []
+    for name, dims in ROLLUPS.items():
+        dim_values = {}
+        for dim in dims:
+            value = values.get(dim, doc.get(dim))
+            if value is None or isinstance(value, (dict, list)):
+                break
+            dim_values[dim] = value
+        else:
+            keys.append((name, dim_values))
+    return keys
+
+
+def _tracked_projection() -> dict:
+    fields = {ROLLUP_AMOUNT_FIELD, ROLLUP_DATE_FIELD, ROLLUP_BUSINESS_FIELD, ROLLUP_CATEGORY_FIELD}
+    return {field: 1 for field in fields}
+
+
+# ──────────────────────────── Incremental ───────────────────────
+
+
+async def _apply(deltas: list[tuple[dict, int]]):
+    """$inc the rollups for (document, +1/-1) pairs, merged per key"""
+    merged: dict[tuple, list] = {}
+    for doc, sign in deltas:
+        amount = _amount(doc.get(ROLLUP_AMOUNT_FIELD)) * sign
+        for name, dims in _rollup_keys(doc):
+            key = (name, *((d, repr(v)) for d, v in dims.items()))
+            entry = merged.setdefault(key, [name, dims, Decimal(0), 0])
+            entry[2] += amount
+            entry[3] += sign
+
+    requests, ids = [], []
+    now = datetime.now(timezone.utc)
+    for name, dims, total, count in merged.values():
+        if total == 0 and count == 0:
+            continue
+        _id = {"rollup": name, **dims}
+        ids.append(_id)
+        requests.append(UpdateOne(
+            {"_id": _id},
+            {
+                "$inc": {"total": Decimal128(total), "count": count},
+                "$set": {"rollup": name, **dims, "updated_at": now},
+            },
+            upsert=True,
+        ))
+    if not requests:
+        return
+
+    col = get_rollup_collection()
+    await col.bulk_write(requests, ordered=False)
+    # Keys whose last document went away
+    await col.delete_many({"_id": {"$in": ids}, "count": {"$lte": 0}})
+    rollup_stats["keys_updated"] += len(requests)
+
+    from services.mongo_service import invalidate_collection
+    invalidate_collection(col.name)
+
+
+async def capture_before(col, op: MongoOperation) -> list[dict] | None:
+    """
+    Documents an update/delete is about to touch (tracked fields only).
+    None means too many to track incrementally.
+    """
+    if not ROLLUPS_ENABLED or op.action in (ActionEnum.insert_one, ActionEnum.insert_many):
+        return []
+    filt = op.filter or {}
+    projection = _tracked_projection()
+    if op.action in (ActionEnum.update_one, ActionEnum.delete_one):
+        doc = await col.find_one(filt, projection)
+        return [doc] if doc else []
+    docs = await col.find(filt, projection).to_list(length=ROLLUP_MAX_TRACKED + 1)
+    return None if len(docs) > ROLLUP_MAX_TRACKED else docs
+
+
+async def apply_write(col, op: MongoOperation, before: list[dict] | None):
+    """Update the rollups after a write went through execute_operation"""
+    if not ROLLUPS_ENABLED:
+        return
+    if before is None:
+        rollup_stats["skipped_large_writes"] += 1
+        rollup_stats["stale"] = True
+        print("[ROLLUPS] Escritura demasiado grande para actualizar incrementalmente; ejecuta tools.rebuild_rollups")
+        return
+
+    try:
+        match op.action:
+            case ActionEnum.insert_one:
+                after = [op.data] if isinstance(op.data, dict) else []
+            case ActionEnum.insert_many:
+                after = [d for d in op.data or [] if isinstance(d, dict)]
+            case ActionEnum.update_one | ActionEnum.update_many:
+                ids = [doc["_id"] for doc in before]
+                after = await col.find({"_id": {"$in": ids}}, _tracked_projection()).to_list(
+                    length=None
+                ) if ids else []
+            case _:
+                after = []
+
+        deltas = [(doc, -1) for doc in before] + [(doc, 1) for doc in after]
+        await _apply(deltas)
+        rollup_stats["incremental_writes"] += 1
+        rollup_stats["docs_applied"] += len(deltas)
+    except Exception as e:
+        rollup_stats["errors"] += 1
+        rollup_stats["stale"] = True
+        print(f"[ROLLUPS ERROR] No se pudieron actualizar los resúmenes: {e}")
+
+
+# ──────────────────────────── Rebuild ───────────────────────────
+
+
+def _rebuild_pipeline(name: str, dims: list[str], stamp: datetime) -> list:
+    date = f"${ROLLUP_DATE_FIELD}"
+    month = {
+        "$switch": {
+            "branches": [
+                {"case": {"$eq": [{"$type": date}, "date"]},
+                 "then": {"$dateToString": {"format": "%Y-%m", "date": date}}},
+                {"case": {"$eq": [{"$type": date}, "string"]},
+                 "then": {"$substrCP": [date, 0, 7]}},
+            ],
+            "default": None,
+        }
+    }
+    group_id = {dim: (month if dim == "mes" else f"${dim}") for dim in dims}
+    match = {dim: {"$exists": True, "$ne": None} for dim in dims if dim != "mes"}
+    match[ROLLUP_DATE_FIELD] = {"$exists": True}
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": group_id,
+            "total": {"$sum": {"$convert": {
+                "input": f"${ROLLUP_AMOUNT_FIELD}", "to": "decimal", "onError": 0, "onNull": 0,
+            }}},
+            "count": {"$sum": 1},
+        }},
+        {"$match": {"_id.mes": {"$regex": r"^\d{4}-\d{2}$"}}},
+        {"$project": {
+            "_id": {"rollup": name, **{dim: f"$_id.{dim}" for dim in dims}},
+            "rollup": name,
+            **{dim: f"$_id.{dim}" for dim in dims},
+            "total": 1,
+            "count": 1,
+            "updated_at": stamp,
+        }},
+        {"$merge": {"into": ROLLUP_COLLECTION, "on": "_id", "whenMatched": "replace"}},
+    ]
+
+
+async def rebuild_rollups() -> dict:
+    """
+    Recompute every rollup from the data collection. Existing keys are
+    replaced in place and keys that no longer have data are removed, so
+    readers never see an empty rollup collection.
+    """
+    col = db.get_collection()
+    rollups = get_rollup_collection()
+    await ensure_rollup_indexes()
+
+    # BSON dates keep milliseconds
+    now = datetime.now(timezone.utc)
+    stamp = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    started = time.perf_counter()
+    counts = {}
+    for name, dims in ROLLUPS.items():
+        await col.aggregate(_rebuild_pipeline(name, dims, stamp), allowDiskUse=True).to_list(length=None)
+        stale = await rollups.delete_many({"rollup": name, "updated_at": {"$lt": stamp}})
+        counts[name] = {
+            "keys": await rollups.count_documents({"rollup": name}),
+            "removed": stale.deleted_count,
+        }
+
+    from services.mongo_service import invalidate_collection
+    invalidate_collection(rollups.name)
+
+    rollup_stats["rebuilds"] += 1
+    rollup_stats["last_rebuild"] = stamp.isoformat()
+    rollup_stats["stale"] = False
+    return {"rollups": counts, "seconds": round(time.perf_counter() - started, 2)}
+
+
+def get_rollup_stats() -> dict:
+    return {**rollup_stats, "enabled": ROLLUPS_ENABLED, "collection": ROLLUP_COLLECTION}
@@ -0,0 +1,152 @@
+"""
+Fast-path router: decides if a turn needs the MongoDB agent loop
+
+Conversational turns skip the structured LLMResponse call and go straight
+to plain text generation. Local rules decide the obvious cases; in
+"hybrid"/"model" mode a small model classifies the rest.
+"""
+import re
+import time
+from enum import Enum
+from functools import partial
+from google.genai import types
+
+from config.settings import ROUTER_MODE, ROUTER_MODEL, ROUTER_TIMEOUT, ROUTER_MAX_RETRIES
+from services.call_policy import call_with_policy
+
+# ──────────────────────────── Rules ─────────────────────────────
+
+# Anything that smells like real data or a CRUD request goes to the agent
+_DATA_PATTERN = re.compile(
+    r"\d|gast|cu[aá]nt|negocio|compr|pag|precio|monto|total|promedio|suma|"
+    r"mes|semana|año|ayer|hoy|fecha|registr|agreg|añad|guard|borr|elimin|"
+    r"actualiz|cambi|modific|list|mu[eé]strame|datos|llego|visit|frecuen|"
+    r"compar|factur|recibo|cuenta|presupuesto|ahorr",
+    re.IGNORECASE,
+)
+
+# Short social messages never need data
+_CHAT_PATTERN = re.compile(
+    r"^\W*(hola|hey|buenas|buenos d[ií]as|buenas (tardes|noches)|gracias|"
+    r"muchas gracias|ok|okay|vale|dale|perfecto|genial|jaja\w*|bien|"
+    r"todo bien|qu[eé] tal|c[oó]mo est[aá]s|adi[oó]s|chao|nos vemos)\W*$",
+    re.IGNORECASE,
+)
+
+ROUTER_PROMPT = """Clasifica el mensaje del usuario para un asesor financiero con acceso a una base de datos de gastos y negocios visitados.
+Responde "data" si responderlo requiere consultar o modificar esos datos reales (montos, negocios, fechas, totales, registrar/borrar/actualizar).
+Responde "chat" si es conversación, consejo general, estrategia o algo que se responde sin datos."""
+
+
+class Route(str, Enum):
+    chat = "chat"
+    data = "data"
+
+
+def heuristic_route(message: str) -> Route | None:
+    """Local rules; None when the message is ambiguous"""
+    text = message.strip()
+    if _CHAT_PATTERN.match(text):
+        return Route.chat
+    if _DATA_PATTERN.search(text):
+        return Route.data
+    return None
+
+
+# ──────────────────────────── Stats ─────────────────────────────
+
+router_stats = {
+    "chat": 0,
+    "data": 0,
+    "by_heuristic": 0,
+    "by_model": 0,
+    "model_errors": 0,
+}
+
+# Exponential moving average of full-turn latency per route (ms)
+_turn_latency_ema: dict[str, float] = {}
+_EMA_ALPHA = 0.2
+
+
+def record_turn_latency(route: str, latency_ms: float) -> float | None:
+    """
+    Track turn latency per route. Returns the estimated time saved (ms)
+    when a chat turn is faster than the average agent turn.
+    """
+    previous = _turn_latency_ema.get(route)
+    _turn_latency_ema[route] = (
+        latency_ms if previous is None
+        else (1 - _EMA_ALPHA) * previous + _EMA_ALPHA * latency_ms
+    )
+    if route == Route.chat.value and Route.data.value in _turn_latency_ema:
+        return round(_turn_latency_ema[Route.data.value] - latency_ms, 1)
+    return None
+
+
+def get_router_stats() -> dict:
+    """Decision counts and average turn latency per route"""
+    return {
+        **router_stats,
+        "mode": ROUTER_MODE,
+        "avg_turn_ms": {k: round(v, 1) for k, v in _turn_latency_ema.items()},
+    }
+
+
+# ──────────────────────────── Routing ───────────────────────────
+
+
+async def route_message(client, message: str, has_image: bool = False) -> dict:
+    """
+    Decide the route for a turn.
+
+    Returns {"route": "chat"|"data", "by": ..., "latency_ms": ...}.
+    Images and router errors always go to the agent loop.
+    """
+    started = time.perf_counter()
+    route, by = Route.data, "default"
+
+    if ROUTER_MODE == "off":
+        by = "off"
+    elif has_image:
+        by = "image"
+    else:
+        decided = heuristic_route(message) if ROUTER_MODE != "model" else None
+        if decided is not None:
+            route, by = decided, "heuristic"
+            router_stats["by_heuristic"] += 1
+        elif ROUTER_MODE in ("model", "hybrid"):
+            try:
+                # Timeouts, an open breaker or a refused slot fall back
+                # to the agent loop like any other classifier error
+                response = await call_with_policy(
+                    partial(
+                        client.aio.models.generate_content,
+                        model=ROUTER_MODEL,
+                        contents=message,
+                        config=types.GenerateContentConfig(
+                            system_instruction=ROUTER_PROMPT,
+                            response_mime_type="text/x.enum",
+                            response_schema=Route,
+                            temperature=0.0,
+                        ),
+                    ),
+                    ROUTER_MODEL,
+                    hedge=False,
+                    timeout=ROUTER_TIMEOUT,
+                    max_retries=ROUTER_MAX_RETRIES,
+                )
+                route = Route((response.text or "data").strip())
+                by = "model"
+                router_stats["by_model"] += 1
+            except Exception as e:
+                router_stats["model_errors"] += 1
+                print(f"[ROUTER ERROR] Clasificador falló, uso el agente: {type(e).__name__}: {e}")
+
+    router_stats[route.value] += 1
+    decision = {
+        "route": route.value,
+        "by": by,
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    print(f"[ROUTER] {decision['route']} ({decision['by']}, {decision['latency_ms']}ms): {message[:50]}")
+    return decision
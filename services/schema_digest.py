@@ -0,0 +1,237 @@
+"""
+Schema digest of the data collection for the system context
+
+A background task samples COLLECTION, infers field names, types, example
+values and rough cardinalities, and renders a compact digest that is
+appended to the system prompt, so the model can write filters without
+an exploratory find_one first. Later refreshes only read documents
+inserted since the previous one (by _id) and merge them in. The digest
+text only changes when a field, type or cardinality bucket changes, so
+the Gemini context cache isn't rebuilt on every refresh.
+"""
+import asyncio
+import time
+from datetime import datetime
+from bson import ObjectId, Decimal128, Int64
+
+from config.settings import (
+    COLLECTION,
+    SCHEMA_DIGEST,
+    SCHEMA_DIGEST_SAMPLE_SIZE,
+    SCHEMA_DIGEST_REFRESH,
+    SCHEMA_DIGEST_MAX_FIELDS,
+)
+from database.mongodb import get_collection
+
+# Distinct values tracked per field before it is reported as high-cardinality
+_DISTINCT_CAP = 1000
+_EXAMPLES = 3
+_MAX_EXAMPLE_CHARS = 40
+
+# ──────────────────────────── State ─────────────────────────────
+
+# field path → {"count", "types": {name: n}, "examples": [...], "distinct": set | None}
+_fields: dict[str, dict] = {}
+_docs_seen = 0
+_last_id: ObjectId | None = None
+_digest = ""
+_refreshed_at = 0.0
+_task: asyncio.Task | None = None
+
+digest_stats = {
+    "refreshes": 0,
+    "docs_sampled": 0,
+    "changes": 0,
+    "errors": 0,
+}
+
+
+# ──────────────────────────── Inference ─────────────────────────
+
+
+def _type_name(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, Int64)):
+        return "int"
+    if isinstance(value, float):
+        return "double"
+    if isinstance(value, Decimal128):
+        return "decimal"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, datetime):
+        return "date"
+    if isinstance(value, ObjectId):
+        return "objectId"
+    if isinstance(value, dict):
+        return "object"
+    if isinstance(value, list):
+        inner = {_type_name(v) for v in value[:20]}
+        return f"array<{'|'.join(sorted(inner))}>" if inner else "array"
+    return type(value).__name__
+
+
+def _example(value) -> str | None:
+    if isinstance(value, (dict, list, ObjectId)) or value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    text = str(value)
+    if len(text) > _MAX_EXAMPLE_CHARS:
+        text = text[:_MAX_EXAMPLE_CHARS] + "…"
+    return text
+
+
+def _observe(path: str, value):
+    field = _fields.setdefault(
+        path, {"count": 0, "types": {}, "examples": [], "distinct": set()}
+    )
+    field["count"] += 1
+    type_name = _type_name(value)
+    field["types"][type_name] = field["types"].get(type_name, 0) + 1
+
+    example = _example(value)
+    if example is None:
+        return
+    if len(field["examples"]) < _EXAMPLES and example not in field["examples"]:
+        field["examples"].append(example)
+    if field["distinct"] is not None:
+        field["distinct"].add(example)
+        if len(field["distinct"]) > _DISTINCT_CAP:
+            field["distinct"] = None
+
+
+def _merge(doc: dict, prefix: str = ""):
+    for key, value in doc.items():
+        path = f"{prefix}{key}"
+        _observe(path, value)
+        # One level of nesting is enough to write dotted filters
+        if isinstance(value, dict) and not prefix:
+            _merge(value, f"{path}.")
+
+
+def _cardinality(field: dict) -> str:
+    distinct = field["distinct"]
+    if distinct is None:
+        return f">{_DISTINCT_CAP} valores"
+    n = len(distinct)
+    if n <= 1:
+        return "valor único"
+    for bucket in (10, 100, 1000):
+        if n <= bucket:
+            return f"≤{bucket} valores"
+    return f">{_DISTINCT_CAP} valores"
+
+
+def render_digest() -> str:
+    """Compact digest text, most frequent fields first"""
+    if not _fields:
+        return ""
+    lines = []
+    ordered = sorted(_fields.items(), key=lambda kv: (-kv[1]["count"], kv[0]))
+    for path, field in ordered[:SCHEMA_DIGEST_MAX_FIELDS]:
+        types = "|".join(sorted(field["types"], key=lambda t: -field["types"][t]))
+        optional = "" if field["count"] >= _docs_seen else " (opcional)"
+        line = f"- {path}: {types}{optional}"
+        if path != "_id" and field["examples"]:
+            main_type = max(field["types"], key=field["types"].get)
+            if main_type == "string":
+                examples = ", ".join(f'"{e}"' for e in field["examples"])
+            else:
+                examples = ", ".join(field["examples"])
+            # Cardinality helps for categorical fields, not for amounts/dates
+            if main_type in ("string", "int", "bool"):
+                line += f"; {_cardinality(field)}"
+            line += f"; ej: {examples}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+# ──────────────────────────── Refresh ───────────────────────────
+
+
+async def refresh_digest() -> bool:
+    """
+    Sample the collection (first run) or read documents newer than the
+    last one seen, and re-render the digest. Returns True if it changed.
+    """
+    global _docs_seen, _last_id, _digest, _refreshed_at
+
+    col = get_collection()
+    if _last_id is None:
+        docs = await col.aggregate(
+            [{"$sample": {"size": SCHEMA_DIGEST_SAMPLE_SIZE}}]
+        ).to_list(length=SCHEMA_DIGEST_SAMPLE_SIZE)
+        newest = await col.find({}, {"_id": 1}).sort("_id", -1).limit(1).to_list(length=1)
+        if newest:
+            _last_id = newest[0]["_id"]
+    else:
+        docs = await col.find({"_id": {"$gt": _last_id}}).sort("_id", 1).to_list(
+            length=SCHEMA_DIGEST_SAMPLE_SIZE
+        )
+        if docs:
+            _last_id = docs[-1]["_id"]
+
+    for doc in docs:
+        _merge(doc)
+    _docs_seen += len(docs)
+    _refreshed_at = time.time()
+    digest_stats["refreshes"] += 1
+    digest_stats["docs_sampled"] += len(docs)
+
+    text = render_digest()
+    if text == _digest:
+        return False
+    _digest = text
+    digest_stats["changes"] += 1
+    print(f"[SCHEMA] Digest actualizado: {len(_fields)} campos, {_docs_seen} documentos muestreados")
+    return True
+
+
+async def _refresh_loop():
+    while True:
+        try:
+            await refresh_digest()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            digest_stats["errors"] += 1
+            print(f"[SCHEMA ERROR] No se pudo muestrear {COLLECTION}: {e}")
+        await asyncio.sleep(SCHEMA_DIGEST_REFRESH)
+
+
+def start_schema_digest():
+    """Start the background refresh task (once per process)"""
+    global _task
+    if not SCHEMA_DIGEST or (_task is not None and not _task.done()):
+        return
+    _task = asyncio.get_running_loop().create_task(_refresh_loop())
+
+
+def stop_schema_digest():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+
+
+# ──────────────────────────── Access ────────────────────────────
+
+
+def get_digest() -> str:
+    """Current digest text ("" until the first sample or when disabled)"""
+    return _digest if SCHEMA_DIGEST else ""
+
+
+def get_digest_stats() -> dict:
+    return {
+        **digest_stats,
+        "enabled": SCHEMA_DIGEST,
+        "fields": len(_fields),
+        "docs_seen": _docs_seen,
+        "digest_chars": len(_digest),
+        "refreshed_at": _refreshed_at or None,
+    }
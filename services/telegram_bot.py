@@ -2,12 +2,91 @@
 Telegram bot service for Robert
 """
 import asyncio
-from telegram import Update
+import time
+from datetime import datetime
+import httpx
+from telegram import Bot, Update, Message
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
-from config.settings import TELEGRAM_BOT_TOKEN
-from services.gemini_service import run_agent
-from services.memory_service import save_message, get_chat_history, clear_session_history
+from config.settings import (
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_WEBHOOK_URL,
+    TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_STREAM_REPLIES,
+    TELEGRAM_STREAM_EDIT_INTERVAL,
+    TELEGRAM_COALESCE_WINDOW,
+    DISPATCH_URL,
+    DISPATCH_TIMEOUT,
+)
+from models.schemas import LLMResponse
+from services.gemini_service import run_agent, run_agent_stream
+from services.memory_service import save_turn, save_unanswered, get_context, clear_session_history
+from services.image_service import select_photo, get_cached_image, prepare_image
+from services.metrics import stage, start_timings, format_timings
+from services.turn_pipeline import overlap, typing
+
+
+# Telegram rejects messages longer than this
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+
+# ──────────────────────────── Streaming Replies ─────────────────
+
+
+async def _edit_quietly(message: Message, text: str):
+    """Edit a message, ignoring "not modified" and flood-control errors"""
+    try:
+        with stage("telegram_send", "edit"):
+            await message.edit_text(text[:TELEGRAM_MAX_MESSAGE_LENGTH])
+    except (BadRequest, RetryAfter) as e:
+        print(f"[BOT] Edición omitida: {e}")
+
+
+async def stream_reply(
+    update: Update,
+    message: str,
+    image_bytes: bytes | None = None,
+    image_mime: str | None = None,
+    history: list[dict] | None = None,
+    summary: str | None = None,
+) -> LLMResponse:
+    """
+    Run the agent in streaming mode, showing the reply as it is generated.
+
+    Sends a placeholder message and edits it at most once every
+    TELEGRAM_STREAM_EDIT_INTERVAL seconds; the last edit holds the final
+    reply. Returns the final LLMResponse.
+    """
+    with stage("telegram_send", "placeholder"):
+        placeholder = await update.message.reply_text("…")
+    shown = "…"
+    text = ""
+    current_step = 0
+    last_edit = time.monotonic()
+    llm = None
+
+    async for event in run_agent_stream(
+        message, image_bytes, image_mime, history, summary=summary,
+        session_id=str(update.effective_user.id),
+    ):
+        if event["type"] == "token":
+            # Each agent step produces a new reply; show the latest one
+            if event["step"] != current_step:
+                current_step = event["step"]
+                text = ""
+            text += event["text"]
+            now = time.monotonic()
+            if now - last_edit >= TELEGRAM_STREAM_EDIT_INTERVAL and text.strip() and text != shown:
+                await _edit_quietly(placeholder, text)
+                shown = text
+                last_edit = now
+        elif event["type"] == "final":
+            llm = event["llm"]
+
+    if llm.reply != shown:
+        await _edit_quietly(placeholder, llm.reply)
+    return llm
 
 
 # ──────────────────────────── Bot Handlers ──────────────────────
@@ -49,11 +128,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for /clear command - clears chat history"""
-    user_id = str(update.effective_user.id)
-    await clear_session_history(user_id)
-    await update.message.reply_text(
-        "Listo, he limpiado tu historial. Empezamos de cero."
-    )
+    # Queued behind the user's pending turns so it can't race them
+    dispatch(context, update, "clear")
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -61,96 +137,348 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Handle text messages from users
     Each user's Telegram ID is used as their unique session_id
     """
-    user_id = str(update.effective_user.id)
-    message_text = update.message.text
+    print(f"[BOT] Mensaje recibido de {update.effective_user.id}: {update.message.text[:50]}")
+    dispatch(context, update, "text")
+
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle photo messages from users
+    """
+    dispatch(context, update, "photo")
 
-    print(f"[BOT] Mensaje recibido de {user_id}: {message_text[:50]}")
 
-    # Send typing indicator
-    await update.message.chat.send_action("typing")
+# ──────────────────────────── Turn Processing ───────────────────
 
-    try:
-        # Get chat history
-        print(f"[BOT] Obteniendo historial...")
-        history = await get_chat_history(user_id)
-        print(f"[BOT] Historial: {len(history)} mensajes")
 
-        # Save user message
-        await save_message(user_id, "user", message_text)
-        print(f"[BOT] Mensaje guardado")
+async def _clear_history(update: Update):
+    user_id = str(update.effective_user.id)
+    await clear_session_history(user_id)
+    await update.message.reply_text(
+        "Listo, he limpiado tu historial. Empezamos de cero."
+    )
+
 
-        # Ask Gemini with agent loop
-        print(f"[BOT] Llamando a Gemini (agent loop)...")
-        llm, _steps = await run_agent(message_text, history=history)
-        print(f"[BOT] Respuesta de Gemini: {llm.reply[:80]}")
+async def _reply_to_text(update: Update, message_text: str):
+    """
+    One conversational turn for a (possibly coalesced) text message;
+    the reply goes to `update`'s message
+    """
+    user_id = str(update.effective_user.id)
 
-        # Save assistant reply
-        await save_message(user_id, "assistant", llm.reply)
+    received_at = datetime.utcnow()
+    timings = start_timings()
+    llm = None
 
-        # Send reply to user
-        await update.message.reply_text(llm.reply)
-        print(f"[BOT] Respuesta enviada")
+    try:
+        # "typing" stays visible (and is re-sent) until the agent is done;
+        # the first action goes out while the history is fetched
+        async with typing(update.message.chat):
+            print(f"[BOT] Obteniendo historial...")
+            summary, history = await get_context(user_id)
+            print(f"[BOT] Historial: {len(history)} mensajes" + (" + resumen" if summary else ""))
+
+            # Ask Gemini with agent loop
+            print(f"[BOT] Llamando a Gemini (agent loop)...")
+            if TELEGRAM_STREAM_REPLIES:
+                llm = await stream_reply(update, message_text, history=history, summary=summary)
+            else:
+                llm, _steps = await run_agent(
+                    message_text, history=history, summary=summary, session_id=user_id
+                )
+
+        if TELEGRAM_STREAM_REPLIES:
+            print(f"[BOT] Respuesta enviada (streaming): {llm.reply[:80]}")
+            await save_turn(user_id, message_text, llm.reply, user_at=received_at)
+        else:
+            print(f"[BOT] Respuesta de Gemini: {llm.reply[:80]}")
+            # Send the reply ∥ save the turn (user message + reply)
+            await overlap(
+                _send_reply(update, llm.reply),
+                save_turn(user_id, message_text, llm.reply, user_at=received_at),
+            )
+            print(f"[BOT] Respuesta enviada")
+        print(f"[BOT] Tiempos: {format_timings(timings)}")
 
     except Exception as e:
         import traceback
         print(f"[BOT ERROR] {traceback.format_exc()}")
+        if llm is None:
+            # Failed before the reply: the user's message still goes to history
+            await save_unanswered(user_id, message_text, received_at)
         error_message = f"Algo salió mal, hermano. Intenta de nuevo.\n\nError: {str(e)}"
         await update.message.reply_text(error_message)
 
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _send_reply(update: Update, text: str):
+    with stage("telegram_send", "reply"):
+        await update.message.reply_text(text)
+
+
+async def _load_photo(update: Update) -> tuple[bytes, str]:
     """
-    Handle photo messages from users
+    Smallest photo size that is still big enough, ready for Gemini; skips
+    the download entirely if this image (e.g. forwarded) was already processed
     """
+    photo = select_photo(update.message.photo)
+    cached = get_cached_image(photo.file_unique_id)
+    if cached:
+        return cached
+    photo_file = await photo.get_file()
+    raw = await photo_file.download_as_bytearray()
+    # Telegram photos are always JPEG
+    return await prepare_image(bytes(raw), "image/jpeg", key=photo.file_unique_id)
+
+
+async def _reply_to_photo(update: Update):
+    """One turn for a photo message (never coalesced)"""
     user_id = str(update.effective_user.id)
     caption = update.message.caption or "Analiza esta imagen"
+    received_at = datetime.utcnow()
+    timings = start_timings()
+    llm = None
+
+    try:
+        async with typing(update.message.chat):
+            # Photo download ∥ chat history
+            (photo_bytes, image_mime), (summary, history) = await overlap(
+                _load_photo(update), get_context(user_id)
+            )
+
+            # Ask Gemini with image and history (agent loop)
+            if TELEGRAM_STREAM_REPLIES:
+                llm = await stream_reply(
+                    update, caption, photo_bytes, image_mime, history, summary=summary
+                )
+            else:
+                llm, _steps = await run_agent(
+                    caption, photo_bytes, image_mime, history, summary=summary,
+                    session_id=user_id,
+                )
+
+        # Save the turn (text only, not image), alongside the reply send
+        save = save_turn(user_id, f"[Imagen enviada] {caption}", llm.reply, user_at=received_at)
+        if TELEGRAM_STREAM_REPLIES:
+            await save
+        else:
+            await overlap(_send_reply(update, llm.reply), save)
+        print(f"[BOT] Tiempos (imagen): {format_timings(timings)}")
+
+    except Exception as e:
+        if llm is None:
+            await save_unanswered(user_id, f"[Imagen enviada] {caption}", received_at)
+        error_message = f"No pude procesar la imagen. Error: {str(e)}"
+        await update.message.reply_text(error_message)
+
+
+# ──────────────────────────── Per-user Dispatcher ───────────────
+
+# Work is serialized per user: one drain task per user processes its
+# queue in order, while different users' tasks run concurrently. Text
+# messages arriving within TELEGRAM_COALESCE_WINDOW of each other are
+# merged into a single turn; only a trailing text waits for that window,
+# photos and /clear start right away.
+
+_pending: dict[str, list[tuple[str, Update]]] = {}
+_last_arrival: dict[str, float] = {}
+# Set on each arrival, so a debounce wait ends early when a photo or
+# /clear closes the text group
+_arrived: dict[str, asyncio.Event] = {}
+_drainers: dict[str, asyncio.Task] = {}
+
+dispatcher_stats = {
+    "received": 0,
+    "turns": 0,
+    "coalesced": 0,
+    "forwarded": 0,
+    "forward_errors": 0,
+}
 
-    # Send typing indicator
-    await update.message.chat.send_action("typing")
 
+def dispatch(context: ContextTypes.DEFAULT_TYPE, update: Update, kind: str):
+    """Queue an update ("text", "photo" or "clear") for its user"""
+    user_id = str(update.effective_user.id)
+    _pending.setdefault(user_id, []).append((kind, update))
+    _last_arrival[user_id] = time.monotonic()
+    dispatcher_stats["received"] += 1
+    if user_id in _arrived:
+        _arrived[user_id].set()
+
+    if user_id not in _drainers:
+        _drainers[user_id] = context.application.create_task(
+            _drain(user_id), update=update
+        )
+
+
+async def _drain(user_id: str):
+    """Process everything queued for a user, one turn at a time"""
     try:
-        # Get the largest photo size
-        photo = update.message.photo[-1]
-        photo_file = await photo.get_file()
+        while _pending.get(user_id):
+            # Debounce texts: wait until the user stops typing for a moment
+            while _pending[user_id][-1][0] == "text":
+                wait = _last_arrival[user_id] + TELEGRAM_COALESCE_WINDOW - time.monotonic()
+                if wait <= 0:
+                    break
+                arrived = _arrived.setdefault(user_id, asyncio.Event())
+                arrived.clear()
+                try:
+                    await asyncio.wait_for(arrived.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = _pending.pop(user_id)
+            for group in _group_batch(batch):
+                try:
+                    await _run_group(group)
+                except Exception:
+                    import traceback
+                    print(f"[BOT ERROR] {traceback.format_exc()}")
+    finally:
+        _drainers.pop(user_id, None)
+        _arrived.pop(user_id, None)
+        if not _pending.get(user_id):
+            _last_arrival.pop(user_id, None)
 
-        # Download photo as bytes
-        photo_bytes = await photo_file.download_as_bytearray()
 
-        # Determine mime type (Telegram photos are usually JPEG)
-        image_mime = "image/jpeg"
+def _group_batch(batch: list[tuple[str, Update]]) -> list[list[tuple[str, Update]]]:
+    """Split a batch into turns: consecutive texts merge, others stand alone"""
+    groups = []
+    for kind, update in batch:
+        if kind == "text" and groups and groups[-1][-1][0] == "text":
+            groups[-1].append((kind, update))
+        else:
+            groups.append([(kind, update)])
+    return groups
 
-        # Get chat history
-        history = await get_chat_history(user_id)
 
-        # Save user message (text only, not image)
-        await save_message(user_id, "user", f"[Imagen enviada] {caption}")
+async def _run_group(group: list[tuple[str, Update]]):
+    dispatcher_stats["turns"] += 1
+    if len(group) > 1:
+        dispatcher_stats["coalesced"] += len(group) - 1
+        print(f"[BOT] {len(group)} mensajes agrupados en un turno")
+    if _dispatch_client is not None:
+        await _forward_group(group)
+    else:
+        await _run_turn(group)
 
-        # Ask Gemini with image and history (agent loop)
-        llm, _steps = await run_agent(caption, bytes(photo_bytes), image_mime, history)
 
-        # Save assistant reply
-        await save_message(user_id, "assistant", llm.reply)
+async def _run_turn(group: list[tuple[str, Update]]):
+    """Run one turn (a coalesced text group, a photo or /clear) here"""
+    kind, last_update = group[-1]
+    if kind == "clear":
+        await _clear_history(last_update)
+    elif kind == "photo":
+        await _reply_to_photo(last_update)
+    else:
+        combined = "\n".join(update.message.text for _, update in group)
+        await _reply_to_text(last_update, combined)
 
-        # Send reply
-        await update.message.reply_text(llm.reply)
 
-    except Exception as e:
-        error_message = f"No pude procesar la imagen. Error: {str(e)}"
-        await update.message.reply_text(error_message)
+# ──────────────────────────── Worker Dispatch ───────────────────
+
+# DEPLOY_MODE=workers: the polling process keeps the per-user queue and
+# coalescing above but runs no turns itself. Each turn is POSTed to the
+# API workers, which rebuild the updates with their own Bot and run the
+# same handlers; the drain loop awaits the response, so a user's turns
+# still run one at a time and in order, whichever worker takes them.
+
+DISPATCH_PATH = "/internal/telegram/turn"
+
+_dispatch_client: httpx.AsyncClient | None = None
+_dispatch_secret: str | None = None
+
+# Bot used by an API worker to answer forwarded turns
+worker_bot: Bot | None = None
+
+
+def start_dispatcher(secret: str):
+    """Forward turns to the API workers from now on"""
+    global _dispatch_client, _dispatch_secret
+    _dispatch_secret = secret
+    _dispatch_client = httpx.AsyncClient(base_url=DISPATCH_URL, timeout=DISPATCH_TIMEOUT)
+
+
+async def stop_dispatcher():
+    global _dispatch_client
+    if _dispatch_client is not None:
+        await _dispatch_client.aclose()
+        _dispatch_client = None
+
+
+async def _forward_group(group: list[tuple[str, Update]]):
+    kind, last_update = group[-1]
+    payload = {"kind": kind, "updates": [update.to_dict() for _, update in group]}
+    try:
+        response = await _dispatch_client.post(
+            DISPATCH_PATH, json=payload, headers={"X-Dispatch-Secret": _dispatch_secret}
+        )
+        response.raise_for_status()
+        dispatcher_stats["forwarded"] += 1
+    except httpx.HTTPError as e:
+        dispatcher_stats["forward_errors"] += 1
+        print(f"[BOT ERROR] No se pudo enviar el turno a los workers: {e!r}")
+        await last_update.message.reply_text(
+            "Algo salió mal, hermano. Intenta de nuevo en un momento."
+        )
+
+
+async def start_worker_bot() -> Bot:
+    """Bot for answering forwarded turns in this API worker"""
+    global worker_bot
+    if not TELEGRAM_BOT_TOKEN:
+        raise ValueError("TELEGRAM_BOT_TOKEN no está configurado en el .env")
+    bot = Bot(TELEGRAM_BOT_TOKEN)
+    await bot.initialize()
+    worker_bot = bot
+    return bot
+
+
+async def stop_worker_bot():
+    global worker_bot
+    if worker_bot is not None:
+        await worker_bot.shutdown()
+        worker_bot = None
+
+
+async def run_forwarded_turn(payload: dict):
+    """Run a turn forwarded by the dispatcher; returns when it is done"""
+    group = [(payload["kind"], Update.de_json(data, worker_bot)) for data in payload["updates"]]
+    await _run_turn(group)
+
+
+def get_dispatcher_stats() -> dict:
+    """Queue and coalescing counters for the per-user dispatcher"""
+    return {
+        **dispatcher_stats,
+        "active_users": len(_drainers),
+        "queued": sum(len(items) for items in _pending.values()),
+    }
 
 
 # ──────────────────────────── Bot Setup ─────────────────────────
 
+# Application serving webhook updates (set by start_webhook_bot)
+bot_app: Application = None
 
-def create_bot_application():
+WEBHOOK_PATH = "/telegram/webhook"
+
+
+def create_bot_application(webhook: bool = False):
     """
     Create and configure the Telegram bot application
+
+    Args:
+        webhook: Build without an Updater; updates arrive through the
+            FastAPI webhook route instead of long polling
     """
     if not TELEGRAM_BOT_TOKEN:
         raise ValueError("TELEGRAM_BOT_TOKEN no está configurado en el .env")
 
     # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN)
+    if webhook:
+        builder = builder.updater(None)
+    application = builder.build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -166,6 +494,52 @@ def create_bot_application():
     return application
 
 
+async def start_webhook_bot() -> Application:
+    """
+    Start the bot in webhook mode and register the webhook with Telegram
+    (when TELEGRAM_WEBHOOK_URL is set). No polling, no startup delay.
+    """
+    global bot_app
+    if not TELEGRAM_WEBHOOK_SECRET:
+        raise ValueError("TELEGRAM_WEBHOOK_SECRET no está configurado en el .env")
+
+    application = create_bot_application(webhook=True)
+    await application.initialize()
+    await application.start()
+
+    if TELEGRAM_WEBHOOK_URL:
+        url = f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}/{TELEGRAM_WEBHOOK_SECRET}"
+        await application.bot.set_webhook(
+            url=url,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        print(f"[BOT] Webhook registrado en {TELEGRAM_WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}/***")
+
+    bot_app = application
+    return application
+
+
+async def stop_bot(application: Application):
+    """Stop a running bot application (polling or webhook)"""
+    global bot_app
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    if bot_app is application:
+        bot_app = None
+
+
+async def process_webhook_update(data: dict):
+    """
+    Queue an update received on the webhook; handlers run in the
+    Application's own task so the HTTP response returns immediately.
+    """
+    update = Update.de_json(data, bot_app.bot)
+    await bot_app.update_queue.put(update)
+
+
 async def run_bot():
     """
     Run the Telegram bot
@@ -183,6 +557,4 @@ async def run_bot():
     try:
         await asyncio.Event().wait()
     finally:
-        await application.updater.stop()
-        await application.stop()
-        await application.shutdown()
+        await stop_bot(application)
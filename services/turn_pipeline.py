@@ -0,0 +1,91 @@
+"""
+Per-turn pipeline shared by /chat and the Telegram handlers
+
+A turn runs as three phases whose independent I/O overlaps:
+
+    1. typing action ∥ history fetch ∥ image preparation
+    2. agent run, with "typing" re-sent in the background
+    3. reply send ∥ turn save
+
+With TURN_PIPELINE=false the same steps run one after another, which is
+the baseline benchmarks/load_test.py --no-pipeline measures against.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+from config.settings import TURN_PIPELINE, TELEGRAM_TYPING_REFRESH
+from services.metrics import stage
+
+pipeline_stats = {
+    "overlapped": 0,
+    "typing_sent": 0,
+    "typing_errors": 0,
+}
+
+
+def get_pipeline_stats() -> dict:
+    """Overlap and typing counters for the per-turn pipeline"""
+    return {"enabled": TURN_PIPELINE, **pipeline_stats}
+
+
+async def overlap(*steps):
+    """
+    Await independent steps concurrently and return their results in
+    order; sequentially when the pipeline is disabled. If one fails the
+    others still complete and the first error is raised.
+    """
+    if not TURN_PIPELINE:
+        results = []
+        try:
+            for step in steps:
+                results.append(await step)
+        finally:
+            for step in steps[len(results) + 1:]:
+                step.close()
+        return results
+    pipeline_stats["overlapped"] += 1
+    results = await asyncio.gather(*steps, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def _send_typing(chat):
+    """Send one "typing" action; failures only cost the indicator"""
+    try:
+        with stage("telegram_send", "typing"):
+            await chat.send_action("typing")
+        pipeline_stats["typing_sent"] += 1
+    except Exception as e:
+        pipeline_stats["typing_errors"] += 1
+        print(f"[BOT] Acción 'typing' omitida: {e}")
+
+
+async def _typing_loop(chat, send_first: bool, interval: float):
+    if send_first:
+        await _send_typing(chat)
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        await _send_typing(chat)
+
+
+@asynccontextmanager
+async def typing(chat, interval: float = TELEGRAM_TYPING_REFRESH):
+    """
+    Show "typing" in `chat` for as long as the block runs.
+
+    The first action is sent in the background so the block's own I/O
+    (history fetch, photo download) starts right away; it is then
+    re-sent every `interval` seconds, since Telegram clears the
+    indicator after ~5s and agent turns with several steps take longer.
+    """
+    if not TURN_PIPELINE:
+        await _send_typing(chat)
+    task = asyncio.create_task(_typing_loop(chat, TURN_PIPELINE, interval))
+    try:
+        yield
+    finally:
+        task.cancel()
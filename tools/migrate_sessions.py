@@ -0,0 +1,106 @@
+"""
+Move chat history from one document per message to per-session documents
+
+Reads every session in MEMORY_COLLECTION, writes its newest
+MEMORY_SESSION_MAX_MESSAGES messages to MEMORY_SESSION_COLLECTION and the
+rest to the time-bucketed MEMORY_ARCHIVE_COLLECTION. Each session is
+rebuilt from the source, so the tool can be re-run after a failure.
+
+Stop the app first, migrate, then start it with MEMORY_LAYOUT=session
+(re-running after the switch would overwrite turns saved since):
+
+    python -m tools.migrate_sessions --dry-run
+    python -m tools.migrate_sessions
+    python -m tools.migrate_sessions --delete-source   # once verified
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+from config.settings import MEMORY_SESSION_MAX_MESSAGES
+from database.mongodb import init_db, close_db
+from services.memory_service import (
+    estimate_tokens,
+    archive_requests,
+    ensure_session_indexes,
+    get_memory_collection,
+    get_session_collection,
+    get_archive_collection,
+)
+
+# Archive upserts per bulk_write
+_BATCH = 1000
+
+
+async def migrate_session(session_id: str, dry_run: bool) -> tuple[int, int]:
+    """Rebuild one session's document + archive; returns (kept, archived)"""
+    messages = await get_memory_collection().find(
+        {"sessionID": session_id},
+        {"_id": 0, "role": 1, "message": 1, "timestamp": 1, "tokens": 1},
+    ).sort("timestamp", 1).to_list(length=None)
+    for msg in messages:
+        msg["tokens"] = msg.get("tokens") or estimate_tokens(msg["message"])
+
+    recent = messages[-MEMORY_SESSION_MAX_MESSAGES:]
+    older = messages[:-MEMORY_SESSION_MAX_MESSAGES] if len(messages) > len(recent) else []
+    if dry_run:
+        return len(recent), len(older)
+
+    archive = get_archive_collection()
+    await archive.delete_many({"sessionID": session_id})
+    requests = archive_requests(session_id, older)
+    for i in range(0, len(requests), _BATCH):
+        await archive.bulk_write(requests[i:i + _BATCH], ordered=False)
+
+    now = datetime.utcnow()
+    await get_session_collection().replace_one(
+        {"_id": session_id},
+        {"messages": recent, "total": len(messages), "updated_at": now, "migrated_at": now},
+        upsert=True,
+    )
+    return len(recent), len(older)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--session", help="Migrate only this sessionID")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would move")
+    parser.add_argument("--delete-source", action="store_true",
+                        help="Delete each session's messages from MEMORY_COLLECTION after migrating it")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        await ensure_session_indexes()
+        if args.session:
+            sessions = [args.session]
+        else:
+            # $group rather than distinct: no 16MB cap on the result
+            cursor = get_memory_collection().aggregate(
+                [{"$group": {"_id": "$sessionID"}}], allowDiskUse=True
+            )
+            sessions = [doc["_id"] async for doc in cursor]
+
+        started = time.perf_counter()
+        kept_total, archived_total = 0, 0
+        for i, session_id in enumerate(sessions, 1):
+            kept, archived = await migrate_session(session_id, args.dry_run)
+            kept_total += kept
+            archived_total += archived
+            if args.delete_source and not args.dry_run:
+                await get_memory_collection().delete_many({"sessionID": session_id})
+            if i % 100 == 0:
+                print(f"[MIGRATE] {i}/{len(sessions)} sesiones")
+
+        verb = "Se moverían" if args.dry_run else "Migrados"
+        print(
+            f"[MIGRATE] {verb} {len(sessions)} sesiones: {kept_total} mensajes en documentos "
+            f"de sesión, {archived_total} archivados ({time.perf_counter() - started:.1f}s)"
+        )
+    finally:
+        close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,28 @@
+"""
+Rebuild the materialized spending rollups from the data collection
+
+Use it once after enabling rollups (backfill), and whenever documents are
+written by something other than Robert (e.g. the Llego app itself) —
+from cron if that happens regularly.
+
+    python -m tools.rebuild_rollups
+"""
+import asyncio
+import json
+
+from database.mongodb import init_db, close_db
+from services.rollup_service import rebuild_rollups
+
+
+async def main():
+    await init_db()
+    try:
+        print("Reconstruyendo rollups...")
+        result = await rebuild_rollups()
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+    finally:
+        close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())